@@ -1,7 +1,23 @@
+from collections import OrderedDict
+
 from django import get_version
+from django.conf.urls import patterns, url
 from django.contrib import admin
+from django.contrib.admin.util import unquote
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import (ChangeList, ALL_VAR, ORDER_VAR,
+                                            ORDER_TYPE_VAR)
+from django.core.paginator import Paginator, InvalidPage
+from django.core.exceptions import PermissionDenied
+from django.http import Http404
+from django.shortcuts import get_object_or_404, render
+from django.utils.translation import ugettext_lazy as _
 
-from flag.models import FlaggedContent, FlagInstance
+from flag import settings as flag_settings
+from flag import registry
+from flag.models import (FlaggedContent, FlagInstance, FlagPolicy,
+                         FlagCounter, FlagRollup)
+from flag.utils import estimate_count
 
 
 class InlineFlagInstance(admin.TabularInline):
@@ -10,11 +26,178 @@ class InlineFlagInstance(admin.TabularInline):
     raw_id_fields = ('user', )
 
 
+# GET parameter to ask for exact counts in the changelist
+EXACT_COUNT_VAR = '_exact_count'
+
+
+class StatusListFilter(admin.SimpleListFilter):
+    """
+    Filter on the status, with the number of flagged contents of each status
+    (read from the FlagCounter table)
+    """
+    title = _('status')
+    parameter_name = 'status'
+
+    def lookups(self, request, model_admin):
+        """
+        The global statuses, the ones of the models with flagged contents
+        (which may have their own STATUSES setting), and any other status
+        used
+        """
+        labels = OrderedDict(flag_settings.STATUSES)
+        content_type_ids = FlagCounter.objects.values_list('content_type',
+                                                           flat=True)
+        for content_type_id in set(content_type_ids):
+            content_type = registry.get_tuple_for_id(content_type_id)
+            entry = content_type and registry.get('%s.%s' % content_type)
+            if entry is not None:
+                for status, label in entry.policy['STATUSES']:
+                    labels.setdefault(status, label)
+        counts = FlaggedContent.objects.count_by_status()
+        for status in sorted(counts):
+            labels.setdefault(status, unicode(status))
+        return [(str(status), u'%s (%s)' % (label, counts.get(status, 0)))
+                for status, label in labels.items()]
+
+    def queryset(self, request, queryset):
+        if self.value() is None:
+            return queryset
+        return queryset.filter(status=self.value())
+
+
+class ApproximatePaginator(Paginator):
+    """
+    Paginator using an estimate of the number of objects (see
+    `estimate_count`) if it's more than the ADMIN_COUNT_THRESHOLD setting,
+    instead of counting them. If `exact` is True, the objects are always
+    counted.
+    """
+    def __init__(self, *args, **kwargs):
+        self.exact = kwargs.pop('exact', False)
+        self.approximate = False
+        super(ApproximatePaginator, self).__init__(*args, **kwargs)
+
+    def _get_count(self):
+        if self._count is None:
+            count = None
+            if not self.exact:
+                count = self.estimate_count()
+                if count is not None and \
+                        count > flag_settings.ADMIN_COUNT_THRESHOLD:
+                    self.approximate = True
+                else:
+                    count = None
+            if count is None:
+                count = self.object_list.count()
+            self._count = count
+        return self._count
+    count = property(_get_count)
+
+    def estimate_count(self):
+        """
+        Return the estimated number of objects, or None
+        """
+        return estimate_count(self.object_list)
+
+    def page(self, number):
+        """
+        If the count is estimated, a page can be after the last one without
+        being detected: in this case, the objects are counted to raise
+        EmptyPage as usual
+        """
+        page = super(ApproximatePaginator, self).page(number)
+        if self.approximate and page.number > 1:
+            page.object_list = list(page.object_list)
+            if not page.object_list:
+                self.exact, self.approximate = True, False
+                self._count = self._num_pages = None
+                return super(ApproximatePaginator, self).page(number)
+        return page
+
+
+class ApproximateChangeList(ChangeList):
+    """
+    ChangeList which doesn't count the objects (filtered or not) when the
+    estimates given by its paginator (an ApproximatePaginator) are enough
+    (the `get_results` method is the same as the django one, excepted for
+    the count without filters)
+    """
+    def get_counted_results(self):
+        """
+        If the list is only filtered by status (or not filtered), return the
+        number of objects with and without the filter, read from the
+        FlagCounter table, else None
+        """
+        params = dict((key, value) for key, value in self.params.items()
+                      if key not in (ALL_VAR, ORDER_VAR, ORDER_TYPE_VAR))
+        if self.exact_count or self.query or \
+                set(params) - set([StatusListFilter.parameter_name]):
+            return None
+        counts = FlaggedContent.objects.count_by_status()
+        full_result_count = sum(counts.values())
+        status = params.get(StatusListFilter.parameter_name)
+        if status is None:
+            return full_result_count, full_result_count
+        try:
+            return counts.get(int(status), 0), full_result_count
+        except ValueError:
+            return None
+
+    def get_results(self, request):
+        self.exact_count = getattr(request, 'flag_exact_count', False)
+        paginator = self.model_admin.get_paginator(request, self.query_set,
+                                                   self.list_per_page)
+        counted = self.get_counted_results()
+        if counted is not None:
+            # the counters are used instead of counting the objects
+            paginator._count = counted[0]
+        # Get the number of objects, with admin filters applied.
+        result_count = paginator.count
+        approximate = paginator.approximate
+
+        # Get the total number of objects, with no admin filters applied.
+        if counted is not None:
+            full_result_count = counted[1]
+        elif not self.query_set.query.where:
+            full_result_count = result_count
+        else:
+            full_paginator = self.model_admin.get_paginator(request,
+                    self.root_query_set, self.list_per_page)
+            full_result_count = full_paginator.count
+            approximate = approximate or full_paginator.approximate
+
+        can_show_all = result_count <= self.list_max_show_all
+        multi_page = result_count > self.list_per_page
+
+        # Get the list of objects to display on this page.
+        if (self.show_all and can_show_all) or not multi_page:
+            result_list = self.query_set._clone()
+        else:
+            try:
+                result_list = paginator.page(self.page_num + 1).object_list
+            except InvalidPage:
+                raise IncorrectLookupParameters
+
+        self.result_count = result_count
+        self.full_result_count = full_result_count
+        self.approximate_count = approximate
+        self.result_list = result_list
+        self.can_show_all = can_show_all
+        self.multi_page = multi_page
+        self.paginator = paginator
+
+    def get_exact_count_url(self):
+        """
+        Return the url of the current page, with exact counts
+        """
+        return self.get_query_string({EXACT_COUNT_VAR: 1})
+
+
 class FlaggedContentAdmin(admin.ModelAdmin):
     inlines = [InlineFlagInstance]
     list_display = ('id', '__unicode__', 'status', 'count')
     list_display_links = ('id', '__unicode__')
-    list_filter = ('status',)
+    list_filter = (StatusListFilter,)
     readonly_fields = ('content_type', 'object_id')
     raw_id_fields = ('creator', 'moderator')
     if get_version() >= '1.4':
@@ -31,5 +214,124 @@ class FlaggedContentAdmin(admin.ModelAdmin):
                   'count',
                   'moderator')
 
+    paginator = ApproximatePaginator
+
+    def get_changelist(self, request, **kwargs):
+        return ApproximateChangeList
+
+    def get_paginator(self, request, queryset, per_page, orphans=0,
+                      allow_empty_first_page=True):
+        return self.paginator(queryset, per_page, orphans,
+                              allow_empty_first_page,
+                              exact=getattr(request, 'flag_exact_count',
+                                            False))
+
+    def changelist_view(self, request, extra_context=None):
+        """
+        Manage the parameter to ask for exact counts (it's not a filter)
+        """
+        if EXACT_COUNT_VAR in request.GET:
+            request.GET = request.GET.copy()
+            del request.GET[EXACT_COUNT_VAR]
+            request.flag_exact_count = True
+        return super(FlaggedContentAdmin, self).changelist_view(request,
+                                                                extra_context)
+
+    def get_inline_instances(self, request):
+        """
+        The flags are only editable (all at once) if the
+        ADMIN_EDITABLE_INSTANCES setting is True, else they are displayed by
+        pages (see `instances_view`)
+        """
+        if not flag_settings.ADMIN_EDITABLE_INSTANCES:
+            return []
+        return super(FlaggedContentAdmin, self).get_inline_instances(request)
+
+    def get_urls(self):
+        info = self.model._meta.app_label, self.model._meta.module_name
+        return patterns('',
+            url(r'^(.+)/instances/$',
+                self.admin_site.admin_view(self.instances_view),
+                name='%s_%s_instances' % info),
+        ) + super(FlaggedContentAdmin, self).get_urls()
+
+    def get_instances_context(self, flagged_content, after=None):
+        """
+        Return the context to render a page of flags of the flagged content
+        """
+        flag_instances, next_cursor = FlagInstance.objects.get_page(
+                flagged_content, after,
+                flag_settings.ADMIN_INSTANCES_PAGE_SIZE)
+        statuses = dict(flagged_content.content_settings('STATUSES'))
+        for flag_instance in flag_instances:
+            flag_instance.status_label = statuses.get(flag_instance.status,
+                                                      flag_instance.status)
+        return dict(flagged_content=flagged_content,
+                    flag_instances=flag_instances,
+                    next_cursor=next_cursor)
+
+    def change_view(self, request, object_id, form_url='',
+                    extra_context=None):
+        """
+        Add the summary and the first page of flags in the context
+        """
+        extra_context = dict(extra_context or {})
+        if not flag_settings.ADMIN_EDITABLE_INSTANCES:
+            flagged_content = self.get_object(request,
+                                              unquote(object_id))
+            if flagged_content is not None:
+                summary = FlagInstance.objects.get_summary(flagged_content)
+                statuses = dict(flagged_content.content_settings('STATUSES'))
+                summary['by_status'] = [
+                    (statuses.get(status, status), count)
+                    for status, count in sorted(summary['by_status'].items())]
+                extra_context['flag_summary'] = summary
+                extra_context.update(
+                        self.get_instances_context(flagged_content))
+        return super(FlaggedContentAdmin, self).change_view(request,
+                object_id, form_url, extra_context)
+
+    def instances_view(self, request, object_id):
+        """
+        Render a page of flags of the flagged content, after the `after`
+        cursor, to be added in the change page
+        """
+        flagged_content = get_object_or_404(FlaggedContent,
+                                            pk=unquote(object_id))
+        if not self.has_change_permission(request, flagged_content):
+            raise PermissionDenied
+        try:
+            context = self.get_instances_context(flagged_content,
+                                                 request.GET.get('after'))
+        except ValueError:
+            raise Http404
+        return render(request, 'admin/flag/flaggedcontent/instances.html',
+                      context)
+
 
 admin.site.register(FlaggedContent, FlaggedContentAdmin)
+
+
+class FlagPolicyAdmin(admin.ModelAdmin):
+    list_display = ('model', 'settings', 'when_updated')
+    search_fields = ('model',)
+
+
+admin.site.register(FlagPolicy, FlagPolicyAdmin)
+
+
+class FlagCounterAdmin(admin.ModelAdmin):
+    list_display = ('content_type', 'status', 'count')
+    list_filter = ('content_type',)
+
+
+admin.site.register(FlagCounter, FlagCounterAdmin)
+
+
+class FlagRollupAdmin(admin.ModelAdmin):
+    list_display = ('day', 'content_type', 'status', 'count')
+    list_filter = ('content_type', 'status')
+    date_hierarchy = 'day'
+
+
+admin.site.register(FlagRollup, FlagRollupAdmin)
@@ -0,0 +1,71 @@
+"""
+Versioned cache keys for the values and rendered templates of flagged
+objects, used by the `*_cached` templatetags and filters.
+Each object has a version, bumped when it's flagged or when its status
+changes: all the keys of the object change at once, without having to find
+and delete them.
+"""
+
+import time
+from hashlib import md5
+
+from django.core.cache import get_cache
+
+from flag import settings as flag_settings
+
+_VERSION_KEY = 'flag:version:%s:%s'
+_KEY = 'flag:%s:%s:%s:%s:%s'
+
+
+def get_backend():
+    """
+    Return the django cache defined by the CACHE_BACKEND setting
+    """
+    return get_cache(flag_settings.CACHE_BACKEND)
+
+
+def _new_version():
+    """
+    A new version is based on the current time (in microseconds), so an
+    evicted version key will never make old entries valid again
+    """
+    return int(time.time() * 1000000)
+
+
+def get_version(content_type_id, object_id, backend=None):
+    """
+    Return the current version of the given object
+    """
+    backend = backend or get_backend()
+    key = _VERSION_KEY % (content_type_id, object_id)
+    version = backend.get(key)
+    if version is None:
+        version = _new_version()
+        if not backend.add(key, version, flag_settings.CACHE_TIMEOUT):
+            version = backend.get(key) or version
+    return version
+
+
+def bump_version(content_type_id, object_id, backend=None):
+    """
+    Change the version of the given object, to invalidate all its cached
+    values. Nothing else than the version key is touched.
+    """
+    backend = backend or get_backend()
+    key = _VERSION_KEY % (content_type_id, object_id)
+    try:
+        backend.incr(key)
+    except ValueError:
+        # no version yet (or evicted)
+        backend.set(key, _new_version(), flag_settings.CACHE_TIMEOUT)
+
+
+def make_key(kind, content_type_id, object_id, *parts, **kwargs):
+    """
+    Return a key for a `kind` of value ("count", "form"...) of the given
+    object, in its current version. `parts` are added to make the key
+    unique for other things than the object
+    """
+    version = get_version(content_type_id, object_id, kwargs.get('backend'))
+    extra = md5(repr(parts)).hexdigest() if parts else ''
+    return _KEY % (kind, content_type_id, object_id, version, extra)
@@ -0,0 +1,192 @@
+"""
+Bounded thread pool to run the deferred receivers of signals (see
+`signals.DeferredSignal`) out of the request.
+With the `FlagDeferredSignalsMiddleware` middleware, the receivers are only
+run after the response (so after the commit of the transaction, if the
+middleware is set before the `TransactionMiddleware` one), and not at all if
+the view raised an exception.
+The pool is drained (with a DEFERRED_DRAIN_TIMEOUT timeout) when the process
+exits.
+"""
+
+import atexit
+import logging
+import os
+import Queue
+import threading
+import time
+
+from django.db import connections
+
+from flag import settings as flag_settings
+
+__all__ = ('Pool', 'defer', 'hold', 'release', 'discard', 'drain',
+           'get_stats')
+
+logger = logging.getLogger('flag.deferred')
+
+# tasks held for the current thread (by `hold`), until `release`
+_local = threading.local()
+
+
+class Pool(object):
+    """
+    A pool of DEFERRED_WORKERS threads, started on first use (and again in a
+    forked process), running the tasks of a queue of DEFERRED_QUEUE_SIZE
+    tasks. If the queue is full, a task is run in the calling thread, or
+    dropped, depending on the DEFERRED_QUEUE_FULL setting ("inline" or
+    "drop")
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.queue = None
+        self.threads = []
+        self.stats = dict(submitted=0, run=0, failed=0, inline=0, dropped=0)
+
+    def start(self):
+        """
+        Start the threads if not running in this process
+        """
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.queue = Queue.Queue(flag_settings.DEFERRED_QUEUE_SIZE)
+            self.threads = []
+            for index in range(flag_settings.DEFERRED_WORKERS):
+                thread = threading.Thread(target=self.run,
+                                          name='flag-deferred-%d' % index)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Add a task to the queue
+        """
+        self.start()
+        try:
+            self.queue.put_nowait((func, args, kwargs))
+        except Queue.Full:
+            if flag_settings.DEFERRED_QUEUE_FULL == 'drop':
+                self._count('dropped')
+                logger.warning('Deferred tasks queue full, %r dropped', func)
+            else:
+                self._count('inline')
+                self.execute(func, args, kwargs)
+        else:
+            self._count('submitted')
+
+    def execute(self, func, args, kwargs):
+        """
+        Run a task, logging its exceptions
+        """
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            self._count('failed')
+            logger.exception('Deferred task %r failed', func)
+        else:
+            self._count('run')
+
+    def run(self):
+        while True:
+            func, args, kwargs = self.queue.get()
+            try:
+                self.execute(func, args, kwargs)
+            finally:
+                self.queue.task_done()
+            # don't keep database connections open while idle
+            if self.queue.empty():
+                for connection in connections.all():
+                    connection.close()
+
+    def drain(self, timeout=None):
+        """
+        Wait for all the tasks of the queue to be run. Return False if they
+        are not after `timeout` seconds
+        """
+        if self.pid != os.getpid():
+            return True
+        end = time.time() + timeout if timeout is not None else None
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = end - time.time() if end is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def get_stats(self):
+        """
+        Return a copy of the counters of tasks: `submitted` (to the queue),
+        `run` and `failed` (by the threads, or inline), `inline` (run in the
+        calling thread because the queue was full) and `dropped`
+        """
+        with self.lock:
+            return dict(self.stats)
+
+
+_pool = Pool()
+
+
+def defer(func, *args, **kwargs):
+    """
+    Run the task in the pool, now or, if tasks are held for the current
+    thread, when they are released
+    """
+    pending = getattr(_local, 'pending', None)
+    if pending is not None:
+        pending.append((func, args, kwargs))
+    else:
+        _pool.submit(func, *args, **kwargs)
+
+
+def hold():
+    """
+    Keep the next tasks of the current thread until `release` or `discard`
+    """
+    _local.pending = []
+
+
+def release():
+    """
+    Send the held tasks of the current thread to the pool
+    """
+    pending, _local.pending = getattr(_local, 'pending', None), None
+    for func, args, kwargs in pending or ():
+        _pool.submit(func, *args, **kwargs)
+
+
+def discard():
+    """
+    Forget the held tasks of the current thread
+    """
+    _local.pending = None
+
+
+def drain(timeout=None):
+    """
+    Wait for the tasks of the pool to be run
+    """
+    return _pool.drain(timeout)
+
+
+def get_stats():
+    """
+    Return the counters of tasks of the pool (see `Pool.get_stats`)
+    """
+    return _pool.get_stats()
+
+
+def _drain_at_exit():
+    if not drain(flag_settings.DEFERRED_DRAIN_TIMEOUT):
+        logger.warning('Deferred tasks not run at exit')
+
+atexit.register(_drain_at_exit)
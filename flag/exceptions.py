@@ -3,14 +3,16 @@ __all__ = ('FlagException',
            'ContentAlreadyFlaggedByUserException',
            'ContentFlaggedEnoughException',
            'FlagCommentException',
-           'FlagUserNotTrustedException')
+           'FlagUserNotTrustedException',
+           'IdempotencyKeyReusedException')
 
 
 class FlagException(Exception):
     """
     Base class for django-flag exceptions
+    The `code` attribute is used as `error_code` in json responses
     """
-    pass
+    code = 'flag_error'
 
 
 class ModelCannotBeFlaggedException(FlagException):
@@ -18,7 +20,7 @@ class ModelCannotBeFlaggedException(FlagException):
     Exception raised when a user try to flag a object that is not defined
     in the FLAG_MODELS settings (only if this settings if defined)
     """
-    pass
+    code = 'model_cannot_be_flagged'
 
 
 class ContentAlreadyFlaggedByUserException(FlagException):
@@ -27,7 +29,7 @@ class ContentAlreadyFlaggedByUserException(FlagException):
     already flagged and the number of its flags raised the
     LIMIT_SAME_OBJECT_FOR_USER value
     """
-    pass
+    code = 'already_flagged_by_user'
 
 
 class ContentFlaggedEnoughException(FlagException):
@@ -35,7 +37,7 @@ class ContentFlaggedEnoughException(FlagException):
     Exception raised when someone try to flag an object which is
     already flagged and the LIMIT_FOR_OBJECT is raised
     """
-    pass
+    code = 'flagged_enough'
 
 
 class FlagCommentException(FlagException):
@@ -43,7 +45,7 @@ class FlagCommentException(FlagException):
     Exception raised when someone try to add a comment while flagging an
     object but with the ALLOW_COMMENTS settings to False (or the opposite)
     """
-    pass
+    code = 'invalid_comment'
 
 
 class OnlyStaffCanUpdateStatus(FlagException):
@@ -51,11 +53,19 @@ class OnlyStaffCanUpdateStatus(FlagException):
     Exception raised when someone not in staff try to update the status
     of a flagged content
     """
-    pass
+    code = 'only_staff_can_update_status'
 
 class FlagUserNotTrustedException(FlagException):
     """
     Exception raised in case someone not trusted try to flag a content
     see FlagInstance.can_creator_be_trusted() for details
     """
-    pass
+    code = 'user_not_trusted'
+
+
+class IdempotencyKeyReusedException(FlagException):
+    """
+    Exception raised when a user sends an idempotency key already used for
+    a flag of another object
+    """
+    code = 'idempotency_key_reused'
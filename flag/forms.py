@@ -8,6 +8,24 @@ from django.utils.hashcompat import sha_constructor
 from django.conf import settings
 
 from flag import settings as flag_settings
+from flag.utils import LRUCache
+
+# cache of the security hashes generated for the initial data of the forms,
+# by (content_type, object_pk, timestamp)
+_security_hashes = LRUCache()
+SECURITY_HASHES_CACHE_SIZE = 10000
+
+
+def get_security_timestamp():
+    """
+    Return the timestamp to use in new forms: the current one, rounded down
+    to the SECURITY_TIMESTAMP_BUCKET setting
+    """
+    timestamp = int(time.time())
+    bucket = flag_settings.SECURITY_TIMESTAMP_BUCKET
+    if bucket > 1:
+        timestamp -= timestamp % bucket
+    return timestamp
 
 
 class SecurityForm(forms.Form):
@@ -67,7 +85,7 @@ class SecurityForm(forms.Form):
 
     def generate_security_data(self):
         """Generate a dict of security data for "initial" data."""
-        timestamp = int(time.time())
+        timestamp = get_security_timestamp()
         security_dict = {
             'content_type': str(self.target_object._meta),
             'object_pk': str(self.target_object._get_pk_val()),
@@ -80,6 +98,8 @@ class SecurityForm(forms.Form):
         """
         Generate the initial security hash from self.content_object
         and a (unix) timestamp.
+        The hash is memoized, as many forms for the same object share the
+        same timestamp (see the SECURITY_TIMESTAMP_BUCKET setting)
         """
 
         initial_security_dict = {
@@ -87,7 +107,17 @@ class SecurityForm(forms.Form):
             'object_pk': str(self.target_object._get_pk_val()),
             'timestamp': str(timestamp),
           }
-        return self.generate_security_hash(**initial_security_dict)
+        key = (initial_security_dict['content_type'],
+               initial_security_dict['object_pk'],
+               initial_security_dict['timestamp'])
+        security_hash = _security_hashes.get(key)
+        if security_hash is None:
+            security_hash = self.generate_security_hash(
+                    **initial_security_dict)
+            _security_hashes.set(key, security_hash,
+                                 flag_settings.SECURITY_TIMESTAMP_BUCKET or 1,
+                                 SECURITY_HASHES_CACHE_SIZE)
+        return security_hash
 
     def generate_security_hash(self, content_type, object_pk, timestamp):
         """
@@ -0,0 +1,224 @@
+"""
+Queued mode of the views adding flags (QUEUE setting): the views only check
+the form and put the flag in a queue, and the flags are added later, by
+batches, by the `flag_process_queue` command (see `process`).
+The queue is defined by the QUEUE_BACKEND setting: the default one,
+`DatabaseQueue`, stores the flags in the QueuedFlag table.
+"""
+
+import logging
+
+from django.contrib.auth.models import User
+from django.db import router, transaction
+from django.utils.translation import ugettext as _
+
+from flag import settings as flag_settings
+from flag import cache as flag_cache
+from flag import registry
+from flag.exceptions import ContentAlreadyFlaggedByUserException
+from flag.models import FlagInstance, QueuedFlag
+from flag.utils import import_from_path, in_transaction
+
+__all__ = ('DatabaseQueue', 'load_flags', 'get_queue', 'enqueue', 'process')
+
+_DUPLICATE_KEY = 'flag:queued:%s:%s:%s'
+
+logger = logging.getLogger('flag.ingestion')
+
+# the queue, for a generation of the settings
+_queue = dict(generation=None, queue=None)
+
+
+class DatabaseQueue(object):
+    """
+    Queue stored in the QueuedFlag table.
+    A queue has a `put` method to add a flag, `get_batch` to get the next
+    flags, and `ack` to remove them once added. Flags are read and removed
+    in the transaction in which they are added
+    """
+
+    def put(self, user, content_object, content_creator=None, comment=None,
+            idempotency_key=None):
+        """
+        Add a flag to the queue
+        """
+        QueuedFlag.objects.create(
+                user=user,
+                content_type_id=registry.get_for_model(
+                        content_object).content_type_id,
+                object_id=content_object.pk,
+                creator=content_creator,
+                comment=comment,
+                idempotency_key=idempotency_key or None)
+
+    def get_batch(self, size):
+        """
+        Return a list of `(key, flag)` tuples for the next `size` flags, with
+        each flag as a dict with the `user`, `content_object`,
+        `content_creator`, `comment` and `idempotency_key` entries (see
+        `load_flags`)
+        """
+        queued_flags = list(QueuedFlag.objects.select_for_update()
+                                              .order_by('id')[:size])
+        flags = load_flags([dict(user_id=queued_flag.user_id,
+                                 content_type_id=queued_flag.content_type_id,
+                                 object_id=queued_flag.object_id,
+                                 creator_id=queued_flag.creator_id,
+                                 comment=queued_flag.comment,
+                                 idempotency_key=queued_flag.idempotency_key)
+                            for queued_flag in queued_flags])
+        return [(queued_flag.id, flag)
+                for queued_flag, flag in zip(queued_flags, flags)]
+
+    def ack(self, keys):
+        """
+        Remove the given flags from the queue
+        """
+        QueuedFlag.objects.filter(id__in=keys).delete()
+
+
+def load_flags(rows):
+    """
+    Return a list of flags, as dicts with the `user`, `content_object`,
+    `content_creator`, `comment` and `idempotency_key` entries (to be passed
+    to `FlagInstance.objects.add_grouped`), for a list of dicts with the
+    `user_id`, `content_type_id`, `object_id`, `creator_id` and `comment`
+    entries, and an optional `idempotency_key` one. Users and objects are
+    loaded with a query by model, and are None if they were deleted
+    """
+    user_ids = set()
+    object_ids = {}
+    for row in rows:
+        user_ids.update((row['user_id'], row['creator_id']))
+        object_ids.setdefault(row['content_type_id'], set())\
+                  .add(row['object_id'])
+    user_ids.discard(None)
+    users = User.objects.in_bulk(list(user_ids))
+
+    objects = {}
+    for content_type_id, ids in object_ids.items():
+        model = registry.get_model_for_id(content_type_id)
+        if model is None:
+            continue
+        for pk, obj in model._default_manager.in_bulk(list(ids)).items():
+            objects[(content_type_id, pk)] = obj
+
+    return [dict(user=users.get(row['user_id']),
+                 content_object=objects.get((row['content_type_id'],
+                                             row['object_id'])),
+                 content_creator=users.get(row['creator_id']),
+                 comment=row['comment'],
+                 idempotency_key=row.get('idempotency_key'))
+            for row in rows]
+
+
+def get_queue():
+    """
+    Return the queue defined by the QUEUE_BACKEND setting
+    """
+    if _queue['generation'] != flag_settings.generation:
+        queue = import_from_path(flag_settings.QUEUE_BACKEND)()
+        _queue.update(generation=flag_settings.generation, queue=queue)
+    return _queue['queue']
+
+
+def enqueue(user, content_object, content_creator=None, comment=None,
+            idempotency_key=None):
+    """
+    Put a flag in the queue. If the model allows only one flag by user
+    (LIMIT_SAME_OBJECT_FOR_USER is 1), raise a
+    ContentAlreadyFlaggedByUserException if the user already queued a flag
+    for this object in the last QUEUE_DUPLICATE_TIMEOUT seconds (only
+    checked in the cache, the other checks are done when the flag is added),
+    except if it was with the same `idempotency_key`: it's a retry, and the
+    flag is not queued again
+    """
+    entry = registry.get_for_model(content_object)
+    if entry.policy['LIMIT_SAME_OBJECT_FOR_USER'] == 1:
+        key = _DUPLICATE_KEY % (user.pk, entry.content_type_id,
+                                content_object.pk)
+        backend = flag_cache.get_backend()
+        if not backend.add(key, idempotency_key or 1,
+                           flag_settings.QUEUE_DUPLICATE_TIMEOUT):
+            if idempotency_key and backend.get(key) == idempotency_key:
+                return
+            raise ContentAlreadyFlaggedByUserException(
+                    _('You already flagged this'))
+    get_queue().put(user, content_object, content_creator, comment,
+                    idempotency_key)
+
+
+def _process_batch(queue, size, isolated=False):
+    """
+    Read the next `size` flags of the queue, add them and remove them from
+    the queue, in a transaction. If `isolated` is True, an error when adding
+    them is logged, and they are removed anyway (used to add the flags of a
+    failed batch one by one, so a flag always failing doesn't block the
+    queue).
+    Return the batch, the flags to add and their results
+    """
+    using = router.db_for_write(QueuedFlag)
+    with in_transaction(using):
+        batch = queue.get_batch(size)
+        flags = [flag for key, flag in batch
+                 if flag['user'] is not None
+                 and flag['content_object'] is not None]
+        if isolated:
+            sid = transaction.savepoint(using=using)
+        try:
+            results = FlagInstance.objects.add_grouped(flags,
+                    send_signal=True, send_mails=True, notify=False)
+        except Exception:
+            if not isolated:
+                raise
+            transaction.savepoint_rollback(sid, using=using)
+            logger.exception('Queued flags removed without being added: %r',
+                             [key for key, flag in batch])
+            results = [None] * len(flags)
+        else:
+            if isolated:
+                transaction.savepoint_commit(sid, using=using)
+        queue.ack([key for key, flag in batch])
+    return batch, flags, results
+
+
+def process(batch_size=None):
+    """
+    Add the queued flags, by batches of `batch_size` (default to the
+    QUEUE_BATCH_SIZE setting), with `FlagInstance.objects.add_grouped`. Each
+    batch is read, added and removed from the queue in a transaction, and
+    the signals, mails and webhooks are sent after the commit. If a batch
+    fails, its flags are added one by one, and the ones failing again are
+    logged and removed from the queue.
+    Flags which cannot be added (limits, deleted objects...) are only logged.
+    Return the number of processed flags
+    """
+    batch_size = batch_size or flag_settings.QUEUE_BATCH_SIZE
+    queue = get_queue()
+    total = 0
+    while True:
+        try:
+            batch, flags, results = _process_batch(queue, batch_size)
+        except Exception:
+            logger.exception('Batch of queued flags failed, added one by one')
+            batch, flags, results = [], [], []
+            for index in range(batch_size):
+                one_batch, one_flags, one_results = _process_batch(queue, 1,
+                        isolated=True)
+                batch.extend(one_batch)
+                flags.extend(one_flags)
+                results.extend(one_results)
+                if not one_batch:
+                    break
+        # only once the batch is committed (it's retried on errors)
+        FlagInstance.objects.notify_added(results, send_signal=True,
+                                          send_mails=True)
+
+        failed = len(batch) - len(flags) + \
+                 len([result for result in results
+                      if not isinstance(result, FlagInstance)])
+        if failed:
+            logger.info('%d queued flags not added', failed)
+        total += len(batch)
+        if len(batch) < batch_size:
+            return total
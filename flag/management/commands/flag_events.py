@@ -0,0 +1,49 @@
+import json
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from flag.models import FlagEvent
+
+
+class Command(NoArgsCommand):
+    help = ('Write the flag events (the FlagEvent table) after the given id '
+            'on the standard output, one json object by line')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--after', action='store', type='int', dest='after',
+                    default=0,
+                    help='Only write the events after this id'),
+        make_option('--limit', action='store', type='int', dest='limit',
+                    default=None,
+                    help='The maximum number of events to write'),
+        make_option('--follow', action='store_true', dest='follow',
+                    default=False,
+                    help='Wait for new events instead of stopping'),
+        make_option('--interval', action='store', type='float',
+                    dest='interval', default=1,
+                    help='The number of seconds to wait for new events '
+                         'with --follow'),
+        make_option('--batch-size', action='store', type='int',
+                    dest='batch_size', default=1000,
+                    help='The number of events read in each query'),
+    )
+
+    def handle_noargs(self, **options):
+        after_id, limit = options['after'], options['limit']
+        batch_size = options['batch_size']
+        while limit is None or limit > 0:
+            size = batch_size if limit is None else min(batch_size, limit)
+            events = FlagEvent.objects.read_events(after_id, size)
+            for event in events:
+                self.stdout.write(json.dumps(event.as_dict(),
+                                             separators=(',', ':')) + '\n')
+            self.stdout.flush()
+            if events:
+                after_id = events[-1].id
+            if limit is not None:
+                limit -= len(events)
+            if len(events) < size:
+                if not options['follow']:
+                    break
+                time.sleep(options['interval'])
@@ -0,0 +1,13 @@
+from django.core.management.base import NoArgsCommand
+
+from flag.models import FlagCountShard
+
+
+class Command(NoArgsCommand):
+    help = 'Add the flags counted in the shards of the sharded flagged ' \
+           'contents to their count'
+
+    def handle_noargs(self, **options):
+        count = FlagCountShard.objects.fold()
+        if int(options.get('verbosity', 1)):
+            self.stdout.write('%d flags added to the counts\n' % count)
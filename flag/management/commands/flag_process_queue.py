@@ -0,0 +1,34 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from flag import ingestion
+
+
+class Command(NoArgsCommand):
+    help = 'Add the flags put in the queue by the views in the queued mode'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', action='store', type='int',
+                    dest='batch_size', default=None,
+                    help='The number of flags added in each transaction '
+                         '(default to the FLAG_QUEUE_BATCH_SIZE setting)'),
+        make_option('--loop', action='store_true', dest='loop',
+                    default=False,
+                    help='Wait for new flags instead of stopping'),
+        make_option('--interval', action='store', type='float',
+                    dest='interval', default=1,
+                    help='The number of seconds to wait for new flags with '
+                         '--loop'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        while True:
+            count = ingestion.process(options['batch_size'])
+            if verbosity and (count or not options['loop']):
+                self.stdout.write('%d queued flags processed\n' % count)
+            if not options['loop']:
+                break
+            if not count:
+                time.sleep(options['interval'])
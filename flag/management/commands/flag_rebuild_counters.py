@@ -0,0 +1,15 @@
+from django.core.management.base import NoArgsCommand
+
+from flag.models import FlagCounter
+
+
+class Command(NoArgsCommand):
+    help = ('Count the flagged contents by content type and status, to fill '
+            'the FlagCounter table')
+
+    def handle_noargs(self, **options):
+        FlagCounter.objects.rebuild()
+        verbosity = int(options.get('verbosity', 1))
+        if verbosity:
+            self.stdout.write('%d counters rebuilt\n' %
+                              FlagCounter.objects.count())
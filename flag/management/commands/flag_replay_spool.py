@@ -0,0 +1,28 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from flag import settings as flag_settings
+
+
+class Command(NoArgsCommand):
+    help = 'Add the flags written in the spool file while the database ' \
+           'was not available'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', action='store', type='int',
+                    dest='batch_size', default=None,
+                    help='The number of flags added in each transaction '
+                         '(default to the FLAG_SPOOL_BATCH_SIZE setting)'),
+        make_option('--wait', action='store', type='float',
+                    dest='wait', default=1,
+                    help='The number of seconds to wait after moving the '
+                         'spool file, for the processes still writing in it'),
+    )
+
+    def handle_noargs(self, **options):
+        if not flag_settings.SPOOL_PATH:
+            raise CommandError('The FLAG_SPOOL_PATH setting is not defined')
+        from flag import spool
+        count = spool.replay(options['batch_size'], options['wait'])
+        if int(options.get('verbosity', 1)):
+            self.stdout.write('%d spooled flags replayed\n' % count)
@@ -0,0 +1,22 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from flag.models import FlagRollup
+
+
+class Command(NoArgsCommand):
+    help = ('Add the flags added since the last run to the daily rollups '
+            '(the FlagRollup table)')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', action='store', type='int',
+                    dest='batch_size', default=None,
+                    help='The number of flags processed in each transaction '
+                         '(default to the FLAG_ROLLUP_BATCH_SIZE setting)'),
+    )
+
+    def handle_noargs(self, **options):
+        count = FlagRollup.objects.process(options.get('batch_size'))
+        verbosity = int(options.get('verbosity', 1))
+        if verbosity:
+            self.stdout.write('%d flags processed\n' % count)
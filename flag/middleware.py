@@ -0,0 +1,65 @@
+import logging
+
+from django.conf import settings
+
+from flag import deferred, profiling
+
+logger = logging.getLogger('flag.profiling')
+
+
+class FlagQueryProfilerMiddleware(object):
+    """
+    Record the SQL queries issued by django-flag during a request, grouped by
+    call site, and add a summary in the `X-Flag-Queries` header of the
+    response and in the `flag.profiling` logger.
+    It's active if DEBUG is True, or if the request has a `X-Flag-Profile`
+    header and the user is staff (so the middleware must be set after the
+    `AuthenticationMiddleware` one)
+    """
+    header = 'HTTP_X_FLAG_PROFILE'
+    response_header = 'X-Flag-Queries'
+
+    def is_enabled(self, request):
+        """
+        Return True if the queries must be profiled for this request
+        """
+        if settings.DEBUG:
+            return True
+        if self.header not in request.META:
+            return False
+        user = getattr(request, 'user', None)
+        return bool(user and user.is_authenticated() and user.is_staff)
+
+    def process_request(self, request):
+        if self.is_enabled(request):
+            profiling.start()
+
+    def process_response(self, request, response):
+        if not profiling.is_active():
+            return response
+        summary = profiling.stop()
+        if summary:
+            text = profiling.format_summary(summary)
+            response[self.response_header] = text
+            logger.debug('%s %s: %s', request.method, request.path, text)
+        return response
+
+
+class FlagDeferredSignalsMiddleware(object):
+    """
+    Keep the deferred receivers of signals (see `flag.signals.DeferredSignal`)
+    sent during a request, to run them only after the response, or to forget
+    them if the view raised an exception.
+    Set it before the `TransactionMiddleware` one, so they are run after the
+    commit of the transaction
+    """
+
+    def process_request(self, request):
+        deferred.hold()
+
+    def process_exception(self, request, exception):
+        deferred.discard()
+
+    def process_response(self, request, response):
+        deferred.release()
+        return response
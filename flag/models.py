@@ -1,5 +1,14 @@
-from django.db import models
+import json
+import operator
+import random
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.db import models, router, transaction, IntegrityError
+from django.db.models.query import QuerySet
 from django.core import urlresolvers
+from django.core.exceptions import ValidationError
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
@@ -7,21 +16,116 @@ from django.utils.translation import ugettext_lazy as _, ungettext
 from django.core.mail import send_mail
 from django.template.loader import render_to_string
 from django.contrib.sites.models import Site
+from django.utils import timezone
 from django.utils.encoding import force_unicode
-from django.utils import importlib
 
 from flag import settings as flag_settings
-from flag import signals
+from flag import policies, registry, signals, trust, webhooks
+from flag import cache as flag_cache
 from flag.exceptions import *
-from flag.utils import get_content_type_tuple
+from flag.profiling import profiled
+from flag.utils import (get_content_type_tuple, encode_keyset, decode_keyset,
+                        in_transaction)
 
-try:
-    line = flag_settings.TRUST_EVAL_FUNC
-    path = '.'.join(line.rsplit('.')[:-1])
-    func = line.rsplit('.')[-1]
-    can_user_be_trusted = getattr(importlib.import_module(path), func)
-except (ImportError, IndexError), e:
-    from flag.utils import can_user_be_trusted
+_RATE_KEY = 'flag:rate:%s:%s'
+_FOLD_KEY = 'flag:fold:%s'
+
+
+class FlaggedContentQuerySet(QuerySet):
+    """
+    QuerySet for the FlaggedContent model, which can load the content objects
+    (and the creators and moderators) of all its rows at once
+    """
+    _content_objects_hints = None
+
+    def with_content_objects(self, select_related=None):
+        """
+        Return a queryset which loads, when evaluated, the content objects of
+        its rows with one query by content type, and their creators and
+        moderators with one query.
+        `select_related` is an optional dict with models ("app_label.model")
+        as keys and, as values, a list of fields to pass to `select_related`
+        when loading the objects of this model (or True for a simple
+        `select_related()`)
+        """
+        clone = self._clone()
+        clone._content_objects_hints = select_related or {}
+        return clone
+
+    def _clone(self, *args, **kwargs):
+        clone = super(FlaggedContentQuerySet, self)._clone(*args, **kwargs)
+        clone._content_objects_hints = self._content_objects_hints
+        return clone
+
+    def iterator(self):
+        if self._content_objects_hints is None:
+            for flagged_content in super(FlaggedContentQuerySet,
+                                         self).iterator():
+                yield flagged_content
+            return
+        # we need all the rows to load the objects
+        flagged_contents = list(super(FlaggedContentQuerySet, self).iterator())
+        prefetch_content_objects(flagged_contents,
+                                 self._content_objects_hints)
+        for flagged_content in flagged_contents:
+            yield flagged_content
+
+
+@profiled('prefetch_content_objects')
+def prefetch_content_objects(flagged_contents, select_related=None):
+    """
+    Load the content objects of the given flagged contents, with one query by
+    content type, and their creators and moderators, with one query, and
+    attach them to the flagged contents, so accessing `content_object`,
+    `creator` and `moderator` doesn't cost a query anymore.
+    See `FlaggedContentQuerySet.with_content_objects` for `select_related`
+    """
+    select_related = select_related or {}
+
+    # content objects, by content type
+    object_ids = {}
+    for flagged_content in flagged_contents:
+        object_ids.setdefault(flagged_content.content_type_id,
+                              set()).add(flagged_content.object_id)
+    objects = {}
+    for content_type_id, ids in object_ids.items():
+        model = registry.get_model_for_id(content_type_id)
+        if model is None:
+            model = ContentType.objects.get_for_id(
+                    content_type_id).model_class()
+        if model is None:
+            # the model doesn't exist anymore
+            continue
+        queryset = model._default_manager.all()
+        hints = select_related.get('%s.%s' % (model._meta.app_label,
+                                              model._meta.module_name))
+        if hints is True:
+            queryset = queryset.select_related()
+        elif hints:
+            queryset = queryset.select_related(*hints)
+        objects[content_type_id] = queryset.in_bulk(list(ids))
+
+    # creators and moderators
+    user_ids = set()
+    for flagged_content in flagged_contents:
+        user_ids.update((flagged_content.creator_id,
+                         flagged_content.moderator_id))
+    user_ids.discard(None)
+    users = User.objects.in_bulk(list(user_ids)) if user_ids else {}
+
+    content_object_cache = FlaggedContent.content_object.cache_attr
+    creator_cache = FlaggedContent._meta.get_field('creator').get_cache_name()
+    moderator_cache = FlaggedContent._meta.get_field(
+            'moderator').get_cache_name()
+    for flagged_content in flagged_contents:
+        setattr(flagged_content, content_object_cache, objects.get(
+            flagged_content.content_type_id, {}).get(
+                flagged_content.object_id))
+        setattr(flagged_content, creator_cache,
+                users.get(flagged_content.creator_id))
+        setattr(flagged_content, moderator_cache,
+                users.get(flagged_content.moderator_id))
+    return flagged_contents
 
 
 class FlaggedContentManager(models.Manager):
@@ -29,6 +133,25 @@ class FlaggedContentManager(models.Manager):
     Manager for the FlaggedContent models
     """
 
+    def get_query_set(self):
+        return FlaggedContentQuerySet(self.model, using=self._db)
+
+    def with_content_objects(self, select_related=None):
+        """
+        Return a queryset loading the content objects of all its rows at once
+        (see `FlaggedContentQuerySet.with_content_objects`)
+        """
+        return self.get_query_set().with_content_objects(select_related)
+
+    def with_shards(self):
+        """
+        Return a queryset with, on each flagged content, the total of its
+        shards in `shards_count` (None if not sharded), read with the same
+        query as `count` (see `FlaggedContent.get_count`)
+        """
+        return self.annotate(shards_count=models.Sum('count_shards__count'))
+
+    @profiled('get_for_object')
     def get_for_object(self, content_object):
         """
         Helper to get a FlaggedContent instance for the given object
@@ -37,6 +160,7 @@ class FlaggedContentManager(models.Manager):
         return self.get(content_type__id=content_type.id,
                         object_id=content_object.id)
 
+    @profiled('filter_for_model')
     def filter_for_model(self, model, only_object_ids=False):
         """
         Return a queryset to filter FlaggedContent on a given model
@@ -48,12 +172,27 @@ class FlaggedContentManager(models.Manager):
                 User, True).filter(status=2))
         """
         app_label, model = get_content_type_tuple(model)
-        queryset = self.filter(content_type__app_label=app_label,
-                content_type__model=model)
+        content_type_id = registry.get_id_for_tuple(app_label, model)
+        if content_type_id is not None:
+            queryset = self.filter(content_type=content_type_id)
+        else:
+            # not an installed model
+            queryset = self.filter(content_type__app_label=app_label,
+                    content_type__model=model)
         if only_object_ids:
             queryset = queryset.values_list('object_id', flat=True)
         return queryset
 
+    def count_by_status(self, model=None):
+        """
+        Return a dict with the number of flagged contents by status, for the
+        given model (a model, an instance or a "app_label.model" string), or
+        for all models. The numbers are read from the FlagCounter table, not
+        counted
+        """
+        return FlagCounter.objects.get_counts(model)
+
+    @profiled('get_or_create_for_object')
     def get_or_create_for_object(self,
                                  content_object,
                                  content_creator=None,
@@ -73,6 +212,7 @@ class FlaggedContentManager(models.Manager):
             defaults=defaults)
         return flagged_content, created
 
+    @profiled('model_can_be_flagged')
     def model_can_be_flagged(self, content_type):
         """
         Return True if the model is listed in the MODELS settings (or if this
@@ -93,6 +233,102 @@ class FlaggedContentManager(models.Manager):
         model = '%s.%s' % (app_label, model)
         return model in flag_settings.MODELS
 
+    def get_limits(self, content_type):
+        """
+        Return a tuple with, for the given ContentType, if the model can be
+        flagged, and the LIMIT_FOR_OBJECT and LIMIT_SAME_OBJECT_FOR_USER
+        settings
+        """
+        model = content_type.model_class()
+        return (self.model_can_be_flagged(model),
+                flag_settings.get_for_model(model, 'LIMIT_FOR_OBJECT'),
+                flag_settings.get_for_model(model,
+                                            'LIMIT_SAME_OBJECT_FOR_USER'))
+
+    def count_user_flags(self, user, flagged_contents):
+        """
+        Return a dict with the number of flags of the user for each of the
+        given flagged contents (only ones with flags), in one grouped query
+        """
+        if not flagged_contents:
+            return {}
+        return dict((row['flagged_content'], row['count'])
+            for row in FlagInstance.objects.filter(user=user, status=1,
+                flagged_content__in=[flagged_content.id
+                    for flagged_content in flagged_contents])\
+                .values('flagged_content')\
+                .annotate(count=models.Count('id')).order_by())
+
+    def _can_be_flagged_by_user(self, flagged_content, user_count, limits):
+        """
+        Return True if the flagged content can be flagged by a user with
+        `user_count` flags on it, regarding the `limits` returned by
+        `get_limits`. `flagged_content` can be None if not flagged.
+        """
+        allowed, limit, limit_for_user = limits
+        if not allowed:
+            return False
+        if flagged_content is None:
+            return True
+        return (not limit or flagged_content.count < limit) and \
+               (not limit_for_user or user_count < limit_for_user)
+
+    def _flaggable_by(self, user, objects):
+        """
+        Return a list with, for each object, True if it can be flagged by
+        the given user. See `flaggable_by`
+        """
+        if not (user and user.is_active and user.is_authenticated()):
+            return [False for obj in objects]
+
+        # group objects by content type
+        content_types = {}
+        for obj in objects:
+            content_type = ContentType.objects.get_for_model(obj)
+            content_types.setdefault(content_type, set()).add(obj.pk)
+        if not content_types:
+            return []
+
+        # one query for the flagged contents
+        query = reduce(operator.or_, [
+            models.Q(content_type=content_type, object_id__in=object_ids)
+            for content_type, object_ids in content_types.items()])
+        flagged_contents = dict(
+            ((flagged_content.content_type_id, flagged_content.object_id),
+             flagged_content) for flagged_content in self.filter(query))
+
+        # limits for each model
+        limits = dict((content_type.id, self.get_limits(content_type))
+                      for content_type in content_types)
+
+        # one grouped count for the flags of the user, only if needed
+        counts = self.count_user_flags(user, [flagged_content
+            for flagged_content in flagged_contents.values()
+            if limits[flagged_content.content_type_id][2]])
+
+        result = []
+        for obj in objects:
+            content_type_id = ContentType.objects.get_for_model(obj).id
+            flagged_content = flagged_contents.get(
+                    (content_type_id, obj.pk))
+            result.append(self._can_be_flagged_by_user(flagged_content,
+                counts.get(getattr(flagged_content, 'id', None), 0),
+                limits[content_type_id]))
+        return result
+
+    @profiled('flaggable_by')
+    def flaggable_by(self, user, objects):
+        """
+        Return a dict with, for each object pk, True if the object can be
+        flagged by the given user, like the `can_be_flagged_by_user` method
+        of FlaggedContent, but in only two queries for all objects.
+        As the keys are the pks, objects should be of the same model.
+        """
+        objects = list(objects)
+        return dict((obj.pk, flaggable)
+            for obj, flaggable in zip(objects,
+                                      self._flaggable_by(user, objects)))
+
     def assert_model_can_be_flagged(self, content_type):
         """
         Raise an acception if the "model_can_be_flagged" method return False
@@ -120,15 +356,27 @@ class FlaggedContent(models.Model):
                                   null=True,
                                   related_name="moderated_content")
     count = models.PositiveIntegerField(default=0)
+    # if True, new flags are counted in FlagCountShard rows (see `get_count`)
+    sharded = models.BooleanField(default=False)
     when_updated = models.DateTimeField(auto_now=True, auto_now_add=True)
 
     # manager
     objects = FlaggedContentManager()
 
+    # flags of a sharded flagged content being added by `add_grouped`, not
+    # yet counted in the database
+    _pending_count = 0
+
     class Meta:
         unique_together = [("content_type", "object_id")]
         ordering = ('-id',)
 
+    def __init__(self, *args, **kwargs):
+        super(FlaggedContent, self).__init__(*args, **kwargs)
+        # keep the status and moderator to know, on save, if they were updated
+        self._original_status = self.status
+        self._original_moderator_id = self.moderator_id
+
     def __unicode__(self):
         """
         Show the flagged object in the unicode string
@@ -136,12 +384,14 @@ class FlaggedContent(models.Model):
         app_label, model = get_content_type_tuple(self.content_type_id)
         return u'%s.%s #%s' % (app_label, model, self.object_id)
 
+    @profiled('content_settings')
     def content_settings(self, name):
         """
         Return the settings `name` for the current content object
         """
         return flag_settings.get_for_model(self.content_object, name)
 
+    @profiled('count_flags_by_user')
     def count_flags_by_user(self, user):
         """
         Helper to get the number of flags on this flagged content by the
@@ -149,6 +399,65 @@ class FlaggedContent(models.Model):
         """
         return self.flag_instances.filter(user=user, status=1).count()
 
+    def get_count(self):
+        """
+        Return the number of flags: `count`, plus, for a sharded flagged
+        content, the flags counted in its shards and not yet added to `count`
+        (see `fold_shards`), both read with one query (a fold between two
+        queries would count its flags twice, or miss them), and the flags
+        being added by `add_grouped`
+        """
+        if not self.sharded:
+            return self.count
+        count, shards_count, sharded = self._read_counts()
+        return count + shards_count + self._pending_count
+
+    def _read_counts(self):
+        """
+        Return the `count` field, the total of the shards and the `sharded`
+        field, read from the database with one query
+        """
+        count, shards_count, sharded = FlaggedContent.objects.with_shards()\
+                .filter(id=self.id)\
+                .values_list('count', 'shards_count', 'sharded')[0]
+        return count, shards_count or 0, sharded
+
+    def fold_shards(self):
+        """
+        Move the counts of the shards to `count`. Return the number of moved
+        flags
+        """
+        using = router.db_for_write(FlaggedContent, instance=self)
+        total = 0
+        with in_transaction(using):
+            shards = FlagCountShard.objects.select_for_update()\
+                                           .filter(flagged_content=self)\
+                                           .exclude(count=0)
+            for shard_id, count in shards.values_list('id', 'count'):
+                FlagCountShard.objects.filter(id=shard_id).update(
+                        count=models.F('count') - count)
+                total += count
+            if total:
+                FlaggedContent.objects.filter(id=self.id).update(
+                        count=models.F('count') + total)
+        return total
+
+    def _check_rate(self, added):
+        """
+        Count the flags added in the current second, and shard the flagged
+        content if there are more than SHARDED_COUNTS_RATE
+        """
+        backend = flag_cache.get_backend()
+        key = _RATE_KEY % (self.id, int(time.time()))
+        backend.add(key, 0, 10)
+        try:
+            rate = backend.incr(key, added)
+        except ValueError:
+            return
+        if rate >= flag_settings.SHARDED_COUNTS_RATE:
+            FlaggedContent.objects.filter(id=self.id).update(sharded=True)
+            self.sharded = True
+
     def can_be_flagged(self):
         """
         Check that the LIMIT_FOR_OBJECT is not raised
@@ -156,7 +465,7 @@ class FlaggedContent(models.Model):
         limit = self.content_settings('LIMIT_FOR_OBJECT')
         if not limit:
             return True
-        return self.count < limit
+        return self.get_count() < limit
 
     def assert_can_be_flagged(self):
         """
@@ -178,9 +487,11 @@ class FlaggedContent(models.Model):
             return True
         return self.count_flags_by_user(user) < limit
 
-    def assert_can_be_flagged_by_user(self, user):
+    def assert_can_be_flagged_by_user(self, user, count=None):
         """
         Raise an exception if the given user cannot flag this object
+        `count` is the number of flags of the user on this object, if already
+        known (see `count_flags_by_user`)
         """
 
         try:
@@ -192,7 +503,8 @@ class FlaggedContent(models.Model):
             limit = self.content_settings('LIMIT_SAME_OBJECT_FOR_USER')
             if not limit:
                 return
-            count = self.count_flags_by_user(user)
+            if count is None:
+                count = self.count_flags_by_user(user)
             if count >= limit:
                 error = ungettext(
                             'You already flagged this',
@@ -259,56 +571,169 @@ class FlaggedContent(models.Model):
 
         # check if we can flag this model
         FlaggedContent.objects.assert_model_can_be_flagged(self.content_object)
-        super(FlaggedContent, self).save(*args, **kwargs)
+        is_new = not self.pk
+        using = kwargs.get('using') or router.db_for_write(FlaggedContent,
+                                                           instance=self)
+        with in_transaction(using):
+            # the count of a sharded flagged content is only updated with
+            # relative updates (see `fold_shards`)
+            count = self.count
+            if self.sharded and not is_new:
+                self.count = models.F('count')
+            try:
+                super(FlaggedContent, self).save(*args, **kwargs)
+            finally:
+                self.count = count
+
+            # the counters are updated in the same transaction
+            if is_new:
+                FlagCounter.objects.add(self.content_type_id, self.status, 1)
+            elif self.status != self._original_status:
+                FlagCounter.objects.add(self.content_type_id,
+                                        self._original_status, -1)
+                FlagCounter.objects.add(self.content_type_id, self.status, 1)
+
+            # and the events too
+            if flag_settings.EVENTS and not is_new:
+                if self.status != self._original_status:
+                    FlagEvent.objects.log(FlagEvent.STATUS, self,
+                                          status=self.status,
+                                          previous=self._original_status,
+                                          moderator=self.moderator_id)
+                elif self.moderator_id != self._original_moderator_id:
+                    FlagEvent.objects.log(FlagEvent.MODERATOR, self,
+                            moderator=self.moderator_id,
+                            previous=self._original_moderator_id)
+        self._original_moderator_id = self.moderator_id
+
+        # cached values for this object are outdated
+        if is_new or self.status != self._original_status:
+            previous_status = self._original_status
+            self._original_status = self.status
+            self.invalidate_cache()
+            if not is_new:
+                webhooks.notify_status(self, previous_status)
+
+    def invalidate_cache(self):
+        """
+        Invalidate all the cached values and templates for the flagged object
+        (see `flag.cache`)
+        """
+        flag_cache.bump_version(self.content_type_id, self.object_id)
 
+    @profiled('flag_added')
     def flag_added(self, flag_instance, send_signal=False, send_mails=False):
         """
         Called when a flag is added, to update the count and send a signal
         """
+        self.flags_added([flag_instance], send_signal, send_mails)
+
+    def flags_added(self, flag_instances, send_signal=False,
+                    send_mails=False, notify=True):
+        """
+        Called when flags are added, to update the count (once for all the
+        flags) and, if `notify` is True, send a signal (and mails) for each
+        flag (see `notify_flags_added`)
+        """
+        if not flag_instances:
+            return
+
         # get the the count value from the db, not from the stored Instance
         # increment the count if status == 1
-        if self.status == flag_settings.DEFAULT_STATUS:
-            self.count = models.F('count') + 1
-            self.save()
+        counted = self.status == flag_settings.DEFAULT_STATUS
+        in_shards = counted and self.sharded
+        using = router.db_for_write(FlaggedContent, instance=self)
+        with in_transaction(using):
+            if in_shards:
+                # the row of the flagged content is not locked
+                FlagCountShard.objects.add(self, len(flag_instances))
+            elif counted:
+                # a relative update: this instance may be outdated
+                self.when_updated = timezone.now()
+                FlaggedContent.objects.filter(id=self.id).update(
+                        count=models.F('count') + len(flag_instances),
+                        when_updated=self.when_updated)
+                if flag_settings.SHARDED_COUNTS:
+                    self._check_rate(len(flag_instances))
+            # the count reached with the new flags, read while the row is
+            # locked by the update, so concurrent flags each get their own
+            # (for a sharded flagged content, the row is not locked)
+            self._pending_count = 0
+            self.count, shards_count, self.sharded = self._read_counts()
+            count = self.count + shards_count
+        previous_count = count - len(flag_instances) if counted else count
+
+        if in_shards and flag_cache.get_backend().add(_FOLD_KEY % self.id, 1,
+                flag_settings.SHARDED_COUNTS_FOLD_INTERVAL):
+            self.fold_shards()
+        self.invalidate_cache()
+
+        # update the rollups now if wanted (else see the `flag_rollup` command)
+        if flag_settings.ROLLUP_INLINE:
+            FlagRollup.objects.add_flags([(flag_instance.when_added,
+                                           self.content_type_id,
+                                           flag_instance.status)
+                                          for flag_instance in flag_instances])
+
+        # the count reached by each flag
+        for index, flag_instance in enumerate(flag_instances):
+            flag_instance.counted = counted
+            flag_instance.reached_count = previous_count + index + 1 \
+                                          if counted else count
+
+        if notify:
+            self.notify_flags_added(flag_instances, send_signal, send_mails)
+
+    def notify_flags_added(self, flag_instances, send_signal=False,
+                           send_mails=False):
+        """
+        Send a signal (and mails) for each new flag, and tell the webhooks if
+        a threshold is crossed. Called by `flags_added`, or later (after the
+        commit) if it was called with `notify=False`
+        """
+        if not flag_instances:
+            return
 
         # send a signal if wanted
         if send_signal:
-            signals.content_flagged.send(
-                sender=FlaggedContent,
-                flagged_content=self,
-                flagged_instance=flag_instance)
-
-        # update count of the current object
-        new_self = FlaggedContent.objects.get(id=self.id)
-        self.count = new_self.count
-
-        # send emails if wanted
+            for flag_instance in flag_instances:
+                signals.content_flagged.send(
+                    sender=FlaggedContent,
+                    flagged_content=self,
+                    flagged_instance=flag_instance)
+
+        # tell the webhooks if a threshold is crossed
+        if flag_instances[0].counted:
+            webhooks.notify_count(self, flag_instances[0].reached_count - 1,
+                                  flag_instances[-1].reached_count)
+
+        # send emails if wanted, checking the count reached by each flag
         if send_mails and self.content_settings('SEND_MAILS'):
-            # always send mail if the max flag is reached
-            limit = self.content_settings('LIMIT_FOR_OBJECT')
-            really_send_mails = limit \
-                and self.count >= limit
-
-            # limit not reached, check rules
-            if not really_send_mails:
-                # check rule
-                current_min_count, current_step = 0, 0
-                for min_count, step in self.content_settings(
-                        'SEND_MAILS_RULES'):
-                    if self.count >= min_count:
-                        current_min_count, current_step = min_count, step
-                    else:
-                        break
+            for flag_instance in flag_instances:
+                if self._must_send_mails(flag_instance.reached_count):
+                    flag_instance.send_mails()
+
+    def _must_send_mails(self, count):
+        """
+        Return True if mails must be sent for a flag making the count of
+        flags reach `count`
+        """
+        # always send mail if the max flag is reached
+        limit = self.content_settings('LIMIT_FOR_OBJECT')
+        if limit and count >= limit:
+            return True
 
-                # do we need to send mail ?
-                if current_step and \
-                        not (self.count - current_min_count) % current_step:
-                    really_send_mails = True
+        # limit not reached, check rules
+        current_min_count, current_step = 0, 0
+        for min_count, step in self.content_settings('SEND_MAILS_RULES'):
+            if count >= min_count:
+                current_min_count, current_step = min_count, step
+            else:
+                break
 
-            # finally send mails if we really want to do it
-            # if the flag is to be deleted, we send the mail anyway
-            if really_send_mails:
-                flag_instance.send_mails()
+        # do we need to send mail ?
+        return bool(current_step and
+                    not (count - current_min_count) % current_step)
 
     def get_status_display(self):
         """
@@ -323,17 +748,73 @@ class FlaggedContent(models.Model):
 
 class FlagInstanceManager(models.Manager):
     """
-    Manager for the FlagInstance model, adding a `add` method
+    Manager for the FlagInstance model, adding a `add` method, and helpers
+    for the admin (`get_page` and `get_summary`)
     """
 
+    @profiled('add')
     def add(self, user, content_object, content_creator=None, comment=None,
-            status=None, send_signal=False, send_mails=False):
+            status=None, send_signal=False, send_mails=False, trusted=None,
+            spool=True, idempotency_key=None):
         """
         Helper to easily create a flag of an object
         `content_creator` can only be set if it's the first flag
         if `status` is updated, no signal/mails will be sent (update by staff)
+        `trusted` can be passed if the trust of the user is already known
+        If an `idempotency_key` is passed and the user already added a flag
+        with the same key, this flag is returned, and nothing is done (an
+        IdempotencyKeyReusedException is raised if it's a flag of another
+        object)
+        If the SPOOL_PATH setting is defined (and `spool` is True), the flag
+        is written in the spool file if the database is not available, and
+        None is returned (see `flag.spool`)
         TODO : move things in the `save` method of the `FlagInstance` model
         """
+        args = (user, content_object, content_creator, comment, status,
+                send_signal, send_mails, trusted, idempotency_key)
+        if spool and flag_settings.SPOOL_PATH:
+            from flag import spool as flag_spool
+            return flag_spool.add_or_spool(self._add, *args)
+        return self._add(*args)
+
+    def get_for_idempotency_key(self, user, idempotency_key, content_object):
+        """
+        Return the flag added by the user with the given idempotency key, or
+        None. Raise an IdempotencyKeyReusedException if this flag is not one
+        of `content_object`
+        """
+        try:
+            flag_instance = self.select_related('flagged_content').get(
+                    user=user, idempotency_key=idempotency_key)
+        except FlagInstance.DoesNotExist:
+            return None
+        self._check_idempotency_key(flag_instance, content_object)
+        return flag_instance
+
+    def _check_idempotency_key(self, flag_instance, content_object):
+        """
+        Raise an IdempotencyKeyReusedException if the given flag, found by
+        its idempotency key, is not one of `content_object`
+        """
+        flagged_content = flag_instance.flagged_content
+        if flagged_content.object_id != content_object.pk or \
+                flagged_content.content_type_id != ContentType.objects.\
+                        get_for_model(content_object).id:
+            raise IdempotencyKeyReusedException(
+                    _('This idempotency key was used for another object'))
+
+    def _add(self, user, content_object, content_creator, comment, status,
+             send_signal, send_mails, trusted, idempotency_key, notify=True):
+        """
+        Create the flag (see `add`). If `notify` is False, the signal, mails
+        and webhooks are not sent: call `notify_added` with the flag (after
+        the commit)
+        """
+        if idempotency_key:
+            flag_instance = self.get_for_idempotency_key(user,
+                    idempotency_key, content_object)
+            if flag_instance is not None:
+                return flag_instance
 
         # get or create the FlaggedContent object
         flagged_content, created = FlaggedContent.objects.\
@@ -343,28 +824,268 @@ class FlagInstanceManager(models.Manager):
 
         # save new status, moderator and updated date
         if status:
-            flagged_content.status = status
-            # if the status is not the default one, we save the moderator
-            if status != flag_settings.DEFAULT_STATUS:
-                flagged_content.moderator = user
-        # always update the `when_updated` field
-        flagged_content.save()
+            using = router.db_for_write(FlaggedContent,
+                                        instance=flagged_content)
+            with in_transaction(using):
+                # the loaded row may be outdated (sharded, or with flags
+                # folded in its count since): read it again, locked, to not
+                # overwrite it
+                flagged_content.count, flagged_content.sharded = \
+                        FlaggedContent.objects.select_for_update()\
+                                      .filter(id=flagged_content.id)\
+                                      .values_list('count', 'sharded')[0]
+                flagged_content.status = status
+                # if the status is not the default one, we save the moderator
+                if status != flag_settings.DEFAULT_STATUS:
+                    flagged_content.moderator = user
+                flagged_content.save()
+        elif not flagged_content.sharded:
+            # always update the `when_updated` field (but not for a sharded
+            # flagged content, to not lock its row), without saving the
+            # whole row
+            flagged_content.when_updated = timezone.now()
+            FlaggedContent.objects.filter(id=flagged_content.id).update(
+                    when_updated=flagged_content.when_updated)
 
         # add the flag
         params = dict(
             flagged_content=flagged_content,
             user=user,
-            comment=comment)
+            comment=comment,
+            idempotency_key=idempotency_key or None)
         if status:
             params['status'] = status
         else:
             params['status'] = flagged_content.status
 
         flag_instance = FlagInstance(**params)
-        flag_instance.save(send_signal=send_signal,
-                               send_mails=send_mails)
+        # in a savepoint, to read the flag of a concurrent request with the
+        # same key (as `get_or_create` does)
+        using = router.db_for_write(FlagInstance, instance=flag_instance)
+        sid = transaction.savepoint(using=using)
+        try:
+            flag_instance.save(trusted=trusted, notify=False)
+            transaction.savepoint_commit(sid, using=using)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid, using=using)
+            # the same key was used by a concurrent request
+            if not idempotency_key:
+                raise
+            flag_instance = self.get_for_idempotency_key(user,
+                    idempotency_key, content_object)
+            if flag_instance is None:
+                raise
+            return flag_instance
+        if flag_instance.pk:
+            flagged_content.flags_added([flag_instance], send_signal,
+                                        send_mails, notify)
         return flag_instance
 
+    @profiled('get_page')
+    def get_page(self, flagged_content, after=None, size=50):
+        """
+        Return a page of the flags of the given flagged content, the most
+        recent first, using a keyset pagination on `(when_added, id)`: the
+        cost of a page doesn't depend on its position.
+        `after` is the cursor returned with the previous page (None for the
+        first page).
+        Return a tuple with the list of flags (with their users) and the
+        cursor of the next page (None if it's the last one)
+        """
+        queryset = self.filter(flagged_content=flagged_content)
+        if after:
+            when_added, pk = decode_keyset(after)
+            queryset = queryset.filter(
+                models.Q(when_added__lt=when_added) |
+                models.Q(when_added=when_added, id__lt=pk))
+        flag_instances = list(queryset.select_related('user')
+                                      .order_by('-when_added', '-id')
+                                      [:size + 1])
+        next_cursor = None
+        if len(flag_instances) > size:
+            flag_instances = flag_instances[:size]
+            last = flag_instances[-1]
+            next_cursor = encode_keyset(last.when_added, last.id)
+        return flag_instances, next_cursor
+
+    @profiled('get_summary')
+    def get_summary(self, flagged_content, top=10):
+        """
+        Return a dict with, for the given flagged content, the total number of
+        flags (`total`), the number of flags by status (`by_status`, a dict)
+        and the `top` users with the most flags (`top_flaggers`, a list of
+        (user, count) tuples), computed with one grouped query (and one to
+        load the top users)
+        """
+        by_status, by_user = {}, {}
+        for row in self.filter(flagged_content=flagged_content)\
+                       .values('status', 'user')\
+                       .annotate(count=models.Count('id')).order_by():
+            by_status[row['status']] = by_status.get(row['status'], 0) + \
+                                       row['count']
+            by_user[row['user']] = by_user.get(row['user'], 0) + row['count']
+        top_ids = sorted(by_user, key=lambda user_id: (-by_user[user_id],
+                                                       user_id))[:top]
+        users = User.objects.in_bulk(top_ids) if top_ids else {}
+        return dict(total=sum(by_status.values()),
+                    by_status=by_status,
+                    top_flaggers=[(users[user_id], by_user[user_id])
+                                  for user_id in top_ids if user_id in users])
+
+    def _get_trusted(self, flags):
+        """
+        Return a dict with the trust of the users of the given flags (only
+        for models needing it), evaluated at once
+        """
+        users = [flag['user'] for flag in flags
+            if flag_settings.get_for_model(flag['content_object'],
+                                           'NEEDS_TRUST')]
+        if not users:
+            return {}
+        return trust.are_users_trusted(users, trust.get_eval_func())
+
+    @profiled('add_grouped')
+    def add_grouped(self, flags, send_signal=False, send_mails=False,
+                    notify=True):
+        """
+        Add many flags at once, like `add_bulk` (but without `status`: only
+        simple flags by users), grouping the flags of each object: its
+        FlaggedContent is loaded once, and its count updated once.
+        Flags with an `idempotency_key` already used by their user are not
+        added again: the existing flag is returned (or an
+        IdempotencyKeyReusedException if it's a flag of another object).
+        If `notify` is False, the signals, mails and webhooks are not sent:
+        call `notify_added` with the results (after the commit).
+        Return a list with, for each flag, the new FlagInstance or the
+        FlagException raised when adding it
+        """
+        flags = list(flags)
+        trusted = self._get_trusted(flags)
+        results = [None] * len(flags)
+
+        # flags already added with the same keys, loaded with one query
+        keys = dict(((flag['user'].pk, flag['idempotency_key']), index)
+                    for index, flag in reversed(list(enumerate(flags)))
+                    if flag.get('idempotency_key'))
+        existing = {}
+        if keys:
+            for flag_instance in self.select_related('flagged_content')\
+                    .filter(user__in=set(user_id for user_id, key in keys),
+                            idempotency_key__in=set(key for user_id, key
+                                                    in keys)):
+                existing[(flag_instance.user_id,
+                          flag_instance.idempotency_key)] = flag_instance
+        # indexes of the flags with the same key as a previous one
+        duplicates = {}
+
+        # indexes of the flags, by object
+        groups = OrderedDict()
+        object_keys = [(flag['content_object']._meta.app_label,
+                        flag['content_object']._meta.module_name,
+                        flag['content_object'].pk) for flag in flags]
+        for index, flag in enumerate(flags):
+            user_key = (flag['user'].pk, flag.get('idempotency_key'))
+            if user_key in existing:
+                try:
+                    self._check_idempotency_key(existing[user_key],
+                                                flag['content_object'])
+                except FlagException, e:
+                    results[index] = e
+                else:
+                    results[index] = existing[user_key]
+                continue
+            if user_key in keys and keys[user_key] != index:
+                if object_keys[keys[user_key]] != object_keys[index]:
+                    results[index] = IdempotencyKeyReusedException(
+                        _('This idempotency key was used for another object'))
+                else:
+                    duplicates[index] = keys[user_key]
+                continue
+            groups.setdefault(object_keys[index], []).append(index)
+
+        for indexes in groups.values():
+            first = flags[indexes[0]]
+            try:
+                flagged_content, created = FlaggedContent.objects.\
+                        get_or_create_for_object(first['content_object'],
+                                                 first.get('content_creator'))
+            except FlagException, e:
+                for index in indexes:
+                    results[index] = e
+                continue
+
+            added = []
+            for index in indexes:
+                flag = flags[index]
+                flag_instance = FlagInstance(flagged_content=flagged_content,
+                                             user=flag['user'],
+                                             comment=flag.get('comment'),
+                                             status=flagged_content.status,
+                                             idempotency_key=flag.get(
+                                                     'idempotency_key'))
+                try:
+                    flag_instance.save(trusted=flag.get('trusted',
+                                            trusted.get(flag['user'].pk)),
+                                       notify=False)
+                except FlagException, e:
+                    results[index] = e
+                    continue
+                results[index] = flag_instance
+                if flag_instance.pk:
+                    added.append(flag_instance)
+                    # the next flags of the group are checked with this count
+                    counted = flagged_content.status == \
+                              flag_settings.DEFAULT_STATUS
+                    if counted and flagged_content.sharded:
+                        flagged_content._pending_count += 1
+                    elif counted:
+                        flagged_content.count += 1
+
+            flagged_content.flags_added(added, send_signal, send_mails,
+                                        notify)
+
+        for index, first in duplicates.items():
+            results[index] = results[first]
+        return results
+
+    def notify_added(self, results, send_signal=False, send_mails=False):
+        """
+        Send the signals, mails and webhooks for the flags added by
+        `add_grouped` with `notify=False`
+        """
+        groups = OrderedDict()
+        for result in results:
+            if isinstance(result, FlagInstance) and \
+                    hasattr(result, 'reached_count'):
+                groups.setdefault(result.flagged_content_id, []).append(result)
+        for flag_instances in groups.values():
+            flag_instances[0].flagged_content.notify_flags_added(
+                    flag_instances, send_signal, send_mails)
+
+    @profiled('add_bulk')
+    def add_bulk(self, flags, send_signal=False, send_mails=False):
+        """
+        Add many flags at once. `flags` is a list of dicts with the
+        parameters of the `add` method (`user` and `content_object` are
+        mandatory).
+        The trust of all users is evaluated at once if needed.
+        Return a list with, for each flag, the new FlagInstance or the
+        FlagException raised when adding it
+        """
+        flags = list(flags)
+        trusted = self._get_trusted(flags)
+
+        results = []
+        for flag in flags:
+            params = dict(send_signal=send_signal, send_mails=send_mails)
+            params.update(flag)
+            params.setdefault('trusted', trusted.get(flag['user'].pk))
+            try:
+                results.append(self.add(**params))
+            except FlagException, e:
+                results.append(e)
+        return results
+
 
 class FlagInstance(models.Model):
 
@@ -373,11 +1094,14 @@ class FlagInstance(models.Model):
     when_added = models.DateTimeField(auto_now=False, auto_now_add=True)
     comment = models.TextField(null=True, blank=True)  # comment by the flagger
     status = models.PositiveSmallIntegerField(default=1, db_index=True)
+    # key sent by the client, to not add the flag twice on retries
+    idempotency_key = models.CharField(max_length=64, null=True, blank=True)
 
     objects = FlagInstanceManager()
 
     class Meta:
         ordering = ('-when_added',)
+        unique_together = (('user', 'idempotency_key'),)
 
     def __unicode__(self):
         """
@@ -401,10 +1125,16 @@ class FlagInstance(models.Model):
         If a `send_signal` is passed, we pass it to the `flag_added` method
         of the flagged_content to tell him to send the signal (default False)
         Idem with `send_mails`, to send emails if settings allow it.
+        A `trusted` parameter can be passed if the trust of the user is
+        already known (else it's evaluated if the NEEDS_TRUST setting is True)
+        If `notify` is False, the flagged_content is not told about the new
+        flag: its `flags_added` method must be called later
         """
         is_new = not bool(self.id)
         send_signal = kwargs.pop('send_signal', False)
         send_mails = kwargs.pop('send_mails', False)
+        trusted = kwargs.pop('trusted', None)
+        notify = kwargs.pop('notify', True)
 
         # check if the user can flag this object
         if is_new and self.status == 1:
@@ -421,13 +1151,26 @@ class FlagInstance(models.Model):
 
 
         # we won't save this if the user is not trusted !
-        if self.content_settings('NEEDS_TRUST') and not can_user_be_trusted(self.user):
+        needs_trust = self.content_settings('NEEDS_TRUST')
+        if needs_trust and trusted is None:
+            trusted = trust.is_user_trusted(self.user,
+                                           trust.get_eval_func())
+        if needs_trust and not trusted:
             self.send_untrusted_warning_mails()
         else:
-            super(FlagInstance, self).save(*args, **kwargs)
+            using = kwargs.get('using') or router.db_for_write(FlagInstance,
+                                                               instance=self)
+            with in_transaction(using):
+                super(FlagInstance, self).save(*args, **kwargs)
+                if is_new and flag_settings.EVENTS:
+                    FlagEvent.objects.log(FlagEvent.FLAG,
+                                          self.flagged_content,
+                                          flag=self.id,
+                                          user=self.user_id,
+                                          status=self.status)
 
             # tell the flagged_content that it has a new flag
-            if is_new:
+            if is_new and notify:
                 self.flagged_content.flag_added(self, send_signal=send_signal,
                                                 send_mails=send_mails)
 
@@ -543,6 +1286,458 @@ class FlagInstance(models.Model):
         return url
 
 
+class FlagPolicy(models.Model):
+    """
+    Settings for a model, overriding the MODELS_SETTINGS setting (used only
+    if the DB_POLICIES setting is True, see `flag.policies`)
+    """
+    model = models.CharField(_('model'), max_length=100, unique=True,
+            help_text=_('The model, as "app_label.model"'))
+    settings = models.TextField(_('settings'),
+            help_text=_('A json dict with the settings to use for this '
+                        'model, without the FLAG_ prefix, like '
+                        '{"LIMIT_FOR_OBJECT": 5, "NEEDS_TRUST": true}'))
+    when_updated = models.DateTimeField(auto_now=True, auto_now_add=True)
+
+    class Meta:
+        ordering = ('model',)
+        verbose_name = _('flag policy')
+        verbose_name_plural = _('flag policies')
+
+    def __unicode__(self):
+        return self.model
+
+    def get_settings(self):
+        """
+        Return the settings as a dict
+        """
+        return json.loads(self.settings)
+
+    def clean(self):
+        """
+        Check that the model is an installed one, and that the settings are
+        a json dict of per-model settings
+        """
+        app_label, dot, model_name = self.model.partition('.')
+        if registry.get_id_for_tuple(app_label, model_name) is None:
+            raise ValidationError(_('Unknown model: %s') % self.model)
+        try:
+            values = self.get_settings()
+        except ValueError:
+            raise ValidationError(_('The settings must be valid json'))
+        if not isinstance(values, dict):
+            raise ValidationError(_('The settings must be a json dict'))
+        invalid = [name for name in values
+                   if name not in flag_settings._MODEL_SETTINGS]
+        if invalid:
+            raise ValidationError(_('Invalid settings: %s') % \
+                                  ', '.join(sorted(invalid)))
+
+
+class FlagPolicyVersion(models.Model):
+    """
+    A single row, updated each time a FlagPolicy is saved or deleted, so
+    processes know when to load the policies again
+    """
+    version = models.PositiveIntegerField(default=0)
+
+    @classmethod
+    def bump(cls):
+        """
+        Increment the version
+        """
+        _increment(cls.objects, 1, field='version', pk=1)
+
+
+def _increment(manager, delta, field='count', **keys):
+    """
+    Add `delta` to the `field` field (`count` by default) of the row with the
+    given `keys`, creating it if needed
+    """
+    rows = manager.filter(**keys)
+    values = {field: models.F(field) + delta}
+    if not rows.update(**values):
+        row, created = manager.get_or_create(defaults={field: delta},
+                                             **keys)
+        if not created:
+            rows.update(**values)
+
+
+def _get_content_type_id(model):
+    """
+    Return the content type id of the given model (a model, an instance or
+    a "app_label.model" string), or None if it's not an installed model
+    """
+    return registry.get_id_for_tuple(*get_content_type_tuple(model))
+
+
+class FlagCounterManager(models.Manager):
+    """
+    Manager for the FlagCounter model
+    """
+
+    def add(self, content_type_id, status, delta):
+        """
+        Add `delta` to the counter of the given content type and status,
+        creating it if needed
+        """
+        _increment(self, delta, content_type_id=content_type_id,
+                   status=status)
+
+    def get_counts(self, model=None):
+        """
+        Return a dict with the number of flagged contents by status, for the
+        given model (or for all models)
+        """
+        counters = self.all()
+        if model is not None:
+            content_type_id = _get_content_type_id(model)
+            if content_type_id is None:
+                return {}
+            counters = counters.filter(content_type=content_type_id)
+        counts = {}
+        for status, count in counters.values_list('status', 'count'):
+            counts[status] = counts.get(status, 0) + count
+        return counts
+
+    def rebuild(self):
+        """
+        Count the flagged contents again, by content type and status, to
+        fill the counters (needed for existing flagged contents, or if they
+        were updated without their `save` method)
+        """
+        using = router.db_for_write(FlagCounter)
+        with in_transaction(using):
+            self.all().delete()
+            rows = FlaggedContent.objects.values('content_type', 'status')\
+                                         .annotate(count=models.Count('id'))\
+                                         .order_by()
+            for row in rows:
+                self.create(content_type_id=row['content_type'],
+                            status=row['status'],
+                            count=row['count'])
+
+
+class FlagCounter(models.Model):
+    """
+    Number of flagged contents by content type and status, updated when a
+    FlaggedContent is created, deleted, or when its status changes
+    """
+    content_type = models.ForeignKey(ContentType)
+    status = models.PositiveSmallIntegerField()
+    count = models.IntegerField(default=0)
+
+    objects = FlagCounterManager()
+
+    class Meta:
+        unique_together = [('content_type', 'status')]
+
+    def __unicode__(self):
+        return u'%s.%s (%s): %s' % (self.content_type.app_label,
+                                    self.content_type.model,
+                                    self.status,
+                                    self.count)
+
+
+class FlagCountShardManager(models.Manager):
+    """
+    Manager for the FlagCountShard model
+    """
+
+    def add(self, flagged_content, delta):
+        """
+        Add `delta` to a random shard of the flagged content
+        """
+        _increment(self, delta, flagged_content=flagged_content,
+                   shard=random.randrange(
+                           flag_settings.SHARDED_COUNTS_SHARDS))
+
+    def get_total(self, flagged_content):
+        """
+        Return the sum of the shards of the flagged content
+        """
+        return self.filter(flagged_content=flagged_content).aggregate(
+                total=models.Sum('count'))['total'] or 0
+
+    def fold(self):
+        """
+        Move the counts of all the shards to the `count` of their flagged
+        contents. Return the number of moved flags
+        """
+        total = 0
+        ids = self.exclude(count=0).values_list('flagged_content', flat=True)
+        for flagged_content in FlaggedContent.objects.filter(
+                id__in=set(ids)):
+            total += flagged_content.fold_shards()
+        return total
+
+
+class FlagCountShard(models.Model):
+    """
+    A part of the number of flags of a sharded flagged content: each new flag
+    is counted in a random shard, without locking the row of the flagged
+    content, and the shards are regularly added to its `count`
+    """
+    flagged_content = models.ForeignKey(FlaggedContent,
+                                        related_name='count_shards')
+    shard = models.PositiveSmallIntegerField()
+    count = models.IntegerField(default=0)
+
+    objects = FlagCountShardManager()
+
+    class Meta:
+        unique_together = [('flagged_content', 'shard')]
+
+    def __unicode__(self):
+        return u'%s (%s): %s' % (self.flagged_content_id, self.shard,
+                                 self.count)
+
+
+class FlagRollupManager(models.Manager):
+    """
+    Manager for the FlagRollup model, to update the rollups and read them
+    """
+
+    def process(self, batch_size=None, delay=None):
+        """
+        Add the flags not yet processed (after the cursor) to the rollups, by
+        batches of `batch_size` (default to the ROLLUP_BATCH_SIZE setting),
+        each one in a transaction. Flags added less than `delay` seconds ago
+        (default to the ROLLUP_READ_DELAY setting) are left for the next run.
+        If the ROLLUP_INLINE setting is True, the flags are already counted,
+        so only the cursor is moved.
+        Return the number of processed flags
+        """
+        batch_size = batch_size or flag_settings.ROLLUP_BATCH_SIZE
+        if delay is None:
+            delay = flag_settings.ROLLUP_READ_DELAY
+        total = 0
+        while True:
+            count = self._process_batch(batch_size, delay)
+            total += count
+            if count < batch_size:
+                return total
+
+    def _process_batch(self, batch_size, delay):
+        """
+        Add the next `batch_size` flags to the rollups and move the cursor.
+        The cursor is locked during the transaction, so flags are never
+        counted twice. The cursor stops before the first flag added less
+        than `delay` seconds ago: ids are allocated before the commits, so a
+        flag with a lower id may still be in a running transaction
+        """
+        using = router.db_for_write(FlagRollup)
+        with in_transaction(using):
+            FlagRollupCursor.objects.get_or_create(pk=1)
+            cursor = FlagRollupCursor.objects.select_for_update().get(pk=1)
+            rows = list(FlagInstance.objects.filter(id__gt=cursor.last_id)
+                        .order_by('id')
+                        .values_list('id', 'when_added',
+                                     'flagged_content__content_type',
+                                     'status')[:batch_size])
+            if delay:
+                limit = timezone.now() - timedelta(seconds=delay)
+                for index, row in enumerate(rows):
+                    if row[1] > limit:
+                        rows = rows[:index]
+                        break
+            if not rows:
+                return 0
+
+            if not flag_settings.ROLLUP_INLINE:
+                self.add_flags([(when_added, content_type_id, status)
+                                for flag_id, when_added, content_type_id,
+                                    status in rows])
+
+            cursor.last_id = rows[-1][0]
+            cursor.save()
+        return len(rows)
+
+    def add_flags(self, flags):
+        """
+        Add flags to the rollups: `flags` is a list of `(when_added,
+        content_type_id, status)` tuples
+        """
+        counts = {}
+        for when_added, content_type_id, status in flags:
+            if timezone.is_aware(when_added):
+                when_added = timezone.localtime(when_added)
+            key = (when_added.date(), content_type_id, status)
+            counts[key] = counts.get(key, 0) + 1
+        for (day, content_type_id, status), count in counts.items():
+            _increment(self, count, day=day,
+                       content_type_id=content_type_id, status=status)
+
+    def get_series(self, model=None, status=None, since=None, until=None):
+        """
+        Return a list of `(day, count)` tuples, by day, with the number of
+        flags added each day, for the given model (a model, an instance or a
+        "app_label.model" string) and status (or all of them), between the
+        `since` and `until` days (included). Days without flags are not
+        returned
+        """
+        rollups = self.all()
+        if model is not None:
+            content_type_id = _get_content_type_id(model)
+            if content_type_id is None:
+                return []
+            rollups = rollups.filter(content_type=content_type_id)
+        if status is not None:
+            rollups = rollups.filter(status=status)
+        if since is not None:
+            rollups = rollups.filter(day__gte=since)
+        if until is not None:
+            rollups = rollups.filter(day__lte=until)
+        rows = rollups.values('day').annotate(total=models.Sum('count'))\
+                                    .order_by('day')
+        return [(row['day'], row['total']) for row in rows]
+
+
+class FlagRollup(models.Model):
+    """
+    Number of flags added by day, content type and status, filled from the
+    FlagInstance table by `FlagRollup.objects.process` (the `flag_rollup`
+    command), or when a flag is added if the ROLLUP_INLINE setting is True
+    """
+    day = models.DateField()
+    content_type = models.ForeignKey(ContentType)
+    status = models.PositiveSmallIntegerField()
+    count = models.PositiveIntegerField(default=0)
+
+    objects = FlagRollupManager()
+
+    class Meta:
+        unique_together = [('day', 'content_type', 'status')]
+        ordering = ('-day',)
+
+    def __unicode__(self):
+        return u'%s %s.%s (%s): %s' % (self.day,
+                                       self.content_type.app_label,
+                                       self.content_type.model,
+                                       self.status,
+                                       self.count)
+
+
+class FlagRollupCursor(models.Model):
+    """
+    A single row, with the id of the last flag added to the rollups
+    """
+    last_id = models.PositiveIntegerField(default=0)
+
+
+class FlagEventManager(models.Manager):
+    """
+    Manager for the FlagEvent model, to log events and read them
+    """
+
+    def log(self, kind, flagged_content, **data):
+        """
+        Add an event of the given kind for the flagged content, with `data`
+        as payload
+        """
+        return self.create(kind=kind,
+                           flagged_content_id=flagged_content.id,
+                           content_type_id=flagged_content.content_type_id,
+                           object_id=flagged_content.object_id,
+                           data=json.dumps(data, separators=(',', ':')))
+
+    def read_events(self, after_id=0, limit=1000, delay=None):
+        """
+        Return the list of the (at most `limit`) events after the event with
+        the id `after_id`, ordered by id. A consumer reads all events, once,
+        by passing the id of the last event it read.
+        Events added less than `delay` seconds ago (default to the
+        EVENTS_READ_DELAY setting) are not returned: their ids may be before
+        ones of events still not visible, in running transactions
+        """
+        if delay is None:
+            delay = flag_settings.EVENTS_READ_DELAY
+        events = self.filter(id__gt=after_id).order_by('id')
+        if delay:
+            events = events.filter(
+                    when_added__lte=timezone.now() - timedelta(seconds=delay))
+        return list(events[:limit])
+
+
+class FlagEvent(models.Model):
+    """
+    Append-only log of the new flags and of the changes of status and
+    moderator of flagged contents, written in the same transaction as them
+    (only if the EVENTS setting is True).
+    The ids are increasing, so consumers can follow the changes with
+    `FlagEvent.objects.read_events`
+    """
+    FLAG = 'flag'
+    STATUS = 'status'
+    MODERATOR = 'moderator'
+
+    kind = models.CharField(max_length=10)
+    # not foreign keys: events are kept when the flagged contents are deleted
+    flagged_content_id = models.PositiveIntegerField()
+    content_type_id = models.PositiveIntegerField()
+    object_id = models.PositiveIntegerField()
+    data = models.TextField()
+    when_added = models.DateTimeField(auto_now_add=True)
+
+    objects = FlagEventManager()
+
+    class Meta:
+        ordering = ('id',)
+
+    def __unicode__(self):
+        return u'%s #%s on flagged content #%s' % (self.kind, self.id,
+                                                   self.flagged_content_id)
+
+    def as_dict(self):
+        """
+        Return the event as a dict, with the payload, ready to be serialized
+        """
+        result = json.loads(self.data)
+        app_label, model = registry.get_tuple_for_id(self.content_type_id) \
+                           or (None, None)
+        result.update(id=self.id,
+                      kind=self.kind,
+                      flagged_content=self.flagged_content_id,
+                      content_type='%s.%s' % (app_label, model)
+                                   if app_label else self.content_type_id,
+                      object_id=self.object_id,
+                      when=self.when_added.isoformat())
+        return result
+
+
+class FlagSpoolCursor(models.Model):
+    """
+    The offset of the next record to replay in a spool file, updated in the
+    transaction adding the flags (see `flag.spool`)
+    """
+    name = models.CharField(max_length=255, unique=True)
+    offset = models.BigIntegerField(default=0)
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.name, self.offset)
+
+
+class QueuedFlag(models.Model):
+    """
+    A flag waiting to be added, in the queued mode (see `flag.ingestion`)
+    """
+    user = models.ForeignKey(User, related_name='+')
+    content_type = models.ForeignKey(ContentType, related_name='+')
+    object_id = models.PositiveIntegerField()
+    creator = models.ForeignKey(User, null=True, blank=True,
+                                related_name='+')
+    comment = models.TextField(null=True, blank=True)
+    idempotency_key = models.CharField(max_length=64, null=True, blank=True)
+    when_added = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ('id',)
+
+    def __unicode__(self):
+        return u'queued flag on %s #%s by user #%s' % (
+                self.content_type_id, self.object_id, self.user_id)
+
+
 def add_flag(flagger, content_type, object_id, content_creator, comment,
              status=None, send_signal=True, send_mails=True):
     """
@@ -551,3 +1746,35 @@ def add_flag(flagger, content_type, object_id, content_creator, comment,
     content_object = content_type.get_object_for_this_type(id=object_id)
     return FlagInstance.objects.add(flagger, content_object, content_creator,
                                     comment, status, send_signal, send_mails)
+
+
+def invalidate_deleted_content_cache(sender, instance, **kwargs):
+    """
+    Invalidate the cached values of a deleted flagged content
+    """
+    instance.invalidate_cache()
+
+models.signals.post_delete.connect(invalidate_deleted_content_cache,
+                                   sender=FlaggedContent)
+
+
+def decrement_deleted_content_counter(sender, instance, **kwargs):
+    """
+    Remove a deleted flagged content from the counters
+    """
+    FlagCounter.objects.add(instance.content_type_id,
+                            instance._original_status, -1)
+
+models.signals.post_delete.connect(decrement_deleted_content_counter,
+                                   sender=FlaggedContent)
+
+
+def bump_policies_version(sender, instance, **kwargs):
+    """
+    Tell all processes that the policies changed
+    """
+    FlagPolicyVersion.bump()
+    policies.invalidate()
+
+models.signals.post_save.connect(bump_policies_version, sender=FlagPolicy)
+models.signals.post_delete.connect(bump_policies_version, sender=FlagPolicy)
@@ -0,0 +1,83 @@
+"""
+Per-model settings stored in the database (the FlagPolicy model), used if
+the DB_POLICIES setting is True. They override the MODELS_SETTINGS setting,
+and can be updated without a restart.
+The policies are kept in process memory, and loaded again only when their
+version (a single row, updated each time a policy is saved or deleted)
+changes. The version is checked at most every DB_POLICIES_INTERVAL seconds,
+so the lookups cost nothing more than a dict access most of the time.
+"""
+
+import threading
+import time
+
+from flag import settings as flag_settings
+
+__all__ = ('get_policies', 'get_version', 'invalidate', 'clear')
+
+_state = dict(checked=None, version=None, policies={})
+_lock = threading.Lock()
+
+
+def _load_version():
+    """
+    Return the current version of the policies in the database
+    """
+    from flag.models import FlagPolicyVersion
+    versions = FlagPolicyVersion.objects.filter(pk=1).values_list('version',
+                                                                  flat=True)
+    return versions[0] if versions else 0
+
+
+def _load_policies():
+    """
+    Return the policies in the database, a dict with the settings by model
+    """
+    from flag.models import FlagPolicy
+    result = {}
+    for policy in FlagPolicy.objects.all():
+        try:
+            result[policy.model] = policy.get_settings()
+        except ValueError:
+            # invalid json, saved without validation
+            pass
+    return result
+
+
+def get_policies():
+    """
+    Return the policies, a dict with the settings (a dict) by model
+    ("app_label.model"), loaded again if their version changed
+    """
+    now = time.time()
+    checked = _state['checked']
+    if checked is None or now - checked >= flag_settings.DB_POLICIES_INTERVAL:
+        with _lock:
+            version = _load_version()
+            if version != _state['version']:
+                _state.update(policies=_load_policies(), version=version)
+            _state['checked'] = now
+    return _state['policies']
+
+
+def get_version():
+    """
+    Return the version of the policies currently used
+    """
+    get_policies()
+    return _state['version']
+
+
+def invalidate():
+    """
+    Force a check of the version on next use (used when a policy is saved in
+    the current process)
+    """
+    _state['checked'] = None
+
+
+def clear():
+    """
+    Forget the policies, they will be loaded again on next use
+    """
+    _state.update(checked=None, version=None, policies={})
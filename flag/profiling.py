@@ -0,0 +1,92 @@
+"""
+Helpers to profile the SQL queries issued by django-flag during a request,
+grouped by call site (`get_for_object`, `count_flags_by_user`...)
+Profiling is enabled by `flag.middleware.FlagQueryProfilerMiddleware`, or
+manually with `start` and `stop`
+"""
+
+import threading
+from functools import wraps
+
+from django.db import connection
+
+_state = threading.local()
+
+
+def is_active():
+    """
+    Return True if the profiling is running for the current thread
+    """
+    return getattr(_state, 'active', False)
+
+
+def start():
+    """
+    Start to record queries for the current thread. Force the use of the
+    debug cursor so queries are recorded even if DEBUG is False
+    """
+    _state.active = True
+    _state.stack = []
+    _state.sites = {}
+    _state.use_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+
+
+def stop():
+    """
+    Stop the profiling for the current thread and return the summary, a dict
+    with the call site as key and a dict with `calls`, `queries` and `time`
+    (in seconds) as value. Queries are attributed to the innermost call site
+    """
+    if not is_active():
+        return {}
+    _state.active = False
+    connection.use_debug_cursor = _state.use_debug_cursor
+    sites, _state.sites = _state.sites, {}
+    return sites
+
+
+def format_summary(summary):
+    """
+    Return the summary as a short string, the most expensive call sites first
+    """
+    items = sorted(summary.items(), key=lambda item: -item[1]['queries'])
+    return '; '.join('%s: %d calls, %d queries, %.3fs' % (
+            name, data['calls'], data['queries'], data['time'])
+        for name, data in items)
+
+
+def profiled(name):
+    """
+    Decorator to mark a function as a call site for the profiling. It costs
+    nothing more than a thread-local lookup when the profiling is not active
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not is_active():
+                return func(*args, **kwargs)
+
+            # frame: [start index, queries and time of nested call sites]
+            frame = [len(connection.queries), 0, 0.0]
+            _state.stack.append(frame)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _state.stack.pop()
+                queries = connection.queries[frame[0]:]
+                duration = sum(float(query.get('time') or 0)
+                               for query in queries)
+                if _state.stack:
+                    _state.stack[-1][1] += len(queries)
+                    _state.stack[-1][2] += duration
+                site = _state.sites.setdefault(name,
+                        dict(calls=0, queries=0, time=0.0))
+                site['calls'] += 1
+                site['queries'] += len(queries) - frame[1]
+                site['time'] += duration - frame[2]
+        # keep the signature visible for template filters arguments checks
+        wrapper._decorated_function = getattr(func, '_decorated_function',
+                                              func)
+        return wrapper
+    return decorator
@@ -0,0 +1,171 @@
+"""
+Registry of the installed models, by "app_label.model", with their content
+type id, if they can be flagged (the MODELS setting) and their resolved
+settings, so the views can resolve a content type string with a single dict
+lookup.
+It also keeps the content types of the installed models, by id and by
+`(app_label, model)`, used by `utils.get_content_type_tuple`.
+The registry is built on first use (when all the models are loaded), and
+built again if the flag settings (or the policies) change, or after a syncdb.
+"""
+
+import threading
+from collections import namedtuple
+
+from django.db.models import get_apps, get_models
+from django.db.models.signals import post_syncdb
+from django.contrib.contenttypes.models import ContentType
+
+from flag import policies
+from flag import settings as flag_settings
+
+__all__ = ('RegisteredModel', 'get', 'get_for_model', 'get_tuple_for_id',
+           'get_model_for_id', 'get_id_for_tuple', 'clear')
+
+# settings resolved for each model, in the `policy` dict
+POLICY_SETTINGS = ('ALLOW_COMMENTS',
+                   'LIMIT_FOR_OBJECT',
+                   'LIMIT_SAME_OBJECT_FOR_USER',
+                   'STATUSES',
+                   'NEEDS_TRUST',
+                   'SEND_MAILS',
+                   'SEND_MAILS_TO',
+                   'SEND_MAILS_RULES')
+
+RegisteredModel = namedtuple('RegisteredModel',
+                             'model content_type_id allowed policy')
+
+_state = dict(registry=None, signature=None)
+_content_types = dict(by_id=None, by_tuple=None)
+_lock = threading.RLock()
+
+
+def _get_installed_models():
+    """
+    Return the list of all the installed models
+    """
+    return [model for app in get_apps() for model in get_models(app)]
+
+
+def _get_content_types():
+    """
+    Return the dict with the content types of the installed models, by id
+    (`(app_label, model, model class)`) and by `(app_label, model)` (the id),
+    loading them if needed
+    """
+    if _content_types['by_id'] is None:
+        with _lock:
+            by_id, by_tuple = {}, {}
+            for model, content_type in ContentType.objects.get_for_models(
+                    *_get_installed_models()).items():
+                key = (content_type.app_label, content_type.model)
+                by_id[content_type.id] = key + (model,)
+                by_tuple[key] = content_type.id
+            _content_types.update(by_id=by_id, by_tuple=by_tuple)
+    return _content_types
+
+
+def _get_signature():
+    """
+    Return the generation of the settings (and the version of the policies)
+    used to build the registry, to know when it must be built again
+    """
+    if flag_settings.DB_POLICIES:
+        return flag_settings.generation, policies.get_version()
+    return flag_settings.generation, None
+
+
+def _build():
+    """
+    Return a new registry, with all the installed models
+    """
+    content_types = _get_content_types()['by_id']
+    registry = {}
+    for content_type_id, (app_label, model_name, model) in \
+            content_types.items():
+        key = '%s.%s' % (app_label, model_name)
+        allowed = flag_settings.MODELS is None or key in flag_settings.MODELS
+        policy = dict((name, flag_settings.get_for_model(model, name))
+                      for name in POLICY_SETTINGS)
+        registry[key] = RegisteredModel(model, content_type_id, allowed,
+                                        policy)
+    return registry
+
+
+def _get_registry():
+    """
+    Return the registry, building it if needed
+    """
+    signature = _get_signature()
+    registry = _state['registry']
+    if registry is None or _state['signature'] != signature:
+        with _lock:
+            registry = _build()
+            _state.update(registry=registry, signature=signature)
+    return registry
+
+
+def get(key):
+    """
+    Return the RegisteredModel for the given "app_label.model" string, or
+    None if it's not an installed model
+    """
+    registry = _get_registry()
+    entry = registry.get(key)
+    if entry is None and isinstance(key, basestring):
+        # model names are case insensitive
+        app_label, _, model = key.partition('.')
+        entry = registry.get('%s.%s' % (app_label, model.lower()))
+    return entry
+
+
+def get_for_model(model):
+    """
+    Return the RegisteredModel for the given model (or instance of a model)
+    """
+    return get('%s.%s' % (model._meta.app_label, model._meta.module_name))
+
+
+def get_tuple_for_id(content_type_id):
+    """
+    Return the `(app_label, model)` tuple of the given content type id, or
+    None if it's not the one of an installed model
+    """
+    entry = _get_content_types()['by_id'].get(content_type_id)
+    return entry[:2] if entry is not None else None
+
+
+def get_model_for_id(content_type_id):
+    """
+    Return the model of the given content type id, or None if it's not the
+    one of an installed model
+    """
+    entry = _get_content_types()['by_id'].get(content_type_id)
+    return entry[2] if entry is not None else None
+
+
+def get_id_for_tuple(app_label, model):
+    """
+    Return the id of the content type of the given model, or None if it's
+    not an installed model
+    """
+    return _get_content_types()['by_tuple'].get((app_label, model))
+
+
+def clear():
+    """
+    Forget the registry and the content types, they will be loaded again on
+    next use
+    """
+    _state.update(registry=None, signature=None)
+    _content_types.update(by_id=None, by_tuple=None)
+
+
+def _clear_registry(sender, **kwargs):
+    """
+    Signal receiver to build the registry again after a syncdb
+    """
+    clear()
+
+post_syncdb.connect(_clear_registry,
+                    dispatch_uid='flag.registry.clear_on_syncdb')
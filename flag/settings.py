@@ -1,12 +1,23 @@
+"""
+The flag settings, read from the django settings (`FLAG_*`).
+This module is replaced by a `FlagSettings` object, which reads the settings
+on first access only, and again when they are updated by the
+`setting_changed` signal (sent by django's `override_settings`) or by
+assigning them (`flag_settings.LIMIT_FOR_OBJECT = 3`). Each update
+increments the `generation` attribute, so the caches based on the settings
+know when to be built again.
+"""
+
+import sys
+
 from django import conf
 from django.utils.translation import ugettext_lazy as _
 
-from flag.utils import get_content_type_tuple
-
 __all__ = ('ALLOW_COMMENTS',
            'LIMIT_SAME_OBJECT_FOR_USER',
            'LIMIT_FOR_OBJECT',
            'MODELS',
+           'MODELS_SETTINGS',
            'STATUSES',
            'DEFAULT_STATUS',
            'SEND_MAILS',
@@ -14,151 +25,510 @@ __all__ = ('ALLOW_COMMENTS',
            'SEND_MAILS_FROM',
            'SEND_MAILS_RULES',
            'NEEDS_TRUST',
-           'TRUST_TIME')
-
-# keep the default values
-_DEFAULTS = dict(
-    ALLOW_COMMENTS=True,
-    NEEDS_TRUST=False,
-    TRUST_TIME=3,
-    TRUST_EVAL_FUNC='flag.utils.can_user_be_trusted',
-    LIMIT_SAME_OBJECT_FOR_USER=0,
-    LIMIT_FOR_OBJECT=0,
-    MODELS=None,
-    STATUSES=[
-        (1, _("flagged")),
-        (2, _("flag rejected by moderator")),
-        (3, _("creator notified")),
-        (4, _("content removed by creator")),
-        (5, _("content removed by moderator")),
-    ],
-    DEFAULT_STATUS=1,
-    SEND_MAILS=False,
-    SEND_MAILS_TO=conf.settings.ADMINS,
-    SEND_MAILS_FROM=conf.settings.DEFAULT_FROM_EMAIL,
-    SEND_MAILS_RULES=[(1, 1), ],
-    MODELS_SETTINGS={},
-)
-
-# Set FLAG_ALLOW_COMMENTS to False in settings to not allow users to
-# comment their flags (True by default)
-ALLOW_COMMENTS = getattr(conf.settings,
-                         'FLAG_ALLOW_COMMENTS',
-                         _DEFAULTS['ALLOW_COMMENTS'])
-# boolean stating whether an user needs to be trusted before being
-# able to flag some content
-NEEDS_TRUST = getattr(conf.settings,
-                     'FLAG_NEEDS_TRUST',
-                     _DEFAULTS['NEEDS_TRUST'])
-# The number of days that a user must have created his account 
-# before he is allowed to flag content
-TRUST_TIME = getattr(conf.settings, 
-                     'FLAG_TRUST_TIME',
-                     _DEFAULTS['TRUST_TIME'])
-# The function that evaluate if a user can be trusted or not
-TRUST_EVAL_FUNC = getattr(conf.settings, 
-                         'FLAG_TRUST_EVAL_FUNC',
-                         _DEFAULTS['TRUST_EVAL_FUNC'])
-
-
-# Set FLAG_LIMIT_SAME_OBJECT_FOR_USER to a number in settings to limit the
-# times a user can flag a single object
-# If 0, there is no limit
-LIMIT_SAME_OBJECT_FOR_USER = getattr(conf.settings,
-                                     'FLAG_LIMIT_SAME_OBJECT_FOR_USER',
-                                     _DEFAULTS['LIMIT_SAME_OBJECT_FOR_USER'])
-
-# Set FLAG_LIMIT_FOR_OBJECT to a number in settings to limit the times an
-# object can be flagged
-# If 0, there is no limit
-LIMIT_FOR_OBJECT = getattr(conf.settings,
-                           'FLAG_LIMIT_FOR_OBJECT',
-                           _DEFAULTS['LIMIT_FOR_OBJECT'])
-
-# Set FLAG_MODELS to a list/tuple of models in your settings to limit the
-# models that can be flagged. The syntax to use is a string for each model :
-# FLAG_MODELS = ('myapp.mymodel', 'otherapp.othermodel',)
-MODELS = getattr(conf.settings, 'FLAG_MODELS', _DEFAULTS['MODELS'])
-
-# Set FLAG_STATUSES to a list of tuples in your settings to set the available
-# status for each flagged content
-# The default status used when a user flag an object is the first of this list.
-STATUSES = getattr(conf.settings, "FLAG_STATUSES",
-            getattr(conf.settings, "FLAG_STATUS", _DEFAULTS['STATUSES']))
-
-# Set FLAG_DEFAULT_STATUS to ... the default status
-DEFAULT_STATUS = getattr(conf.settings, 'FLAG_DEFAULT_STATUS', 
-                         _DEFAULTS['DEFAULT_STATUS'])
-
-# Set FLAG_SEND_MAILS to True if you want to have emails sent when object are
-# flagged.
-# See others settings FLAG_SEND_MAILS_* for more configuration
-# The default is to not send mails
-SEND_MAILS = getattr(conf.settings, "FLAG_SEND_MAILS", _DEFAULTS['SEND_MAILS'])
-
-# Set FLAG_SEMD_MAILS_TO to a list of email addresses to sent mails when an
-# object is flagged.
-# Each entry can be either a single email address, or a tuple with (name, email
-# address) but only the mail will be used
-# The default is the ADMINS setting
-SEND_MAILS_TO = getattr(conf.settings,
-                        "FLAG_SEND_MAILS_TO",
-                        _DEFAULTS['SEND_MAILS_TO'])
-
-# Set FLAG_SEND_MAILS_FROM to an email address to use as the send of mails
-# sent when an object is flagged.
-# Default to the DEFAULT_FROM_EMAIL setting
-SEND_MAILS_FROM = getattr(conf.settings,
-                          "FLAG_SEND_MAILS_FROM",
-                          _DEFAULTS['SEND_MAILS_FROM'])
-
-# Set FLAG_SEND_MAILS_RULES to define when to send mails for flags. This
-# settings is a list of tuple, each line defining a rule. A rule is a tuple
-# with two entries, the first one is the minimum flag for an object for which
-# this rule apply, and the second one is the frequency : (4, 3) => if an
-# object is flagged 4 times or more, send a mail every 3 flags (4, 7 and 10).
-# If this rule is followed by (10, 5), it will be used only when number of
-# flags is between 4 (included) and 10 (not included), then the "11" rules
-# will apply.
-# A mail will be send if the LIMIT_FOR_OBJECT is reached, ignoring the rules
-# Default is to sent a mail for each flag
-SEND_MAILS_RULES = getattr(conf.settings,
-                           "FLAG_SEND_MAILS_RULES",
-                           _DEFAULTS['SEND_MAILS_RULES'])
-
-# Use FLAG_MODELS_SETTINGS if you want to override the global settings for a
-# specific model.
-# It's a dict with the string represetation of the model (`myapp.mymodel`) as
-# key, and a dict as value. This last dict can have zero, one or more of the
-# settings described in this module (excepted `MODELS` and of course
-# `MODELS_SETTINGS`), using names WITHOUT the `FLAG_` prefix
-# Default to an empty dict : each model will use the global settings
-MODELS_SETTINGS = getattr(conf.settings,
-                          "FLAG_MODELS_SETTINGS",
-                          _DEFAULTS['MODELS_SETTINGS'])
-
-# do not send mails if no recipients
-if SEND_MAILS and not SEND_MAILS_TO:
-    SEND_MAILS = False
+           'TRUST_TIME',
+           'TRUST_EVAL_FUNC',
+           'TRUST_CACHE_TIMEOUT',
+           'TRUST_CACHE_SIZE',
+           'TRUST_CACHE_BACKEND',
+           'TRUST_BATCH_EVAL_FUNC',
+           'SECURITY_TIMESTAMP_BUCKET',
+           'CACHE_BACKEND',
+           'CACHE_TIMEOUT',
+           'STATES_MAX_IDS',
+           'CONFIRM_TEMPLATE_VERSION',
+           'DB_POLICIES',
+           'DB_POLICIES_INTERVAL',
+           'ADMIN_INSTANCES_PAGE_SIZE',
+           'ADMIN_EDITABLE_INSTANCES',
+           'ADMIN_COUNT_THRESHOLD',
+           'ROLLUP_INLINE',
+           'ROLLUP_BATCH_SIZE',
+           'ROLLUP_READ_DELAY',
+           'EVENTS',
+           'EVENTS_READ_DELAY',
+           'WEBHOOKS',
+           'WEBHOOKS_BATCH_SIZE',
+           'WEBHOOKS_BATCH_WAIT',
+           'WEBHOOKS_TIMEOUT',
+           'WEBHOOKS_MAX_RETRIES',
+           'WEBHOOKS_RETRY_DELAY',
+           'WEBHOOKS_QUEUE_SIZE',
+           'DEFERRED_WORKERS',
+           'DEFERRED_QUEUE_SIZE',
+           'DEFERRED_QUEUE_FULL',
+           'DEFERRED_DRAIN_TIMEOUT',
+           'QUEUE',
+           'QUEUE_BACKEND',
+           'QUEUE_BATCH_SIZE',
+           'QUEUE_DUPLICATE_TIMEOUT',
+           'SPOOL_PATH',
+           'SPOOL_FSYNC_INTERVAL',
+           'SPOOL_CIRCUIT_TIMEOUT',
+           'SPOOL_BATCH_SIZE',
+           'SHARDED_COUNTS',
+           'SHARDED_COUNTS_SHARDS',
+           'SHARDED_COUNTS_RATE',
+           'SHARDED_COUNTS_FOLD_INTERVAL')
 
 _ONLY_GLOBAL_SETTINGS = ('MODELS', 'MODELS_SETTINGS',)
 
+# settings read for a model (so which can be defined by model, in
+# MODELS_SETTINGS or in the database), the other ones are only global
+_MODEL_SETTINGS = ('ALLOW_COMMENTS',
+                   'LIMIT_FOR_OBJECT',
+                   'LIMIT_SAME_OBJECT_FOR_USER',
+                   'STATUSES',
+                   'NEEDS_TRUST',
+                   'SEND_MAILS',
+                   'SEND_MAILS_TO',
+                   'SEND_MAILS_FROM',
+                   'SEND_MAILS_RULES',
+                   'WEBHOOKS')
+
+
+def _get_defaults():
+    """
+    Return the default values (some of them depend on django settings)
+    """
+    return dict(
+        ALLOW_COMMENTS=True,
+        NEEDS_TRUST=False,
+        TRUST_TIME=3,
+        TRUST_EVAL_FUNC='flag.utils.can_user_be_trusted',
+        TRUST_BATCH_EVAL_FUNC=None,
+        TRUST_CACHE_TIMEOUT=300,
+        TRUST_CACHE_SIZE=1000,
+        TRUST_CACHE_BACKEND=None,
+        LIMIT_SAME_OBJECT_FOR_USER=0,
+        LIMIT_FOR_OBJECT=0,
+        MODELS=None,
+        STATUSES=[
+            (1, _("flagged")),
+            (2, _("flag rejected by moderator")),
+            (3, _("creator notified")),
+            (4, _("content removed by creator")),
+            (5, _("content removed by moderator")),
+        ],
+        DEFAULT_STATUS=1,
+        SEND_MAILS=False,
+        SEND_MAILS_TO=conf.settings.ADMINS,
+        SEND_MAILS_FROM=conf.settings.DEFAULT_FROM_EMAIL,
+        SEND_MAILS_RULES=[(1, 1), ],
+        MODELS_SETTINGS={},
+        SECURITY_TIMESTAMP_BUCKET=60,
+        CACHE_BACKEND='default',
+        CACHE_TIMEOUT=3600,
+        STATES_MAX_IDS=500,
+        CONFIRM_TEMPLATE_VERSION=1,
+        DB_POLICIES=False,
+        DB_POLICIES_INTERVAL=5,
+        ADMIN_INSTANCES_PAGE_SIZE=50,
+        ADMIN_EDITABLE_INSTANCES=False,
+        ADMIN_COUNT_THRESHOLD=10000,
+        ROLLUP_INLINE=False,
+        ROLLUP_BATCH_SIZE=10000,
+        ROLLUP_READ_DELAY=5,
+        EVENTS=False,
+        EVENTS_READ_DELAY=5,
+        WEBHOOKS=[],
+        WEBHOOKS_BATCH_SIZE=100,
+        WEBHOOKS_BATCH_WAIT=0.5,
+        WEBHOOKS_TIMEOUT=5,
+        WEBHOOKS_MAX_RETRIES=5,
+        WEBHOOKS_RETRY_DELAY=1,
+        WEBHOOKS_QUEUE_SIZE=10000,
+        DEFERRED_WORKERS=4,
+        DEFERRED_QUEUE_SIZE=1000,
+        DEFERRED_QUEUE_FULL='inline',
+        DEFERRED_DRAIN_TIMEOUT=10,
+        QUEUE=False,
+        QUEUE_BACKEND='flag.ingestion.DatabaseQueue',
+        QUEUE_BATCH_SIZE=500,
+        QUEUE_DUPLICATE_TIMEOUT=60,
+        SPOOL_PATH=None,
+        SPOOL_FSYNC_INTERVAL=1,
+        SPOOL_CIRCUIT_TIMEOUT=30,
+        SPOOL_BATCH_SIZE=500,
+        SHARDED_COUNTS=False,
+        SHARDED_COUNTS_SHARDS=16,
+        SHARDED_COUNTS_RATE=50,
+        SHARDED_COUNTS_FOLD_INTERVAL=1,
+    )
+
+
+def _read_settings():
+    """
+    Return a dict with the value of each setting
+    """
+    defaults = _get_defaults()
+
+    def _get(name, *default):
+        return getattr(conf.settings, 'FLAG_%s' % name,
+                       *(default or (defaults[name],)))
+
+    values = {}
+
+    # Set FLAG_ALLOW_COMMENTS to False in settings to not allow users to
+    # comment their flags (True by default)
+    values['ALLOW_COMMENTS'] = _get('ALLOW_COMMENTS')
+    # boolean stating whether an user needs to be trusted before being
+    # able to flag some content
+    values['NEEDS_TRUST'] = _get('NEEDS_TRUST')
+    # The number of days that a user must have created his account
+    # before he is allowed to flag content
+    values['TRUST_TIME'] = _get('TRUST_TIME')
+    # The function that evaluate if a user can be trusted or not
+    values['TRUST_EVAL_FUNC'] = _get('TRUST_EVAL_FUNC')
+    # The function that evaluate the trust of many users at once: it takes a list
+    # of user ids and returns a dict with the user ids as keys and the trust as
+    # values. If None, "flag.utils.evaluate_trust" is used with the default
+    # TRUST_EVAL_FUNC, else TRUST_EVAL_FUNC is called for each user
+    values['TRUST_BATCH_EVAL_FUNC'] = _get('TRUST_BATCH_EVAL_FUNC')
+    # The number of seconds the result of TRUST_EVAL_FUNC is kept for a user.
+    # The function can return a tuple (trusted, timeout) to set its own timeout
+    # If 0, the trust is evaluated on each flag
+    values['TRUST_CACHE_TIMEOUT'] = _get('TRUST_CACHE_TIMEOUT')
+    # The maximum number of users kept in the in-process trust cache (the least
+    # recently used are dropped first)
+    values['TRUST_CACHE_SIZE'] = _get('TRUST_CACHE_SIZE')
+    # The name of a cache defined in the CACHES setting to share the trust
+    # between processes. If None, only the in-process cache is used
+    values['TRUST_CACHE_BACKEND'] = _get('TRUST_CACHE_BACKEND')
+
+    # Set FLAG_LIMIT_SAME_OBJECT_FOR_USER to a number in settings to limit the
+    # times a user can flag a single object
+    # If 0, there is no limit
+    values['LIMIT_SAME_OBJECT_FOR_USER'] = _get('LIMIT_SAME_OBJECT_FOR_USER')
+
+    # Set FLAG_LIMIT_FOR_OBJECT to a number in settings to limit the times an
+    # object can be flagged
+    # If 0, there is no limit
+    values['LIMIT_FOR_OBJECT'] = _get('LIMIT_FOR_OBJECT')
+
+    # Set FLAG_MODELS to a list/tuple of models in your settings to limit the
+    # models that can be flagged. The syntax to use is a string for each model :
+    # FLAG_MODELS = ('myapp.mymodel', 'otherapp.othermodel',)
+    values['MODELS'] = _get('MODELS')
+
+    # Set FLAG_STATUSES to a list of tuples in your settings to set the available
+    # status for each flagged content
+    # The default status used when a user flag an object is the first of this list.
+    values['STATUSES'] = _get('STATUSES',
+                              _get('STATUS', defaults['STATUSES']))
+
+    # Set FLAG_DEFAULT_STATUS to ... the default status
+    values['DEFAULT_STATUS'] = _get('DEFAULT_STATUS')
+
+    # Set FLAG_SEND_MAILS to True if you want to have emails sent when object are
+    # flagged.
+    # See others settings FLAG_SEND_MAILS_* for more configuration
+    # The default is to not send mails
+    values['SEND_MAILS'] = _get('SEND_MAILS')
+
+    # Set FLAG_SEMD_MAILS_TO to a list of email addresses to sent mails when an
+    # object is flagged.
+    # Each entry can be either a single email address, or a tuple with (name, email
+    # address) but only the mail will be used
+    # The default is the ADMINS setting
+    values['SEND_MAILS_TO'] = _get('SEND_MAILS_TO')
+
+    # Set FLAG_SEND_MAILS_FROM to an email address to use as the send of mails
+    # sent when an object is flagged.
+    # Default to the DEFAULT_FROM_EMAIL setting
+    values['SEND_MAILS_FROM'] = _get('SEND_MAILS_FROM')
+
+    # Set FLAG_SEND_MAILS_RULES to define when to send mails for flags. This
+    # settings is a list of tuple, each line defining a rule. A rule is a tuple
+    # with two entries, the first one is the minimum flag for an object for which
+    # this rule apply, and the second one is the frequency : (4, 3) => if an
+    # object is flagged 4 times or more, send a mail every 3 flags (4, 7 and 10).
+    # If this rule is followed by (10, 5), it will be used only when number of
+    # flags is between 4 (included) and 10 (not included), then the "11" rules
+    # will apply.
+    # A mail will be send if the LIMIT_FOR_OBJECT is reached, ignoring the rules
+    # Default is to sent a mail for each flag
+    values['SEND_MAILS_RULES'] = _get('SEND_MAILS_RULES')
+
+    # Use FLAG_MODELS_SETTINGS if you want to override the global settings for a
+    # specific model.
+    # It's a dict with the string represetation of the model (`myapp.mymodel`) as
+    # key, and a dict as value. This last dict can have zero, one or more of the
+    # settings described in this module (excepted `MODELS` and of course
+    # `MODELS_SETTINGS`), using names WITHOUT the `FLAG_` prefix
+    # Default to an empty dict : each model will use the global settings
+    values['MODELS_SETTINGS'] = _get('MODELS_SETTINGS')
+
+    # Set FLAG_SECURITY_TIMESTAMP_BUCKET to a number of seconds: the timestamps of
+    # the flag forms are rounded down to a multiple of it, so the security hashes
+    # can be reused for an object (and rendered forms on a page share a lot)
+    # If 0 or 1, the exact timestamp is used (and nothing is shared)
+    values['SECURITY_TIMESTAMP_BUCKET'] = _get('SECURITY_TIMESTAMP_BUCKET')
+
+    # Set FLAG_CACHE_BACKEND to the name of a cache defined in the CACHES setting
+    # to use for the `*_cached` templatetags and filters
+    values['CACHE_BACKEND'] = _get('CACHE_BACKEND')
+
+    # Set FLAG_CACHE_TIMEOUT to the number of seconds the `*_cached` templatetags
+    # and filters keep their values. Rendered forms are never kept more than one
+    # hour, to stay in the validity window of their security hash
+    values['CACHE_TIMEOUT'] = _get('CACHE_TIMEOUT')
+
+    # Set FLAG_STATES_MAX_IDS to the maximum number of objects for which the
+    # `flag_states` view can return the flag state in one request
+    values['STATES_MAX_IDS'] = _get('STATES_MAX_IDS')
+
+    # Set FLAG_CONFIRM_TEMPLATE_VERSION to a new value each time you update the
+    # templates of the confirm page: it's part of the ETag of this page, so
+    # browsers will not keep using an old version
+    values['CONFIRM_TEMPLATE_VERSION'] = _get('CONFIRM_TEMPLATE_VERSION')
+
+    # Set FLAG_DB_POLICIES to True to use the per-model settings stored in the
+    # database (the FlagPolicy model), overriding FLAG_MODELS_SETTINGS
+    values['DB_POLICIES'] = _get('DB_POLICIES')
+
+    # Set FLAG_DB_POLICIES_INTERVAL to the number of seconds between two
+    # checks of the version of the policies stored in the database: it's the
+    # maximum time for a change to reach all processes
+    values['DB_POLICIES_INTERVAL'] = _get('DB_POLICIES_INTERVAL')
+
+    # Set FLAG_ADMIN_INSTANCES_PAGE_SIZE to the number of flags displayed by
+    # page in the admin page of a flagged content
+    values['ADMIN_INSTANCES_PAGE_SIZE'] = _get('ADMIN_INSTANCES_PAGE_SIZE')
+
+    # Set FLAG_ADMIN_EDITABLE_INSTANCES to True to have the flags editable (in
+    # an inline, all at once) in the admin page of a flagged content. Only
+    # use it if your objects are not flagged too many times
+    values['ADMIN_EDITABLE_INSTANCES'] = _get('ADMIN_EDITABLE_INSTANCES')
+
+    # Set FLAG_ADMIN_COUNT_THRESHOLD to the number of flagged contents above
+    # which the admin list uses estimates (given by the database) instead of
+    # counting them
+    values['ADMIN_COUNT_THRESHOLD'] = _get('ADMIN_COUNT_THRESHOLD')
+
+    # Set FLAG_ROLLUP_INLINE to True to update the daily rollups of flags each
+    # time a flag is added, instead of only with the `flag_rollup` command
+    values['ROLLUP_INLINE'] = _get('ROLLUP_INLINE')
+
+    # Set FLAG_ROLLUP_BATCH_SIZE to the maximum number of flags read at once
+    # (in one transaction) to update the daily rollups
+    values['ROLLUP_BATCH_SIZE'] = _get('ROLLUP_BATCH_SIZE')
+
+    # Set FLAG_ROLLUP_READ_DELAY to the number of seconds a flag must be old
+    # to be added to the rollups by the `flag_rollup` command
+    values['ROLLUP_READ_DELAY'] = _get('ROLLUP_READ_DELAY')
+
+    # Set FLAG_EVENTS to True to log the new flags and the changes of status
+    # and moderator of flagged contents in the FlagEvent table, for
+    # consumers following the changes (see `FlagEvent.objects.read_events`)
+    values['EVENTS'] = _get('EVENTS')
+
+    # Set FLAG_EVENTS_READ_DELAY to the number of seconds an event must be
+    # old to be read: events of transactions still running when a more recent
+    # one is read would be missed by consumers
+    values['EVENTS_READ_DELAY'] = _get('EVENTS_READ_DELAY')
+
+    # Set FLAG_WEBHOOKS to a list of endpoints to notify when a flagged
+    # content crosses a threshold of flags or when its status changes. Each
+    # endpoint is a dict with an `url`, and optionally a `secret` (to sign the
+    # body), the `events` to send ("threshold" and/or "status") and the
+    # `thresholds` (default to the FLAG_LIMIT_FOR_OBJECT setting). See
+    # `flag.webhooks`
+    values['WEBHOOKS'] = _get('WEBHOOKS')
+
+    # Set FLAG_WEBHOOKS_BATCH_SIZE to the maximum number of events sent in one
+    # request to an endpoint
+    values['WEBHOOKS_BATCH_SIZE'] = _get('WEBHOOKS_BATCH_SIZE')
 
-def get_for_model(model, name):
+    # Set FLAG_WEBHOOKS_BATCH_WAIT to the number of seconds to wait for other
+    # events to send with the first one
+    values['WEBHOOKS_BATCH_WAIT'] = _get('WEBHOOKS_BATCH_WAIT')
+
+    # Set FLAG_WEBHOOKS_TIMEOUT to the timeout (in seconds) of the requests to
+    # the endpoints
+    values['WEBHOOKS_TIMEOUT'] = _get('WEBHOOKS_TIMEOUT')
+
+    # Set FLAG_WEBHOOKS_MAX_RETRIES to the number of new attempts to send
+    # events to an endpoint which failed, before dropping them
+    values['WEBHOOKS_MAX_RETRIES'] = _get('WEBHOOKS_MAX_RETRIES')
+
+    # Set FLAG_WEBHOOKS_RETRY_DELAY to the number of seconds to wait before
+    # the first new attempt, doubled for each of the next ones
+    values['WEBHOOKS_RETRY_DELAY'] = _get('WEBHOOKS_RETRY_DELAY')
+
+    # Set FLAG_WEBHOOKS_QUEUE_SIZE to the maximum number of events waiting to
+    # be sent, new events are dropped (and logged) above it
+    values['WEBHOOKS_QUEUE_SIZE'] = _get('WEBHOOKS_QUEUE_SIZE')
+
+    # Set FLAG_DEFERRED_WORKERS to the number of threads running the deferred
+    # receivers of signals (see `flag.deferred`)
+    values['DEFERRED_WORKERS'] = _get('DEFERRED_WORKERS')
+
+    # Set FLAG_DEFERRED_QUEUE_SIZE to the maximum number of deferred receivers
+    # waiting to be run
+    values['DEFERRED_QUEUE_SIZE'] = _get('DEFERRED_QUEUE_SIZE')
+
+    # Set FLAG_DEFERRED_QUEUE_FULL to what to do with a deferred receiver when
+    # the queue is full: "inline" to run it in the thread sending the signal,
+    # or "drop" to forget it (it's counted, see `flag.deferred.get_stats`)
+    values['DEFERRED_QUEUE_FULL'] = _get('DEFERRED_QUEUE_FULL')
+
+    # Set FLAG_DEFERRED_DRAIN_TIMEOUT to the maximum number of seconds to wait
+    # for the deferred receivers to be run when the process exits
+    values['DEFERRED_DRAIN_TIMEOUT'] = _get('DEFERRED_DRAIN_TIMEOUT')
+
+    # Set FLAG_QUEUE to True to have the views only put the flags in a queue,
+    # to be added later, by batches, by the `flag_process_queue` command
+    values['QUEUE'] = _get('QUEUE')
+
+    # Set FLAG_QUEUE_BACKEND to the path of the class of the queue used by
+    # the queued mode (see `flag.ingestion.DatabaseQueue`)
+    values['QUEUE_BACKEND'] = _get('QUEUE_BACKEND')
+
+    # Set FLAG_QUEUE_BATCH_SIZE to the maximum number of queued flags added
+    # at once (in one transaction)
+    values['QUEUE_BATCH_SIZE'] = _get('QUEUE_BATCH_SIZE')
+
+    # Set FLAG_QUEUE_DUPLICATE_TIMEOUT to the number of seconds during which a
+    # user cannot queue another flag for the same object
+    values['QUEUE_DUPLICATE_TIMEOUT'] = _get('QUEUE_DUPLICATE_TIMEOUT')
+
+    # Set FLAG_SPOOL_PATH to the path of a local file where flags are written
+    # when the database is not available, to be added later by the
+    # `flag_replay_spool` command (see `flag.spool`)
+    values['SPOOL_PATH'] = _get('SPOOL_PATH')
+
+    # Set FLAG_SPOOL_FSYNC_INTERVAL to the maximum number of seconds between
+    # a write in the spool file and its sync on disk
+    values['SPOOL_FSYNC_INTERVAL'] = _get('SPOOL_FSYNC_INTERVAL')
+
+    # Set FLAG_SPOOL_CIRCUIT_TIMEOUT to the number of seconds during which
+    # flags are directly written in the spool file, without trying the
+    # database, after an error of the database
+    values['SPOOL_CIRCUIT_TIMEOUT'] = _get('SPOOL_CIRCUIT_TIMEOUT')
+
+    # Set FLAG_SPOOL_BATCH_SIZE to the maximum number of spooled flags added
+    # at once (in one transaction) by the `flag_replay_spool` command
+    values['SPOOL_BATCH_SIZE'] = _get('SPOOL_BATCH_SIZE')
+
+    # Set FLAG_SHARDED_COUNTS to True to count the flags of the most flagged
+    # contents in many rows (see `FlagCountShard`), to avoid the locks on
+    # their row
+    values['SHARDED_COUNTS'] = _get('SHARDED_COUNTS')
+
+    # Set FLAG_SHARDED_COUNTS_SHARDS to the number of rows used to count the
+    # flags of a sharded flagged content
+    values['SHARDED_COUNTS_SHARDS'] = _get('SHARDED_COUNTS_SHARDS')
+
+    # Set FLAG_SHARDED_COUNTS_RATE to the number of flags by second above
+    # which a flagged content is sharded
+    values['SHARDED_COUNTS_RATE'] = _get('SHARDED_COUNTS_RATE')
+
+    # Set FLAG_SHARDED_COUNTS_FOLD_INTERVAL to the minimum number of seconds
+    # between two updates of the `count` of a sharded flagged content with
+    # the counts of its shards
+    values['SHARDED_COUNTS_FOLD_INTERVAL'] = _get(
+            'SHARDED_COUNTS_FOLD_INTERVAL')
+
+    # do not send mails if no recipients
+    if values['SEND_MAILS'] and not values['SEND_MAILS_TO']:
+        values['SEND_MAILS'] = False
+
+    return values
+
+
+class FlagSettings(object):
     """
-    Try to get the `name` settings for a specific model.
-    See `utils.get_content_type_tuple` for description of the `name` parameter
-    The fallback in all case (all exceptions or simply no specific
-    settings) is the basic settings
+    The settings, read on first access (all at once), and then kept as
+    simple attributes
     """
-    from flag import settings as flag_settings
-    result = getattr(flag_settings, name)
-    if name not in _ONLY_GLOBAL_SETTINGS:
+    __all__ = __all__
+    _ONLY_GLOBAL_SETTINGS = _ONLY_GLOBAL_SETTINGS
+    _MODEL_SETTINGS = _MODEL_SETTINGS
+
+    def __init__(self, module):
+        # keep a reference to the module, else its globals are cleared
+        self.__dict__['_module'] = module
+        self.__dict__['generation'] = 0
+
+    @property
+    def _DEFAULTS(self):
+        return _get_defaults()
+
+    def __getattr__(self, name):
+        # only called if the attribute is not set: settings not yet read
+        if name.startswith('_') or not name.isupper():
+            raise AttributeError(name)
+        self._setup()
         try:
-            model_id = '%s.%s' % get_content_type_tuple(model)
-        except:
-            pass
-        else:
-            if name in MODELS_SETTINGS.get(model_id, {}):
-                result = MODELS_SETTINGS[model_id][name]
-    return result
+            return self.__dict__[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self.__dict__[name] = value
+        self.__dict__['generation'] += 1
+
+    def _setup(self):
+        """
+        Read the settings not already set
+        """
+        _connect_setting_changed()
+        for name, value in _read_settings().items():
+            self.__dict__.setdefault(name, value)
+
+    def invalidate(self):
+        """
+        Forget the settings, they will be read again on next access
+        """
+        for name in self.__dict__.keys():
+            if name.isupper():
+                del self.__dict__[name]
+        self.__dict__['generation'] += 1
+
+    def get_for_model(self, model, name):
+        """
+        Try to get the `name` settings for a specific model (from the
+        database if DB_POLICIES is True, else from MODELS_SETTINGS).
+        See `utils.get_content_type_tuple` for description of the `name`
+        parameter
+        The fallback in all case (all exceptions or simply no specific
+        settings) is the basic settings
+        """
+        from flag.utils import get_content_type_tuple
+        result = getattr(self, name)
+        if name not in _ONLY_GLOBAL_SETTINGS:
+            try:
+                model_id = '%s.%s' % get_content_type_tuple(model)
+            except:
+                pass
+            else:
+                if name in self.MODELS_SETTINGS.get(model_id, {}):
+                    result = self.MODELS_SETTINGS[model_id][name]
+                if self.DB_POLICIES:
+                    from flag import policies
+                    policy = policies.get_policies().get(model_id, {})
+                    if name in policy:
+                        result = policy[name]
+        return result
+
+
+def _setting_changed(sender, setting, **kwargs):
+    """
+    Signal receiver to read the settings again when one of them is updated
+    """
+    if setting.startswith('FLAG_') or \
+            setting in ('ADMINS', 'DEFAULT_FROM_EMAIL'):
+        sys.modules[__name__].invalidate()
+
+
+def _connect_setting_changed():
+    """
+    Connect the `setting_changed` signal, only when the settings are used, to
+    not import `django.test` in processes not using them
+    """
+    from django.test.signals import setting_changed
+    setting_changed.connect(_setting_changed,
+                            dispatch_uid='flag.settings.setting_changed')
+
+
+sys.modules[__name__] = FlagSettings(sys.modules[__name__])
@@ -1,4 +1,49 @@
+import threading
+
 from django.dispatch import Signal
 
-content_flagged = Signal(providing_args=["flagged_content",
-                                         "flagged_instance"])
+from flag import deferred
+
+
+class DeferredSignal(Signal):
+    """
+    Signal accepting "deferred" receivers (connected with `deferred=True`),
+    run by the pool of `flag.deferred` instead of in the thread sending the
+    signal. Other receivers are run as usual. Deferred receivers are kept
+    with strong references, and their responses are not returned by `send`
+    """
+
+    def __init__(self, providing_args=None):
+        super(DeferredSignal, self).__init__(providing_args)
+        self.deferred_receivers = []
+        self.deferred_lock = threading.Lock()
+
+    def connect(self, receiver, sender=None, weak=True, dispatch_uid=None,
+                deferred=False):
+        if not deferred:
+            return super(DeferredSignal, self).connect(receiver, sender,
+                                                       weak, dispatch_uid)
+        key = dispatch_uid or id(receiver)
+        with self.deferred_lock:
+            if key not in [entry[0] for entry in self.deferred_receivers]:
+                self.deferred_receivers.append((key, receiver, sender))
+
+    def disconnect(self, receiver=None, sender=None, weak=True,
+                   dispatch_uid=None):
+        key = dispatch_uid or id(receiver)
+        with self.deferred_lock:
+            self.deferred_receivers = [entry for entry in
+                    self.deferred_receivers if entry[0] != key]
+        return super(DeferredSignal, self).disconnect(receiver, sender, weak,
+                                                      dispatch_uid)
+
+    def send(self, sender, **named):
+        responses = super(DeferredSignal, self).send(sender, **named)
+        for key, receiver, receiver_sender in self.deferred_receivers:
+            if receiver_sender is None or receiver_sender is sender:
+                deferred.defer(receiver, signal=self, sender=sender, **named)
+        return responses
+
+
+content_flagged = DeferredSignal(providing_args=["flagged_content",
+                                                 "flagged_instance"])
@@ -0,0 +1,334 @@
+"""
+Spool of flags, used when the database is not available (only if the
+SPOOL_PATH setting is defined).
+When adding a flag (`FlagInstance.objects.add`) fails with a database error,
+the flag is written as a json line in the spool file, and, for the next
+SPOOL_CIRCUIT_TIMEOUT seconds, flags are directly written in the file,
+without waiting for the database. Writes are appended (atomically for
+concurrent processes), and synced on disk at most SPOOL_FSYNC_INTERVAL
+seconds later.
+The `flag_replay_spool` command (see `replay`) adds the spooled flags, by
+batches. The offset of the next record to replay is stored in the database
+(FlagSpoolCursor), in the transaction adding the flags, so a record is never
+added twice.
+"""
+
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, router, transaction
+from django.utils import timezone
+
+from flag import settings as flag_settings
+from flag import registry
+from flag.exceptions import FlagException
+from flag.ingestion import load_flags
+from flag.models import FlagInstance, FlagSpoolCursor
+from flag.utils import in_transaction
+
+__all__ = ('add_or_spool', 'write', 'open_circuit', 'is_circuit_open',
+           'replay')
+
+logger = logging.getLogger('flag.spool')
+
+# time until which the database is not used to add flags
+_circuit = dict(open_until=0)
+
+
+class SpoolFile(object):
+    """
+    The spool file of the current process, opened in append mode, and
+    opened again if it was moved (by `replay`)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.fd = None
+        self.path = None
+        self.last_sync = 0
+        self.timer = None
+
+    def _get_fd(self, path):
+        """
+        Return the descriptor of the file, opened again if the file at
+        `path` is not the opened one
+        """
+        if self.fd is not None:
+            try:
+                same = self.path == path and \
+                       os.stat(path).st_ino == os.fstat(self.fd).st_ino
+            except OSError:
+                same = False
+            if not same:
+                self._sync()
+                os.close(self.fd)
+                self.fd = None
+        if self.fd is None:
+            self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                              0640)
+            self.path = path
+        return self.fd
+
+    def _sync(self):
+        if self.fd is not None:
+            os.fsync(self.fd)
+        self.last_sync = time.time()
+
+    def _sync_later(self):
+        with self.lock:
+            self.timer = None
+            self._sync()
+
+    def write(self, path, line):
+        """
+        Append a line to the file, and sync it on disk now, or in less than
+        SPOOL_FSYNC_INTERVAL seconds
+        """
+        with self.lock:
+            os.write(self._get_fd(path), line)
+            delay = self.last_sync + flag_settings.SPOOL_FSYNC_INTERVAL - \
+                    time.time()
+            if delay <= 0:
+                self._sync()
+            elif self.timer is None:
+                self.timer = threading.Timer(delay, self._sync_later)
+                self.timer.daemon = True
+                self.timer.start()
+
+
+_file = SpoolFile()
+
+
+def open_circuit():
+    """
+    Stop using the database to add flags for SPOOL_CIRCUIT_TIMEOUT seconds
+    """
+    _circuit['open_until'] = time.time() + flag_settings.SPOOL_CIRCUIT_TIMEOUT
+
+
+def is_circuit_open():
+    """
+    Return True if flags must be spooled without trying the database
+    """
+    return time.time() < _circuit['open_until']
+
+
+def write(user, content_object, content_creator=None, comment=None,
+          status=None, idempotency_key=None):
+    """
+    Write a flag in the spool file, as a compact json record (`u`: user id,
+    `ct`: content type id, `o`: object id, `c`: creator id, `m`: comment,
+    `s`: status, `k`: idempotency key, `t`: timestamp), without the empty
+    values
+    """
+    record = dict(u=user.pk,
+                  ct=registry.get_for_model(content_object).content_type_id,
+                  o=content_object.pk,
+                  c=getattr(content_creator, 'pk', None),
+                  m=comment,
+                  s=status,
+                  k=idempotency_key or None,
+                  t=round(time.time(), 3))
+    record = dict((key, value) for key, value in record.items()
+                  if value is not None)
+    _file.write(flag_settings.SPOOL_PATH,
+                json.dumps(record, separators=(',', ':')) + '\n')
+
+
+def add_or_spool(add_func, user, content_object, content_creator, comment,
+                 status, send_signal, send_mails, trusted,
+                 idempotency_key=None):
+    """
+    Add the flag with `add_func`, in a transaction, or write it in the spool
+    file (and return None) if the database is not available. Integrity
+    errors are not availability errors: they are raised, not spooled.
+    The signal, mails and webhooks are sent after the commit, so a spooled
+    flag is only announced when it's replayed
+    """
+    if not is_circuit_open():
+        try:
+            with in_transaction(router.db_for_write(FlagInstance)):
+                flag_instance = add_func(user, content_object,
+                                         content_creator, comment, status,
+                                         send_signal, send_mails, trusted,
+                                         idempotency_key, notify=False)
+        except IntegrityError:
+            raise
+        except DatabaseError, e:
+            logger.warning('Database error, flags spooled for %ss: %s',
+                           flag_settings.SPOOL_CIRCUIT_TIMEOUT, e)
+            open_circuit()
+        else:
+            FlagInstance.objects.notify_added([flag_instance], send_signal,
+                                              send_mails)
+            return flag_instance
+    write(user, content_object, content_creator, comment, status,
+          idempotency_key)
+    return None
+
+
+def _get_when_added(timestamp):
+    """
+    Return the date of a record, from its timestamp
+    """
+    if settings.USE_TZ:
+        return datetime.utcfromtimestamp(timestamp).replace(
+                tzinfo=timezone.utc)
+    return datetime.fromtimestamp(timestamp)
+
+
+def _add_records(records):
+    """
+    Add the flags of the records, in the same order: runs of flags without
+    status are added with `FlagInstance.objects.add_grouped`. Their
+    `when_added` date is set to the one of the records.
+    Return the number of flags not added, and the results of `add_grouped`
+    (to send the signals and mails after the commit)
+    """
+    flags = load_flags([dict(user_id=record['u'],
+                             content_type_id=record['ct'],
+                             object_id=record['o'],
+                             creator_id=record.get('c'),
+                             comment=record.get('m'),
+                             idempotency_key=record.get('k'))
+                        for record in records])
+    failed, grouped, added = 0, [], []
+    for record, flag in zip(records, flags) + [(None, None)]:
+        if grouped and (record is None or record.get('s')):
+            results = FlagInstance.objects.add_grouped(
+                    [grouped_flag for grouped_record, grouped_flag
+                     in grouped],
+                    send_signal=True, send_mails=True, notify=False)
+            added.extend(results)
+            for (grouped_record, grouped_flag), result in zip(grouped,
+                                                               results):
+                if isinstance(result, FlagInstance) and result.pk:
+                    FlagInstance.objects.filter(pk=result.pk).update(
+                            when_added=_get_when_added(grouped_record['t']))
+                else:
+                    failed += 1
+            grouped = []
+        if record is None:
+            break
+        if flag['user'] is None or flag['content_object'] is None:
+            failed += 1
+        elif record.get('s'):
+            try:
+                result = FlagInstance.objects.add(
+                        flag['user'], flag['content_object'],
+                        flag['content_creator'], flag['comment'],
+                        record['s'], spool=False,
+                        idempotency_key=flag['idempotency_key'])
+            except FlagException:
+                failed += 1
+            else:
+                FlagInstance.objects.filter(pk=result.pk).update(
+                        when_added=_get_when_added(record['t']))
+        else:
+            grouped.append((record, flag))
+    return failed, added
+
+
+def _add_records_one_by_one(records, using):
+    """
+    Add the flags of the records one by one, each in a savepoint (used once
+    their batch failed): the ones failing are logged and ignored, so a
+    record always failing doesn't block the replay. Return the number of
+    flags not added, and the results (see `_add_records`)
+    """
+    failed, added = 0, []
+    for record in records:
+        sid = transaction.savepoint(using=using)
+        try:
+            record_failed, record_added = _add_records([record])
+        except Exception:
+            transaction.savepoint_rollback(sid, using=using)
+            logger.exception('Spooled flag ignored: %r', record)
+            failed += 1
+        else:
+            transaction.savepoint_commit(sid, using=using)
+            failed += record_failed
+            added.extend(record_added)
+    return failed, added
+
+
+def _replay_file(path, batch_size):
+    """
+    Add the flags of a spool file not already replayed, by batches. If a
+    batch fails, its flags are added one by one (see
+    `_add_records_one_by_one`). Return the number of replayed records
+    """
+    name = os.path.basename(path)
+    using = router.db_for_write(FlagInstance)
+    cursor, created = FlagSpoolCursor.objects.get_or_create(name=name)
+    offset, total = cursor.offset, 0
+    with open(path, 'rb') as spool_file:
+        spool_file.seek(offset)
+        while True:
+            lines = []
+            while len(lines) < batch_size:
+                line = spool_file.readline()
+                if not line.endswith('\n'):
+                    if line:
+                        logger.warning('Incomplete record ignored in %s',
+                                       path)
+                    break
+                lines.append(line)
+            if not lines:
+                break
+
+            records = []
+            for line in lines:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    logger.warning('Invalid record ignored in %s', path)
+            offset += sum(len(line) for line in lines)
+            try:
+                with in_transaction(using):
+                    failed, added = _add_records(records)
+                    FlagSpoolCursor.objects.filter(name=name).update(
+                            offset=offset)
+            except Exception:
+                logger.exception('Batch of spooled flags failed in %s, '
+                                 'added one by one', path)
+                with in_transaction(using):
+                    failed, added = _add_records_one_by_one(records, using)
+                    FlagSpoolCursor.objects.filter(name=name).update(
+                            offset=offset)
+            FlagInstance.objects.notify_added(added, send_signal=True,
+                                              send_mails=True)
+            if failed:
+                logger.info('%d spooled flags not added', failed)
+            total += len(lines)
+    return total
+
+
+def replay(batch_size=None, wait=1):
+    """
+    Move the spool file (new flags will be written in a new one), wait
+    `wait` seconds for the processes still writing in it, and add the flags
+    of all the moved files, by batches of `batch_size` (default to the
+    SPOOL_BATCH_SIZE setting). The files are removed once replayed.
+    Return the number of replayed records
+    """
+    path = flag_settings.SPOOL_PATH
+    batch_size = batch_size or flag_settings.SPOOL_BATCH_SIZE
+    if os.path.exists(path) and os.path.getsize(path):
+        os.rename(path, '%s.%017.6f' % (path, time.time()))
+        if wait:
+            time.sleep(wait)
+
+    total = 0
+    for moved_path in sorted(glob.glob('%s.*' % path)):
+        total += _replay_file(moved_path, batch_size)
+        os.remove(moved_path)
+        FlagSpoolCursor.objects.filter(
+                name=os.path.basename(moved_path)).delete()
+    return total
@@ -0,0 +1,2 @@
+-- index for the pagination of the flags of a flagged content in the admin
+CREATE INDEX flag_flaginstance_content_when_added ON flag_flaginstance (flagged_content_id, when_added, id);
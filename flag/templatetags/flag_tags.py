@@ -1,9 +1,17 @@
 from django import template
 from django.db.models import ObjectDoesNotExist
+from django.contrib.contenttypes.models import ContentType
+from django.template.loader import render_to_string
+from django.utils.html import escape
+from django.utils.translation import get_language
+
+from flag import cache as flag_cache
+from flag import settings as flag_settings
 
 from flag.forms import get_default_form
 from flag.views import get_next, get_confirm_url_for_object
 from flag.models import FlaggedContent
+from flag.profiling import profiled
 
 register = template.Library()
 
@@ -32,19 +40,82 @@ def flag_with_status(context, content_object, creator_field=None):
     return flag(context, content_object, creator_field, True)
 
 
+# markers for the values of each object in precompiled flag forms
+_FORM_MARKERS = dict(object_pk='__flag_object_pk__',
+                     timestamp='__flag_timestamp__',
+                     security_hash='__flag_security_hash__')
+
+
+def _get_form_fragment(context, content_object, creator_field, with_status,
+                       next):
+    """
+    Return a tuple with a form and the `flag/flag_form.html` template
+    rendered for this form, with markers in place of the values specific to
+    the object.
+    It's done once by request (or by template if we don't have the request)
+    for each model/creator_field/with_status/next combination
+    """
+    request = context.get('request', None)
+    if request is not None:
+        if not hasattr(request, '_flag_form_fragments'):
+            request._flag_form_fragments = {}
+        fragments = request._flag_form_fragments
+    else:
+        if '_flag_form_fragments' not in context.render_context:
+            context.render_context['_flag_form_fragments'] = {}
+        fragments = context.render_context['_flag_form_fragments']
+
+    key = (str(content_object._meta), creator_field, bool(with_status), next)
+    if key not in fragments:
+        form = get_default_form(content_object, creator_field, with_status)
+        form.initial.update(_FORM_MARKERS)
+        fragment_context = dict(form=form, next=next)
+        csrf_token = context.get('csrf_token', None)
+        if csrf_token is not None:
+            fragment_context['csrf_token'] = csrf_token
+        fragments[key] = (form,
+                          render_to_string("flag/flag_form.html",
+                                           fragment_context))
+    return fragments[key]
+
+
+@register.simple_tag(takes_context=True)
+def flag_fast(context, content_object, creator_field=None, with_status=False):
+    """
+    Work like the `flag` templatetag, but the template is rendered only once
+    for all the objects of the same model in a request: only the hidden
+    values specific to each object (pk, timestamp and security hash) are
+    replaced.
+    Use it on pages with many flag forms.
+    """
+    if not content_object:
+        return ''
+    request = context.get('request', None)
+    form, fragment = _get_form_fragment(context, content_object,
+            creator_field, with_status, get_next(request))
+    form.target_object = content_object
+    security_data = form.generate_security_data()
+    for name, marker in _FORM_MARKERS.items():
+        fragment = fragment.replace(marker, escape(security_data[name]))
+    return fragment
+
+
 @register.filter
+@profiled('flag_count')
 def flag_count(content_object):
     """
     This filter will return the number of flags for the given object
     Usage : {{ some_object|flag_count }}
     """
     try:
-        return FlaggedContent.objects.get_for_object(content_object).count
+        return FlaggedContent.objects.get_for_object(content_object)\
+                                    .get_count()
     except:
         return 0
 
 
 @register.filter
+@profiled('flag_status')
 def flag_status(content_object, full=False):
     """
     This filter will return the flag's status for the given object
@@ -62,6 +133,7 @@ def flag_status(content_object, full=False):
 
 
 @register.filter
+@profiled('can_be_flagged_by')
 def can_be_flagged_by(content_object, user):
     """
     This filter will return True if the given user can flag the given object.
@@ -72,6 +144,10 @@ def can_be_flagged_by(content_object, user):
     try:
         if not (user and user.is_active and user.is_authenticated()):
             return False
+        # use the `prefetch_flaggable_by` templatetag result if any
+        prefetched = getattr(content_object, '_flag_flaggable_by', {})
+        if user.pk in prefetched:
+            return prefetched[user.pk]
         if not FlaggedContent.objects.model_can_be_flagged(content_object):
             return False
         try:
@@ -85,6 +161,32 @@ def can_be_flagged_by(content_object, user):
         return False
 
 
+@register.simple_tag
+def prefetch_flaggable_by(objects, user):
+    """
+    This templatetag compute, in two queries, if the given user can flag
+    each of the given objects. The `can_be_flagged_by` filter will then use
+    the result instead of doing queries for each object.
+    Usage:
+        {% prefetch_flaggable_by some_objects request.user %}
+        {% for some_object in some_objects %}
+            {% if some_object|can_by_flagged_by:request.user %}...{% endif %}
+        {% endfor %}
+    """
+    try:
+        if not (user and user.is_active and user.is_authenticated()):
+            return ''
+        objects = list(objects)
+        flaggable = FlaggedContent.objects._flaggable_by(user, objects)
+    except:
+        return ''
+    for obj, result in zip(objects, flaggable):
+        if not hasattr(obj, '_flag_flaggable_by'):
+            obj._flag_flaggable_by = {}
+        obj._flag_flaggable_by[user.pk] = result
+    return ''
+
+
 @register.filter
 def flag_confirm_url(content_object, creator_field=None):
     """
@@ -114,3 +216,84 @@ def flag_confirm_url_with_status(content_object, creator_field=None):
         return get_confirm_url_for_object(content_object, creator_field, True)
     except:
         return ""
+
+
+# marker for the csrf token in cached flag forms
+_CSRF_MARKER = '__flag_csrf_token__'
+
+
+def _get_cached_value(kind, content_object, compute, parts=(), timeout=None):
+    """
+    Return the `kind` value for the object from the cache, using `compute`
+    to get it if not cached (or outdated).
+    `parts` are used to make the key unique for other things than the object
+    """
+    backend = flag_cache.get_backend()
+    content_type_id = ContentType.objects.get_for_model(content_object).id
+    key = flag_cache.make_key(kind, content_type_id, content_object.pk,
+                              *parts, backend=backend)
+    # values are stored in a tuple to be able to cache None
+    value = backend.get(key)
+    if value is None:
+        value = (compute(),)
+        backend.set(key, value, timeout or flag_settings.CACHE_TIMEOUT)
+    return value[0]
+
+
+@register.filter
+def flag_count_cached(content_object):
+    """
+    Cached version of the `flag_count` filter
+    Usage : {{ some_object|flag_count_cached }}
+    """
+    try:
+        return _get_cached_value('count', content_object,
+                                 lambda: flag_count(content_object))
+    except:
+        return 0
+
+
+@register.filter
+def flag_status_cached(content_object, full=False):
+    """
+    Cached version of the `flag_status` filter
+    Usage : {{ some_object|flag_status_cached }}
+    Or : {{ some_object|flag_status_cached:"text" }}
+    """
+    try:
+        parts = (bool(full), get_language() if full else None)
+        return _get_cached_value('status', content_object,
+                                 lambda: flag_status(content_object, full),
+                                 parts)
+    except:
+        return None
+
+
+@register.simple_tag(takes_context=True)
+def flag_cached(context, content_object, creator_field=None,
+                with_status=False):
+    """
+    Cached version of the `flag` templatetag: the rendered template is kept
+    in the cache (with a marker in place of the csrf token)
+    """
+    if not content_object:
+        return ''
+    next = get_next(context.get('request', None))
+    csrf_token = context.get('csrf_token', None)
+
+    def render():
+        form_context = flag(context, content_object, creator_field,
+                            with_status)
+        if csrf_token is not None:
+            form_context['csrf_token'] = _CSRF_MARKER
+        return render_to_string("flag/flag_form.html", form_context)
+
+    parts = (creator_field, bool(with_status), next, csrf_token is not None,
+             get_language())
+    # the security hash of the form must stay valid
+    timeout = min(flag_settings.CACHE_TIMEOUT, 3600)
+    output = _get_cached_value('form', content_object, render, parts,
+                               timeout)
+    if csrf_token is not None:
+        output = output.replace(_CSRF_MARKER, escape(csrf_token))
+    return output
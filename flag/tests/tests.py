@@ -6,17 +6,22 @@ import os
 from django.test import TestCase
 from django.contrib.auth.models import User, AnonymousUser
 from django.contrib.contenttypes.models import ContentType
-from django.db import IntegrityError
+from django.db import IntegrityError, DatabaseError
 from django.core.management import call_command
 from django.db.models import loading, ObjectDoesNotExist
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.http import HttpResponseRedirect
 from django.core import mail
+from django.core.cache import cache
+from django.core.paginator import EmptyPage
 
-from flag.models import FlaggedContent, FlagInstance, add_flag
+from flag.models import (FlaggedContent, FlagInstance, FlagCounter, FlagRollup,
+                         FlagEvent, FlagSpoolCursor, QueuedFlag, FlagCountShard,
+                         add_flag)
 from flag.tests.models import ModelWithoutAuthor, ModelWithAuthor
 from flag import settings as flag_settings
+from flag import deferred, ingestion, policies, spool, trust, webhooks
 from flag.exceptions import *
 from flag.signals import content_flagged
 from flag.templatetags import flag_tags
@@ -101,6 +106,9 @@ class BaseTestCase(TestCase):
                 for key in flag_settings.__all__)
         for key in flag_settings.__all__:
             setattr(flag_settings, key, flag_settings._DEFAULTS[key])
+        trust.clear()
+        policies.clear()
+        cache.clear()
 
     def tearDown(self):
         """
@@ -1344,3 +1352,2153 @@ class TrustedTestCase(BaseTestCaseWithData):
         self._test_flag_instance(self.model_with_author, True)
         flag_settings.TRUST_EVAL_FUNC = old_trust_eval_func
         reload(flag.models)  # force reimport
+
+
+class FlagProfilingTestCase(BaseTestCaseWithData):
+    """
+    Test the queries profiler and its middleware
+    """
+
+    def test_profiled_call_sites(self):
+        """
+        Test that queries are attributed to the innermost call site
+        """
+        from flag import profiling
+
+        self.assertEqual(profiling.stop(), {})
+
+        flagged_content = self._add_flagged_content(self.model_with_author)
+        self._add_flag(flagged_content, comment='comment')
+
+        profiling.start()
+        for i in range(3):
+            flag_tags.flag_count(self.model_with_author)
+        flagged_content.count_flags_by_user(self.user)
+        summary = profiling.stop()
+
+        self.assertFalse(profiling.is_active())
+        self.assertEqual(summary['flag_count']['calls'], 3)
+        self.assertEqual(summary['flag_count']['queries'], 0)
+        self.assertEqual(summary['get_for_object']['calls'], 3)
+        self.assertTrue(summary['get_for_object']['queries'] >= 3)
+        self.assertEqual(summary['count_flags_by_user']['queries'], 1)
+        self.assertTrue('flag_count: 3 calls'
+                        in profiling.format_summary(summary))
+
+    def test_middleware(self):
+        """
+        Test that the middleware only profiles when asked, and adds the
+        summary to the response
+        """
+        from django.test.client import RequestFactory
+        from django.http import HttpResponse
+        from flag.middleware import FlagQueryProfilerMiddleware
+
+        middleware = FlagQueryProfilerMiddleware()
+        factory = RequestFactory()
+
+        def process(request):
+            middleware.process_request(request)
+            flag_tags.flag_count(self.model_with_author)
+            return middleware.process_response(request, HttpResponse())
+
+        settings.DEBUG = False
+        request = factory.get('/')
+        request.user = self.user
+        self.assertFalse(middleware.response_header in process(request))
+
+        # header, but not staff
+        request = factory.get('/', HTTP_X_FLAG_PROFILE='1')
+        request.user = self.user
+        self.assertFalse(middleware.response_header in process(request))
+
+        # header and staff
+        request.user = self.staff_user
+        response = process(request)
+        self.assertTrue('get_for_object' in
+                        response[middleware.response_header])
+
+        # always in debug mode
+        settings.DEBUG = True
+        request = factory.get('/')
+        request.user = self.user
+        self.assertTrue(middleware.response_header in process(request))
+
+
+class TrustCacheTestCase(BaseTestCaseWithData):
+    """
+    Test the cache of the trust evaluation
+    """
+
+    def setUp(self):
+        super(TrustCacheTestCase, self).setUp()
+        self.calls = []
+
+    def _eval_func(self, result):
+        def eval_func(user):
+            self.calls.append(user.pk)
+            return result
+        return eval_func
+
+    def test_cache(self):
+        """
+        Test that the eval function is only called when needed
+        """
+        eval_func = self._eval_func(True)
+        self.assertTrue(trust.is_user_trusted(self.user, eval_func))
+        self.assertTrue(trust.is_user_trusted(self.user, eval_func))
+        self.assertEqual(self.calls, [self.user.pk])
+
+        # explicit invalidation
+        trust.invalidate(self.user)
+        self.assertTrue(trust.is_user_trusted(self.user, eval_func))
+        self.assertEqual(len(self.calls), 2)
+
+        # saving the user invalidates too
+        self.user.save()
+        self.assertTrue(trust.is_user_trusted(self.user, eval_func))
+        self.assertEqual(len(self.calls), 3)
+
+        # no cache
+        flag_settings.TRUST_CACHE_TIMEOUT = 0
+        trust.is_user_trusted(self.user, eval_func)
+        self.assertEqual(len(self.calls), 4)
+
+    def test_timeout_from_eval_func(self):
+        """
+        Test that the eval function can return its own timeout
+        """
+        eval_func = self._eval_func((False, 0))
+        self.assertFalse(trust.is_user_trusted(self.user, eval_func))
+        self.assertFalse(trust.is_user_trusted(self.user, eval_func))
+        self.assertEqual(len(self.calls), 2)
+
+        eval_func = self._eval_func((False, 60))
+        self.assertFalse(trust.is_user_trusted(self.user, eval_func))
+        self.assertFalse(trust.is_user_trusted(self.user, eval_func))
+        self.assertEqual(len(self.calls), 3)
+
+    def test_lru(self):
+        """
+        Test that the local cache is bounded
+        """
+        flag_settings.TRUST_CACHE_SIZE = 2
+        eval_func = self._eval_func(True)
+        for user in (self.user, self.author, self.staff_user, self.user):
+            trust.is_user_trusted(user, eval_func)
+        self.assertEqual(self.calls, [self.user.pk, self.author.pk,
+                                      self.staff_user.pk, self.user.pk])
+        self.assertEqual(len(trust._local_cache), 2)
+
+    def test_backend(self):
+        """
+        Test the shared cache
+        """
+        flag_settings.TRUST_CACHE_BACKEND = 'default'
+        eval_func = self._eval_func(True)
+        trust.is_user_trusted(self.user, eval_func)
+        # only the local cache is cleared
+        trust.clear()
+        trust.is_user_trusted(self.user, eval_func)
+        self.assertEqual(len(self.calls), 1)
+        trust.invalidate(self.user)
+        trust.is_user_trusted(self.user, eval_func)
+        self.assertEqual(len(self.calls), 2)
+        trust.invalidate(self.user)
+
+
+def dummy_batch_eval_trust(user_ids):
+    dummy_batch_eval_trust.calls.append(sorted(user_ids))
+    return dict((user_id, user_id % 2 == 0) for user_id in user_ids)
+dummy_batch_eval_trust.calls = []
+
+
+class BatchTrustTestCase(BaseTestCaseWithData):
+    """
+    Test the evaluation of the trust of many users at once
+    """
+
+    def setUp(self):
+        super(BatchTrustTestCase, self).setUp()
+        dummy_batch_eval_trust.calls = []
+        self.old_user = User.objects.create_user(
+                username='%s-old' % self.USER_BASE,
+                email='%s-old@example.com' % self.USER_BASE,
+                password=self.USER_BASE)
+        self.old_user.date_joined = datetime.now() - timedelta(
+                days=flag_settings.TRUST_TIME + 1)
+        self.old_user.save()
+
+    def test_evaluate_trust(self):
+        """
+        Test the default batch function
+        """
+        from flag.utils import evaluate_trust, can_user_be_trusted
+        result = evaluate_trust([self.user.pk, self.old_user.pk])
+        self.assertEqual(result, {self.user.pk: False,
+                                  self.old_user.pk: True})
+        for user in (self.user, self.old_user):
+            self.assertEqual(result[user.pk], can_user_be_trusted(user))
+
+    def test_are_users_trusted(self):
+        """
+        Test that only users not in cache are evaluated, all at once
+        """
+        flag_settings.TRUST_BATCH_EVAL_FUNC = \
+                'flag.tests.tests.dummy_batch_eval_trust'
+        users = [self.user, self.author, self.old_user]
+        result = trust.are_users_trusted(users, None)
+        self.assertEqual(result, dict((user.pk, user.pk % 2 == 0)
+                                      for user in users))
+        self.assertEqual(dummy_batch_eval_trust.calls,
+                         [sorted(user.pk for user in users)])
+
+        trust.invalidate(self.author)
+        self.assertEqual(trust.are_users_trusted(users, None), result)
+        self.assertEqual(dummy_batch_eval_trust.calls[1], [self.author.pk])
+
+        # single user evaluation uses the same cache
+        self.assertEqual(trust.is_user_trusted(self.user, None),
+                         result[self.user.pk])
+
+    def test_single_eval_func_fallback(self):
+        """
+        Test that a custom TRUST_EVAL_FUNC is used without batch function
+        """
+        calls = []
+
+        def eval_func(user):
+            calls.append(user.pk)
+            return user.pk == self.author.pk
+
+        result = trust.are_users_trusted([self.user, self.author], eval_func)
+        self.assertEqual(result, {self.user.pk: False, self.author.pk: True})
+        self.assertEqual(sorted(calls), sorted([self.user.pk, self.author.pk]))
+
+    def test_add_bulk(self):
+        """
+        Test that the trust is evaluated once for many flags
+        """
+        flag_settings.NEEDS_TRUST = True
+        results = FlagInstance.objects.add_bulk([
+            dict(user=self.user, content_object=self.model_with_author,
+                 comment='comment'),
+            dict(user=self.old_user, content_object=self.model_with_author,
+                 comment='comment'),
+            dict(user=self.old_user, content_object=self.model_without_author,
+                 comment='comment'),
+            dict(user=self.old_user, content_object=self.model_without_author),
+        ])
+        self.assertEqual(len(results), 4)
+        # the untrusted flag is not saved
+        self.assertEqual(results[0].pk, None)
+        self.assertTrue(results[1].pk)
+        self.assertTrue(results[2].pk)
+        # no comment
+        self.assertTrue(isinstance(results[3], FlagCommentException))
+        self.assertEqual(FlaggedContent.objects.get_for_object(
+                self.model_with_author).count, 1)
+
+
+class FlagFastFormTestCase(BaseTestCaseWithData):
+    """
+    Test the memoized security hashes and the `flag_fast` templatetag
+    """
+
+    def test_security_timestamp(self):
+        """
+        Test that the timestamp is rounded and the hash reused
+        """
+        from flag import forms as flag_forms
+
+        flag_settings.SECURITY_TIMESTAMP_BUCKET = 3600
+        self.assertEqual(flag_forms.get_security_timestamp() % 3600, 0)
+        flag_forms._security_hashes.clear()
+        form1 = get_default_form(self.model_with_author)
+        form2 = get_default_form(self.model_with_author)
+        self.assertEqual(form1['security_hash'].value(),
+                         form2['security_hash'].value())
+        self.assertEqual(len(flag_forms._security_hashes), 1)
+
+        # the form is still valid
+        data = dict((key, form1[key].value()) for key in form1.fields)
+        data['comment'] = 'comment'
+        self.assertTrue(FlagForm(self.model_with_author, data).is_valid())
+
+        flag_settings.SECURITY_TIMESTAMP_BUCKET = 0
+        self.assertTrue(flag_forms.get_security_timestamp() % 3600 >= 0)
+
+    def test_flag_fast(self):
+        """
+        Test that `flag_fast` renders the same thing as `flag`
+        """
+        from django.template import Template, Context
+
+        # avoid a timestamp change between the renderings
+        flag_settings.SECURITY_TIMESTAMP_BUCKET = 10 ** 9
+        objects = [self.model_without_author, ModelWithoutAuthor.objects.create(
+                name='baz'), self.model_with_author]
+
+        def render(tag):
+            return Template('{% load flag_tags %}{% for obj in objects %}'
+                            '{% ' + tag + ' obj %}{% endfor %}').render(
+                                Context(dict(objects=objects)))
+
+        self.assertEqual(render('flag_fast'), render('flag'))
+        self.assertEqual(render('flag_fast'), render('flag'))
+        self.assertEqual(flag_tags.flag_fast({}, None), '')
+
+
+class FlagCacheTestCase(BaseTestCaseWithData):
+    """
+    Test the versioned cache and the `*_cached` templatetags and filters
+    """
+
+    def test_versions(self):
+        """
+        Test that keys change when versions are bumped
+        """
+        from flag import cache as flag_cache
+        key = flag_cache.make_key('count', 1, 2)
+        self.assertEqual(key, flag_cache.make_key('count', 1, 2))
+        self.assertNotEqual(key, flag_cache.make_key('count', 1, 2, 'foo'))
+        self.assertNotEqual(key, flag_cache.make_key('count', 1, 3))
+        flag_cache.bump_version(1, 2)
+        self.assertNotEqual(key, flag_cache.make_key('count', 1, 2))
+        # works without existing version
+        cache.clear()
+        flag_cache.bump_version(1, 2)
+        self.assertNotEqual(key, flag_cache.make_key('count', 1, 2))
+
+    def test_cached_filters(self):
+        """
+        Test that the cached filters are invalidated when needed
+        """
+        obj = self.model_with_author
+        self.assertEqual(flag_tags.flag_count_cached(obj), 0)
+        self.assertEqual(flag_tags.flag_status_cached(obj), None)
+
+        # new flagged content
+        flagged_content = self._add_flagged_content(obj)
+        self.assertEqual(flag_tags.flag_status_cached(obj), 1)
+
+        # new flags
+        FlagInstance.objects.add(self.user, obj, comment='comment')
+        self.assertEqual(flag_tags.flag_count_cached(obj), 1)
+        FlagInstance.objects.add(self.user, obj, comment='comment')
+        self.assertEqual(flag_tags.flag_count_cached(obj), 2)
+
+        # really cached
+        FlaggedContent.objects.filter(id=flagged_content.id).update(count=10)
+        self.assertEqual(flag_tags.flag_count_cached(obj), 2)
+
+        # status change
+        flagged_content = FlaggedContent.objects.get_for_object(obj)
+        flagged_content.status = 2
+        flagged_content.save()
+        self.assertEqual(flag_tags.flag_status_cached(obj), 2)
+        self.assertEqual(unicode(flag_tags.flag_status_cached(obj, 'full')),
+                         unicode(flag_settings.STATUSES[1][1]))
+        self.assertEqual(flag_tags.flag_count_cached(obj), 10)
+
+        # deletion
+        flagged_content.delete()
+        self.assertEqual(flag_tags.flag_count_cached(obj), 0)
+        self.assertEqual(flag_tags.flag_status_cached(obj), None)
+
+    def test_flag_cached(self):
+        """
+        Test that the cached flag form keeps the csrf token of the request
+        """
+        from django.template import Template, Context
+
+        flag_settings.SECURITY_TIMESTAMP_BUCKET = 10 ** 9
+        template = Template('{% load flag_tags %}{% flag_cached obj %}')
+        template_not_cached = Template('{% load flag_tags %}{% flag obj %}')
+
+        for token in ('token1', 'token2'):
+            context = dict(obj=self.model_with_author, csrf_token=token)
+            output = template.render(Context(context))
+            self.assertTrue(token in output)
+            self.assertEqual(output,
+                             template_not_cached.render(Context(context)))
+
+        self.assertEqual(flag_tags.flag_cached({}, None), '')
+
+
+class FlaggableByTestCase(BaseTestCaseWithData):
+    """
+    Test the batch evaluation of `can_be_flagged_by`
+    """
+
+    def setUp(self):
+        super(FlaggableByTestCase, self).setUp()
+        self.objects = [self.model_without_author] + [
+            ModelWithoutAuthor.objects.create(name='obj-%d' % i)
+            for i in range(3)]
+        # warm the content types cache
+        ContentType.objects.get_for_model(ModelWithoutAuthor)
+
+    def _add(self, obj, user=None):
+        FlagInstance.objects.add(user or self.user, obj, comment='comment')
+
+    def _check(self, user=None):
+        """
+        Check that results are the same as the ones of the filter
+        """
+        user = user or self.user
+        # the user's flags are only counted if there is a limit
+        queries = 2 if flag_settings.LIMIT_SAME_OBJECT_FOR_USER else 1
+        with self.assertNumQueries(queries):
+            result = FlaggedContent.objects.flaggable_by(user, self.objects)
+        self.assertEqual(result, dict((obj.pk,
+            flag_tags.can_be_flagged_by(obj, user)) for obj in self.objects))
+        return result
+
+    def test_flaggable_by(self):
+        """
+        Test the `flaggable_by` manager method
+        """
+        self._add(self.objects[0])
+        self._add(self.objects[1])
+        self._add(self.objects[1], self.author)
+        result = self._check()
+        self.assertTrue(all(result.values()))
+
+        flag_settings.LIMIT_FOR_OBJECT = 2
+        result = self._check()
+        self.assertEqual([result[obj.pk] for obj in self.objects],
+                         [True, False, True, True])
+
+        flag_settings.LIMIT_FOR_OBJECT = 0
+        flag_settings.LIMIT_SAME_OBJECT_FOR_USER = 1
+        result = self._check()
+        self.assertEqual([result[obj.pk] for obj in self.objects],
+                         [False, False, True, True])
+        result = self._check(self.author)
+        self.assertEqual([result[obj.pk] for obj in self.objects],
+                         [True, False, True, True])
+
+        # not allowed model
+        flag_settings.MODELS = ('tests.modelwithauthor',)
+        self.assertFalse(any(FlaggedContent.objects.flaggable_by(
+            self.user, self.objects).values()))
+
+        # anonymous
+        self.assertFalse(any(FlaggedContent.objects.flaggable_by(
+            AnonymousUser(), self.objects).values()))
+
+    def test_prefetch_flaggable_by(self):
+        """
+        Test that the filter uses the prefetched data
+        """
+        flag_settings.LIMIT_SAME_OBJECT_FOR_USER = 1
+        self._add(self.objects[0])
+        self.assertEqual(flag_tags.prefetch_flaggable_by(self.objects,
+                                                         self.user), '')
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                [flag_tags.can_be_flagged_by(obj, self.user)
+                    for obj in self.objects],
+                [False, True, True, True])
+        self.assertEqual(flag_tags.prefetch_flaggable_by(self.objects,
+                                                         AnonymousUser()), '')
+
+
+class FlagJsonViewTestCase(BaseTestCaseWithData):
+    """
+    Test the json view to add flags
+    """
+
+    def _post(self, data):
+        import json
+        resp = self.client.post(reverse('flag_json'), data)
+        return resp.status_code, json.loads(resp.content)
+
+    def test_flag_json(self):
+        """
+        Test the `flag_json` view
+        """
+        form = get_default_form(self.model_without_author)
+        form_data = dict((key, form[key].value()) for key in form.fields)
+        form_data.update(dict(comment='comment'))
+
+        # not authenticated
+        status_code, result = self._post(copy(form_data))
+        self.assertEqual(status_code, 403)
+        self.assertEqual(result['error_code'], 'login_required')
+
+        self.client.login(username=self.user.username,
+                          password=self.USER_BASE)
+
+        # ok
+        status_code, result = self._post(copy(form_data))
+        self.assertEqual(status_code, 200)
+        self.assertEqual(result, dict(count=1, status=1, can_flag_again=True,
+                                      error_code=None))
+        self.assertEqual(FlagInstance.objects.count(), 1)
+
+        # limit raised
+        flag_settings.LIMIT_SAME_OBJECT_FOR_USER = 2
+        status_code, result = self._post(copy(form_data))
+        self.assertEqual(result, dict(count=2, status=1,
+                                      can_flag_again=False, error_code=None))
+        status_code, result = self._post(copy(form_data))
+        self.assertEqual(status_code, 400)
+        self.assertEqual(result['error_code'], 'already_flagged_by_user')
+        self.assertEqual(result['count'], 2)
+        flag_settings.LIMIT_SAME_OBJECT_FOR_USER = 0
+
+        # invalid form
+        data = copy(form_data)
+        del data['comment']
+        status_code, result = self._post(data)
+        self.assertEqual(result['error_code'], 'invalid_form')
+        self.assertTrue('comment' in result['errors'])
+
+        # bad security hash
+        data = copy(form_data)
+        data['security_hash'] = 'zz' + data['security_hash'][2:]
+        status_code, result = self._post(data)
+        self.assertEqual(result['error_code'], 'security')
+
+        # bad object
+        data = copy(form_data)
+        data['object_pk'] = 'foo'
+        status_code, result = self._post(data)
+        self.assertEqual(result['error_code'], 'bad_request')
+
+        # status by a non staff user
+        data = copy(form_data)
+        data['status'] = 2
+        status_code, result = self._post(data)
+        self.assertEqual(result['error_code'], 'only_staff_can_update_status')
+
+        # get
+        resp = self.client.get(reverse('flag_json'))
+        self.assertEqual(resp.status_code, 405)
+
+
+class FlagStatesViewTestCase(BaseTestCaseWithData):
+    """
+    Test the json view returning the flag state of many objects
+    """
+
+    def test_flag_states(self):
+        """
+        Test the `flag_states` view, and its conditional responses
+        """
+        import json
+
+        objects = [self.model_without_author] + [
+            ModelWithoutAuthor.objects.create(name='obj-%d' % i)
+            for i in range(3)]
+        FlagInstance.objects.add(self.user, objects[1], comment='comment')
+        FlagInstance.objects.add(self.author, objects[1], comment='comment')
+        FlagInstance.objects.add(self.author, objects[2], comment='comment')
+
+        url = reverse('flag_states', kwargs=dict(
+            app_label='tests', object_name='modelwithoutauthor'))
+        url += '?ids=' + ','.join(str(obj.pk) for obj in objects)
+
+        # anonymous
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        result = json.loads(resp.content)
+        self.assertEqual(result[str(objects[1].pk)],
+                         dict(count=2, status=1, can_flag=False))
+        self.assertEqual(result[str(objects[0].pk)],
+                         dict(count=0, status=None, can_flag=False))
+        self.assertEqual(self.client.get(url,
+                HTTP_IF_MODIFIED_SINCE=resp['Last-Modified']).status_code,
+                304)
+
+        # authenticated, with a limit
+        flag_settings.LIMIT_SAME_OBJECT_FOR_USER = 1
+        self.client.login(username=self.user.username,
+                          password=self.USER_BASE)
+        resp = self.client.get(url)
+        result = json.loads(resp.content)
+        self.assertEqual([result[str(obj.pk)]['can_flag'] for obj in objects],
+                         [True, False, True, True])
+        self.assertTrue('Cookie' in resp['Vary'])
+        # the date doesn't cover the user and the limits
+        self.assertFalse(resp.has_header('Last-Modified'))
+
+        # not modified
+        etag = resp['ETag']
+        resp = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 304)
+
+        # modified
+        FlagInstance.objects.add(self.author, objects[3], comment='comment')
+        resp = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp['ETag'], etag)
+
+        # bad requests
+        resp = self.client.get(url + ',foo')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get(reverse('flag_states', kwargs=dict(
+            app_label='tests', object_name='foo')))
+        self.assertEqual(resp.status_code, 400)
+        flag_settings.STATES_MAX_IDS = 2
+        resp = self.client.get(url)
+        self.assertEqual(json.loads(resp.content)['error_code'],
+                         'too_many_ids')
+
+
+class ConfirmViewConditionalTestCase(BaseTestCaseWithData):
+    """
+    Test the ETag and the 304 responses of the confirm view
+    """
+
+    def test_confirm_etag(self):
+        """
+        Test that the confirm page is not rendered again if the client
+        already has it, and only while nothing changed
+        """
+        flag_settings.LIMIT_SAME_OBJECT_FOR_USER = 2
+        url = reverse('flag_confirm', kwargs=dict(
+            app_label='tests', object_name='modelwithoutauthor',
+            object_id=self.model_without_author.pk))
+        self.client.login(username=self.user.username,
+                          password=self.USER_BASE)
+
+        resp = self.client.get(url + '?next=/foo/')
+        self.assertEqual(resp.status_code, 200)
+        etag = resp['ETag']
+        self.assertTrue('Cookie' in resp['Vary'])
+        self.assertFalse('Referer' in resp['Vary'])
+        self.assertTrue('private' in resp['Cache-Control'])
+
+        resp = self.client.get(url + '?next=/foo/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 304)
+
+        # another next url
+        resp = self.client.get(url + '?next=/bar/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 200)
+
+        # next from the referer
+        resp = self.client.get(url, HTTP_REFERER='/bar/')
+        self.assertTrue('Referer' in resp['Vary'])
+
+        # the object is flagged by another user
+        FlagInstance.objects.add(self.author, self.model_without_author,
+                                 comment='comment')
+        resp = self.client.get(url + '?next=/foo/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 200)
+        etag = resp['ETag']
+        resp = self.client.get(url + '?next=/foo/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 304)
+
+        # the object is flagged by the user
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment')
+        resp = self.client.get(url + '?next=/foo/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp['ETag'], etag)
+
+        # the user cannot flag anymore: redirect, without etag
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment')
+        resp = self.client.get(url + '?next=/foo/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 302)
+        self.assertFalse(resp.has_header('ETag'))
+
+        # a message is waiting: no etag
+        flag_settings.LIMIT_SAME_OBJECT_FOR_USER = 0
+        resp = self.client.get(url + '?next=/foo/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 200)
+        self.assertFalse(resp.has_header('ETag'))
+
+
+class RegistryTestCase(BaseTestCaseWithData):
+    """
+    Test the registry of models used by the views
+    """
+
+    def test_registry(self):
+        """
+        Test the entries of the registry, and that they follow the settings
+        """
+        from flag import registry
+
+        entry = registry.get('tests.modelwithauthor')
+        self.assertEqual(entry.model, ModelWithAuthor)
+        self.assertEqual(entry.content_type_id,
+                         ContentType.objects.get_for_model(ModelWithAuthor).id)
+        self.assertTrue(entry.allowed)
+        self.assertEqual(registry.get('tests.ModelWithAuthor'), entry)
+        self.assertEqual(registry.get_for_model(self.model_with_author),
+                         entry)
+        self.assertEqual(registry.get('tests.foo'), None)
+
+        flag_settings.MODELS = ('tests.modelwithoutauthor',)
+        flag_settings.MODELS_SETTINGS = {
+            'tests.modelwithauthor': dict(LIMIT_FOR_OBJECT=5)}
+        entry = registry.get('tests.modelwithauthor')
+        self.assertFalse(entry.allowed)
+        self.assertEqual(entry.policy['LIMIT_FOR_OBJECT'], 5)
+        self.assertTrue(registry.get('tests.modelwithoutauthor').allowed)
+
+    def test_get_content_object_queries(self):
+        """
+        Test that invalid content types are rejected without any query
+        """
+        get_content_object('tests.modelwithauthor', self.model_with_author.id)
+        with self.assertNumQueries(0):
+            self.assertTrue(isinstance(get_content_object('tests.foo', 1),
+                            FlagBadRequest))
+            self.assertTrue(isinstance(get_content_object('foobar', 1),
+                            FlagBadRequest))
+        with self.assertNumQueries(1):
+            self.assertEqual(get_content_object('tests.modelwithauthor',
+                                                self.model_with_author.id),
+                             self.model_with_author)
+
+    def test_content_types(self):
+        """
+        Test the content types kept by the registry, used by
+        `get_content_type_tuple` and `filter_for_model`
+        """
+        from flag import registry
+
+        content_type = ContentType.objects.get_for_model(ModelWithAuthor)
+        registry.get_tuple_for_id(content_type.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(registry.get_tuple_for_id(content_type.id),
+                             ('tests', 'modelwithauthor'))
+            self.assertEqual(registry.get_model_for_id(content_type.id),
+                             ModelWithAuthor)
+            self.assertEqual(registry.get_id_for_tuple('tests',
+                                                       'modelwithauthor'),
+                             content_type.id)
+            self.assertEqual(get_content_type_tuple(content_type.id),
+                             ('tests', 'modelwithauthor'))
+            self.assertEqual(get_content_type_tuple(str(content_type.id)),
+                             ('tests', 'modelwithauthor'))
+        self.assertEqual(registry.get_tuple_for_id(-1), None)
+
+        self.assertFalse('django_content_type' in str(
+            FlaggedContent.objects.filter_for_model(ModelWithAuthor).query))
+        self.assertEqual(len(FlaggedContent.objects.filter_for_model(
+            'tests.modelwithauthor')), 0)
+        FlagInstance.objects.add(self.user, self.model_with_author,
+                                 comment='comment')
+        self.assertEqual(list(FlaggedContent.objects.filter_for_model(
+            'tests.modelwithauthor', True)), [self.model_with_author.id])
+
+        # after a syncdb, the content types are loaded again
+        call_command('syncdb', interactive=False, verbosity=0)
+        self.assertEqual(registry._content_types['by_id'], None)
+
+
+class LazySettingsTestCase(BaseTestCase):
+    """
+    Test the settings object, read on first access and updated on changes
+    """
+
+    def test_settings_changes(self):
+        """
+        Test that the settings are read again when they are updated
+        """
+        from django.test.utils import override_settings
+
+        generation = flag_settings.generation
+        flag_settings.LIMIT_FOR_OBJECT = 2
+        self.assertEqual(flag_settings.LIMIT_FOR_OBJECT, 2)
+        self.assertTrue(flag_settings.generation > generation)
+
+        generation = flag_settings.generation
+        with override_settings(FLAG_LIMIT_FOR_OBJECT=3):
+            self.assertEqual(flag_settings.LIMIT_FOR_OBJECT, 3)
+            self.assertTrue(flag_settings.generation > generation)
+        self.assertEqual(flag_settings.LIMIT_FOR_OBJECT,
+                         getattr(settings, 'FLAG_LIMIT_FOR_OBJECT',
+                                 flag_settings._DEFAULTS['LIMIT_FOR_OBJECT']))
+
+        # settings not concerning flags are ignored
+        generation = flag_settings.generation
+        with override_settings(FOO_BAR=1):
+            self.assertEqual(flag_settings.generation, generation)
+
+        flag_settings.invalidate()
+        self.assertFalse('LIMIT_FOR_OBJECT' in flag_settings.__dict__)
+        self.assertEqual(flag_settings.MODELS,
+                         getattr(settings, 'FLAG_MODELS', None))
+        self.assertTrue('LIMIT_FOR_OBJECT' in flag_settings.__dict__)
+        self.assertRaises(AttributeError, getattr, flag_settings, 'FOO')
+
+    def test_trust_eval_func(self):
+        """
+        Test that the TRUST_EVAL_FUNC function is imported when needed
+        """
+        from flag.utils import can_user_be_trusted, evaluate_trust
+
+        self.assertEqual(trust.get_eval_func(), can_user_be_trusted)
+        flag_settings.TRUST_EVAL_FUNC = 'flag.utils.evaluate_trust'
+        self.assertEqual(trust.get_eval_func(), evaluate_trust)
+        flag_settings.TRUST_EVAL_FUNC = 'flag.utils.foo'
+        self.assertEqual(trust.get_eval_func(), can_user_be_trusted)
+
+
+class FlagPolicyTestCase(BaseTestCaseWithData):
+    """
+    Test the per-model settings stored in the database
+    """
+
+    def test_policies(self):
+        """
+        Test that policies override the settings, and are loaded again only
+        when their version changes
+        """
+        from flag.models import FlagPolicy, FlagPolicyVersion
+        from flag import registry
+
+        model_name = 'tests.modelwithauthor'
+        flag_settings.MODELS_SETTINGS = {model_name: dict(LIMIT_FOR_OBJECT=2)}
+        FlagPolicy.objects.create(model=model_name,
+                                  settings='{"LIMIT_FOR_OBJECT": 3}')
+
+        # not used by default
+        self.assertEqual(flag_settings.get_for_model(model_name,
+                                                     'LIMIT_FOR_OBJECT'), 2)
+
+        flag_settings.DB_POLICIES = True
+        self.assertEqual(flag_settings.get_for_model(model_name,
+                                                     'LIMIT_FOR_OBJECT'), 3)
+        self.assertEqual(flag_settings.get_for_model('tests.modelwithoutauthor',
+                                                     'LIMIT_FOR_OBJECT'), 0)
+        self.assertEqual(registry.get(model_name).policy['LIMIT_FOR_OBJECT'],
+                         3)
+
+        # saved in this process: seen at once
+        FlagPolicy.objects.filter(model=model_name).get().delete()
+        self.assertEqual(flag_settings.get_for_model(model_name,
+                                                     'LIMIT_FOR_OBJECT'), 2)
+
+        # saved by another process: seen after the interval
+        FlagPolicy.objects.filter(model=model_name).update(
+                settings='{"LIMIT_FOR_OBJECT": 4}')
+        FlagPolicy.objects.create(model=model_name,
+                                  settings='{"LIMIT_FOR_OBJECT": 4}')
+        self.assertEqual(flag_settings.get_for_model(model_name,
+                                                     'LIMIT_FOR_OBJECT'), 4)
+        FlagPolicy.objects.filter(model=model_name).update(
+                settings='{"LIMIT_FOR_OBJECT": 5}')
+        FlagPolicyVersion.bump()
+        with self.assertNumQueries(0):
+            self.assertEqual(flag_settings.get_for_model(model_name,
+                                                     'LIMIT_FOR_OBJECT'), 4)
+        flag_settings.DB_POLICIES_INTERVAL = 0
+        self.assertEqual(flag_settings.get_for_model(model_name,
+                                                     'LIMIT_FOR_OBJECT'), 5)
+        self.assertEqual(registry.get(model_name).policy['LIMIT_FOR_OBJECT'],
+                         5)
+
+    def test_validation(self):
+        """
+        Test the validation of the settings of a policy
+        """
+        from django.core.exceptions import ValidationError
+        from flag.models import FlagPolicy, FlagPolicyVersion
+
+        policy = FlagPolicy(model='tests.modelwithauthor')
+        for value in ('foo', '[1]', '{"MODELS": null}', '{"FOO": 1}',
+                      '{"CACHE_BACKEND": "default"}', '{"QUEUE": true}'):
+            policy.settings = value
+            self.assertRaises(ValidationError, policy.clean)
+        policy.settings = '{"NEEDS_TRUST": true, "SEND_MAILS_RULES": [[1, 2]]}'
+        self.assertNotRaises(policy.clean)
+
+        for model in ('tests.unknown', 'tests', ''):
+            policy.model = model
+            self.assertRaises(ValidationError, policy.clean)
+
+        FlagPolicyVersion.bump()
+        FlagPolicyVersion.bump()
+        self.assertEqual(FlagPolicyVersion.objects.get().version, 2)
+
+
+class ContentObjectsPrefetchTestCase(BaseTestCaseWithData):
+    """
+    Test the loading of the content objects of many flagged contents at once
+    """
+
+    def test_with_content_objects(self):
+        """
+        Test that content objects, creators and moderators are loaded with
+        one query by content type, and one for the users
+        """
+        objects = [self.model_with_author, self.model_without_author] + [
+            ModelWithoutAuthor.objects.create(name='obj-%d' % i)
+            for i in range(5)]
+        for obj in objects:
+            FlagInstance.objects.add(self.user, obj, self.author,
+                                     comment='comment')
+        FlaggedContent.objects.filter(
+            id=FlaggedContent.objects.get_for_object(
+                self.model_without_author).id).update(
+                    moderator=self.staff_user)
+
+        # content types are loaded once by the registry
+        from flag import registry
+        registry.get_model_for_id(ContentType.objects.get_for_model(
+            ModelWithAuthor).id)
+
+        with self.assertNumQueries(4):
+            flagged_contents = list(
+                FlaggedContent.objects.with_content_objects())
+            self.assertEqual(len(flagged_contents), len(objects))
+            self.assertEqual(
+                set(flagged_content.content_object
+                    for flagged_content in flagged_contents),
+                set(objects))
+            for flagged_content in flagged_contents:
+                self.assertEqual(flagged_content.creator, self.author)
+                if flagged_content.content_object == self.model_without_author:
+                    self.assertEqual(flagged_content.moderator,
+                                     self.staff_user)
+                else:
+                    self.assertEqual(flagged_content.moderator, None)
+
+        # chained, and with hints
+        with self.assertNumQueries(3):
+            flagged_contents = list(FlaggedContent.objects.filter(
+                status=1).with_content_objects({
+                    'tests.modelwithauthor': ('author',),
+                    'tests.modelwithoutauthor': True}).filter(
+                        content_type=ContentType.objects.get_for_model(
+                            ModelWithAuthor)))
+            self.assertEqual(flagged_contents[0].content_object,
+                             self.model_with_author)
+        with self.assertNumQueries(0):
+            flagged_contents[0].content_object.author
+
+        # missing object
+        FlaggedContent.objects.filter(id=flagged_contents[0].id).update(
+            object_id=10000)
+        self.assertEqual(FlaggedContent.objects.with_content_objects().get(
+            id=flagged_contents[0].id).content_object, None)
+
+
+class FlagInstancesAdminTestCase(BaseTestCaseWithData):
+    """
+    Test the pages of flags in the admin page of a flagged content
+    """
+
+    def _add_flags(self, count):
+        """
+        Add `count` flags on the same object, half of them with the same date
+        """
+        for i in range(count):
+            flag_instance = FlagInstance.objects.add(
+                    self.user if i % 3 else self.author,
+                    self.model_without_author, comment='flag-%d' % i,
+                    status=1 if i % 4 else 2)
+        flagged_content = flag_instance.flagged_content
+        when = datetime.now().replace(microsecond=0)
+        flagged_content.flag_instances.filter(
+            id__in=list(flagged_content.flag_instances.order_by('id')\
+                .values_list('id', flat=True)[:count / 2])).update(
+                    when_added=when)
+        return flagged_content
+
+    def test_get_page(self):
+        """
+        Test the keyset pagination of the flags of a flagged content
+        """
+        flagged_content = self._add_flags(11)
+        expected = list(flagged_content.flag_instances.order_by(
+            '-when_added', '-id'))
+
+        result, after = [], None
+        while True:
+            with self.assertNumQueries(1):
+                flag_instances, after = FlagInstance.objects.get_page(
+                        flagged_content, after, size=3)
+                [flag_instance.user for flag_instance in flag_instances]
+            result.extend(flag_instances)
+            if after is None:
+                break
+        self.assertEqual(result, expected)
+        self.assertRaises(ValueError, FlagInstance.objects.get_page,
+                          flagged_content, 'foo', 3)
+
+    def test_get_summary(self):
+        """
+        Test the summary of the flags of a flagged content
+        """
+        flagged_content = self._add_flags(12)
+        with self.assertNumQueries(2):
+            summary = FlagInstance.objects.get_summary(flagged_content,
+                                                       top=1)
+        self.assertEqual(summary['total'], 12)
+        self.assertEqual(summary['by_status'], {1: 9, 2: 3})
+        self.assertEqual(summary['top_flaggers'], [(self.user, 8)])
+
+    def test_admin_views(self):
+        """
+        Test the change page of a flagged content, and the view to load the
+        next pages of flags
+        """
+        flagged_content = self._add_flags(5)
+        flag_settings.ADMIN_INSTANCES_PAGE_SIZE = 2
+        self.staff_user.is_superuser = True
+        self.staff_user.save()
+        self.client.login(username=self.staff_user.username,
+                          password=self.USER_BASE)
+
+        resp = self.client.get(reverse('admin:flag_flaggedcontent_change',
+                                       args=(flagged_content.id,)))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.context['flag_summary']['total'], 5)
+        self.assertEqual(len(resp.context['flag_instances']), 2)
+        self.assertFalse('flag_instances-TOTAL_FORMS' in resp.content)
+        next_cursor = resp.context['next_cursor']
+
+        url = reverse('admin:flag_flaggedcontent_instances',
+                      args=(flagged_content.id,))
+        resp = self.client.get(url, dict(after=next_cursor))
+        self.assertEqual(len(resp.context['flag_instances']), 2)
+        self.assertTrue('flag-more' in resp.content)
+        resp = self.client.get(url, dict(after=resp.context['next_cursor']))
+        self.assertEqual(len(resp.context['flag_instances']), 1)
+        self.assertFalse('flag-more' in resp.content)
+
+        # editable flags
+        flag_settings.ADMIN_EDITABLE_INSTANCES = True
+        resp = self.client.get(reverse('admin:flag_flaggedcontent_change',
+                                       args=(flagged_content.id,)))
+        self.assertTrue('flag_instances-TOTAL_FORMS' in resp.content)
+        self.assertFalse('flag_summary' in resp.context)
+
+
+class ApproximateCountTestCase(BaseTestCaseWithData):
+    """
+    Test the approximate counts in the admin list of flagged contents
+    """
+
+    def _get_paginator(self, estimate, exact=False):
+        """
+        Return an ApproximatePaginator for all the flagged contents, with the
+        given estimated count
+        """
+        from flag.admin import ApproximatePaginator
+
+        class FixedPaginator(ApproximatePaginator):
+            def estimate_count(self):
+                return estimate
+
+        return FixedPaginator(FlaggedContent.objects.all(), 10, exact=exact)
+
+    def test_paginator(self):
+        """
+        Test the use of the estimate by the paginator
+        """
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment="comment")
+        flag_settings.ADMIN_COUNT_THRESHOLD = 1000
+
+        # below the threshold: counted
+        paginator = self._get_paginator(100)
+        self.assertEqual(paginator.count, 1)
+        self.assertFalse(paginator.approximate)
+
+        # no estimate: counted
+        paginator = self._get_paginator(None)
+        self.assertEqual(paginator.count, 1)
+        self.assertFalse(paginator.approximate)
+
+        # above the threshold: estimated, without query
+        paginator = self._get_paginator(5000)
+        with self.assertNumQueries(0):
+            self.assertEqual(paginator.count, 5000)
+        self.assertTrue(paginator.approximate)
+        self.assertEqual(paginator.num_pages, 500)
+
+        # exact count asked
+        paginator = self._get_paginator(5000, exact=True)
+        self.assertEqual(paginator.count, 1)
+        self.assertFalse(paginator.approximate)
+
+    def test_paginator_empty_page(self):
+        """
+        Test that a page out of the exact count, but not out of the estimated
+        one, is checked again with the exact count
+        """
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment="comment")
+        flag_settings.ADMIN_COUNT_THRESHOLD = 1000
+        paginator = self._get_paginator(5000)
+        self.assertEqual(len(paginator.page(1).object_list), 1)
+        self.assertRaises(EmptyPage, paginator.page, 2)
+        self.assertEqual(paginator.count, 1)
+        self.assertFalse(paginator.approximate)
+
+    def test_changelist(self):
+        """
+        Test the admin list of flagged contents, with and without the exact
+        count parameter
+        """
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment="comment")
+        self.staff_user.is_superuser = True
+        self.staff_user.save()
+        self.client.login(username=self.staff_user.username,
+                          password=self.USER_BASE)
+        url = reverse('admin:flag_flaggedcontent_changelist')
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.context['cl'].result_count, 1)
+        self.assertFalse(resp.context['cl'].approximate_count)
+
+        resp = self.client.get(url, {'_exact_count': 1, 'status': 1})
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.context['cl'].exact_count)
+        self.assertEqual(resp.context['cl'].result_count, 1)
+
+
+class FlagCounterTestCase(BaseTestCaseWithData):
+    """
+    Test the counters of flagged contents by content type and status
+    """
+
+    def test_counters(self):
+        """
+        Test that the counters follow the creations, status changes and
+        deletions of flagged contents
+        """
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment')
+        FlagInstance.objects.add(self.user, self.model_with_author,
+                                 comment='comment')
+        with self.assertNumQueries(1):
+            self.assertEqual(FlaggedContent.objects.count_by_status(), {1: 2})
+        self.assertEqual(FlaggedContent.objects.count_by_status(
+                self.model_with_author), {1: 1})
+        self.assertEqual(FlaggedContent.objects.count_by_status(
+                'auth.user'), {})
+
+        # status change
+        FlagInstance.objects.add(self.staff_user, self.model_with_author,
+                                 comment='comment', status=2)
+        self.assertEqual(FlaggedContent.objects.count_by_status(), {1: 1, 2: 1})
+        self.assertEqual(FlaggedContent.objects.count_by_status(
+                ModelWithAuthor), {1: 0, 2: 1})
+
+        # a new flag doesn't change the status
+        FlagInstance.objects.add(self.author, self.model_with_author,
+                                 comment='comment')
+        self.assertEqual(FlaggedContent.objects.count_by_status(), {1: 1, 2: 1})
+
+        # deletion
+        FlaggedContent.objects.get_for_object(self.model_with_author).delete()
+        self.assertEqual(FlaggedContent.objects.count_by_status(), {1: 1, 2: 0})
+
+    def test_rebuild(self):
+        """
+        Test the rebuild of the counters, after updates made without the
+        `save` method
+        """
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment')
+        FlagInstance.objects.add(self.user, self.model_with_author,
+                                 comment='comment')
+        FlaggedContent.objects.filter(id=FlaggedContent.objects.get_for_object(
+                self.model_with_author).id).update(status=3)
+        self.assertEqual(FlaggedContent.objects.count_by_status(), {1: 2})
+
+        FlagCounter.objects.rebuild()
+        self.assertEqual(FlaggedContent.objects.count_by_status(), {1: 1, 3: 1})
+
+        FlagCounter.objects.all().delete()
+        call_command('flag_rebuild_counters', verbosity=0)
+        self.assertEqual(FlaggedContent.objects.count_by_status(), {1: 1, 3: 1})
+
+    def test_changelist(self):
+        """
+        Test that the admin list of flagged contents uses the counters when
+        it's only filtered by status
+        """
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment')
+        FlagInstance.objects.add(self.user, self.model_with_author,
+                                 comment='comment', status=2)
+        self.staff_user.is_superuser = True
+        self.staff_user.save()
+        self.client.login(username=self.staff_user.username,
+                          password=self.USER_BASE)
+        url = reverse('admin:flag_flaggedcontent_changelist')
+
+        # wrong counters, to see where the counts come from
+        FlagCounter.objects.filter(status=2).update(count=7)
+
+        resp = self.client.get(url, {'status': 2})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.context['cl'].result_count, 7)
+        self.assertEqual(resp.context['cl'].full_result_count, 8)
+        self.assertEqual(len(resp.context['cl'].result_list), 1)
+        self.assertTrue('(7)' in resp.content)
+
+        # exact counts
+        resp = self.client.get(url, {'status': 2, '_exact_count': 1})
+        self.assertEqual(resp.context['cl'].result_count, 1)
+        self.assertEqual(resp.context['cl'].full_result_count, 2)
+
+        # other filters
+        resp = self.client.get(url, {'status': 2, 'count__gte': 0})
+        self.assertEqual(resp.context['cl'].result_count, 1)
+
+
+    def test_status_filter(self):
+        """
+        Test that the status filter of the admin has the statuses of the
+        models, and the ones used
+        """
+        from flag.admin import StatusListFilter
+        flag_settings.MODELS_SETTINGS = {
+            'tests.modelwithauthor': {
+                'STATUSES': list(flag_settings.STATUSES) + [(9, 'custom')]}}
+        FlagInstance.objects.add(self.user, self.model_with_author,
+                                 comment='comment')
+        flagged_content = FlaggedContent.objects.get()
+        flagged_content.status = 9
+        flagged_content.save()
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment')
+        FlaggedContent.objects.filter(id=flagged_content.id).update(status=8)
+        FlagCounter.objects.rebuild()
+
+        lookups = dict(StatusListFilter(None, {}, FlaggedContent,
+                                        None).lookup_choices)
+        self.assertEqual(lookups['9'], 'custom (0)')
+        self.assertEqual(lookups['8'], '8 (1)')
+        self.assertEqual(lookups['1'][-3:], '(1)')
+
+
+class FlagRollupTestCase(BaseTestCaseWithData):
+    """
+    Test the daily rollups of flags
+    """
+
+    def _add_flags(self):
+        """
+        Add flags on the two objects, one of them yesterday, and return the
+        days of today and yesterday
+        """
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment')
+        FlagInstance.objects.add(self.user, self.model_with_author,
+                                 comment='comment')
+        flag_instance = FlagInstance.objects.add(self.author,
+                self.model_with_author, comment='comment', status=2)
+        yesterday = datetime.now() - timedelta(days=1)
+        FlagInstance.objects.filter(id=flag_instance.id).update(
+                when_added=yesterday)
+        return datetime.now().date(), yesterday.date()
+
+    def test_process(self):
+        """
+        Test that only new flags are processed, and the series returned
+        """
+        today, yesterday = self._add_flags()
+        # the flags of today are too recent
+        self.assertEqual(FlagRollup.objects.process(), 0)
+        flag_settings.ROLLUP_READ_DELAY = 0
+        self.assertEqual(FlagRollup.objects.process(batch_size=2), 3)
+        self.assertEqual(FlagRollup.objects.process(), 0)
+
+        self.assertEqual(FlagRollup.objects.get_series(),
+                         [(yesterday, 1), (today, 2)])
+        self.assertEqual(FlagRollup.objects.get_series(status=1),
+                         [(today, 2)])
+        self.assertEqual(FlagRollup.objects.get_series(ModelWithAuthor),
+                         [(yesterday, 1), (today, 1)])
+        self.assertEqual(FlagRollup.objects.get_series(
+                'tests.modelwithauthor', since=today), [(today, 1)])
+        self.assertEqual(FlagRollup.objects.get_series(until=yesterday),
+                         [(yesterday, 1)])
+        self.assertEqual(FlagRollup.objects.get_series('auth.user'), [])
+
+        # a new flag
+        FlagInstance.objects.add(self.author, self.model_without_author,
+                                 comment='comment')
+        call_command('flag_rollup', verbosity=0)
+        self.assertEqual(FlagRollup.objects.get_series(),
+                         [(yesterday, 1), (today, 3)])
+
+    def test_inline(self):
+        """
+        Test the update of the rollups when a flag is added
+        """
+        flag_settings.ROLLUP_INLINE = True
+        today, yesterday = self._add_flags()
+        # the last flag was processed before being moved to yesterday
+        self.assertEqual(FlagRollup.objects.get_series(), [(today, 3)])
+        self.assertEqual(FlagRollup.objects.get_series(status=2),
+                         [(today, 1)])
+        # the command only moves the cursor
+        self.assertEqual(FlagRollup.objects.process(delay=0), 3)
+        self.assertEqual(FlagRollup.objects.get_series(), [(today, 3)])
+
+
+class FlagEventTestCase(BaseTestCaseWithData):
+    """
+    Test the log of flag events
+    """
+
+    def setUp(self):
+        super(FlagEventTestCase, self).setUp()
+        flag_settings.EVENTS = True
+        flag_settings.EVENTS_READ_DELAY = 0
+
+    def test_events(self):
+        """
+        Test the events logged for new flags and changes of flagged contents
+        """
+        flag_instance = FlagInstance.objects.add(self.user,
+                self.model_with_author, comment='comment')
+        flagged_content = flag_instance.flagged_content
+        FlagInstance.objects.add(self.staff_user, self.model_with_author,
+                                 comment='comment', status=2)
+        flagged_content = FlaggedContent.objects.get(id=flagged_content.id)
+        flagged_content.moderator = self.author
+        flagged_content.save()
+        flagged_content.save()
+
+        events = [event.as_dict() for event in
+                  FlagEvent.objects.read_events()]
+        self.assertEqual([event['kind'] for event in events],
+                         ['flag', 'status', 'flag', 'moderator'])
+        self.assertEqual(events[0]['flag'], flag_instance.id)
+        self.assertEqual(events[0]['user'], self.user.id)
+        self.assertEqual(events[0]['content_type'], 'tests.modelwithauthor')
+        self.assertEqual(events[0]['object_id'], self.model_with_author.id)
+        self.assertEqual(events[1]['status'], 2)
+        self.assertEqual(events[1]['previous'], 1)
+        self.assertEqual(events[1]['moderator'], self.staff_user.id)
+        self.assertEqual(events[3]['moderator'], self.author.id)
+        self.assertEqual(events[3]['previous'], self.staff_user.id)
+
+        # follow the events
+        first = FlagEvent.objects.read_events(limit=2)
+        self.assertEqual(len(first), 2)
+        self.assertEqual([event.id for event in
+                          FlagEvent.objects.read_events(first[-1].id)],
+                         [event['id'] for event in events[2:]])
+
+        # recent events
+        self.assertEqual(FlagEvent.objects.read_events(delay=60), [])
+
+        # no events
+        flag_settings.EVENTS = False
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment')
+        self.assertEqual(FlagEvent.objects.count(), 4)
+
+    def test_command(self):
+        """
+        Test the command writing the events as json lines
+        """
+        from StringIO import StringIO
+        import json
+
+        for user in (self.user, self.author, self.staff_user):
+            FlagInstance.objects.add(user, self.model_without_author,
+                                     comment='comment')
+        first_id = FlagEvent.objects.read_events()[0].id
+
+        out = StringIO()
+        call_command('flag_events', stdout=out)
+        lines = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(len(lines), 3)
+        self.assertEqual([line['user'] for line in lines],
+                         [self.user.id, self.author.id, self.staff_user.id])
+
+        out = StringIO()
+        call_command('flag_events', after=first_id, limit=1, stdout=out)
+        lines = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([line['user'] for line in lines], [self.author.id])
+
+
+class WebhooksTestCase(BaseTestCaseWithData):
+    """
+    Test the webhooks, with a local HTTP server
+    """
+
+    def setUp(self):
+        super(WebhooksTestCase, self).setUp()
+        import threading
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+        test = self
+        self.requests = []
+        self.statuses = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                test.requests.append((self.path, self.headers, body))
+                self.send_response(test.statuses.pop(0) if test.statuses
+                                   else 200)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever).start()
+        self.url = 'http://127.0.0.1:%s/hook' % self.server.server_port
+
+        flag_settings.WEBHOOKS_BATCH_WAIT = 0.1
+        flag_settings.WEBHOOKS_RETRY_DELAY = 0.01
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        super(WebhooksTestCase, self).tearDown()
+
+    def _get_events(self, index):
+        """
+        Return the events sent in a request
+        """
+        import json
+        return json.loads(self.requests[index][2])['events']
+
+    def test_threshold(self):
+        """
+        Test the event sent when a threshold is crossed, and its signature
+        """
+        flag_settings.WEBHOOKS = [dict(url=self.url, secret='secret',
+                                       thresholds=[2])]
+        for user in (self.user, self.author, self.staff_user):
+            FlagInstance.objects.add(user, self.model_with_author,
+                                     comment='comment')
+        self.assertTrue(webhooks.flush(5))
+
+        self.assertEqual(len(self.requests), 1)
+        path, headers, body = self.requests[0]
+        self.assertEqual(path, '/hook')
+        self.assertEqual(headers[webhooks.SIGNATURE_HEADER],
+                         webhooks.sign('secret', body))
+        events = self._get_events(0)
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]['event'], 'threshold')
+        self.assertEqual(events[0]['threshold'], 2)
+        self.assertEqual(events[0]['count'], 2)
+        self.assertEqual(events[0]['content_type'], 'tests.modelwithauthor')
+        self.assertEqual(events[0]['object_id'], self.model_with_author.id)
+
+    def test_status(self):
+        """
+        Test the events sent when the status changes, for the endpoints
+        wanting them, and their batching
+        """
+        flag_settings.WEBHOOKS = [dict(url=self.url, events=['status'])]
+        flag_settings.WEBHOOKS_BATCH_WAIT = 1
+        FlagInstance.objects.add(self.user, self.model_with_author,
+                                 comment='comment')
+        FlagInstance.objects.add(self.staff_user, self.model_with_author,
+                                 comment='comment', status=2)
+        FlagInstance.objects.add(self.staff_user, self.model_with_author,
+                                 comment='comment', status=3)
+        self.assertTrue(webhooks.flush(5))
+
+        self.assertEqual(len(self.requests), 1)
+        self.assertFalse(webhooks.SIGNATURE_HEADER in self.requests[0][1])
+        events = self._get_events(0)
+        self.assertEqual([(event['event'], event['previous'], event['status'])
+                          for event in events],
+                         [('status', 1, 2), ('status', 2, 3)])
+        self.assertEqual(events[0]['moderator'], self.staff_user.id)
+
+    def test_retries(self):
+        """
+        Test the new attempts when an endpoint fails
+        """
+        flag_settings.WEBHOOKS = [dict(url=self.url, thresholds=[1])]
+        self.statuses = [500, 503]
+        FlagInstance.objects.add(self.user, self.model_with_author,
+                                 comment='comment')
+        self.assertTrue(webhooks.flush(5))
+        self.assertEqual(len(self.requests), 3)
+        self.assertEqual(self.requests[0][2], self.requests[2][2])
+
+        # dropped after too many retries
+        flag_settings.WEBHOOKS_MAX_RETRIES = 1
+        self.statuses = [500, 500, 500]
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment')
+        self.assertTrue(webhooks.flush(5))
+        self.assertEqual(len(self.requests), 5)
+
+
+class DeferredSignalTestCase(BaseTestCaseWithData):
+    """
+    Test the deferred receivers of the `content_flagged` signal
+    """
+
+    def setUp(self):
+        super(DeferredSignalTestCase, self).setUp()
+        import threading
+        self.calls = []
+
+        def receiver(sender, flagged_content, flagged_instance, **kwargs):
+            self.calls.append((flagged_instance.id,
+                               threading.current_thread().name))
+        self.receiver = receiver
+        content_flagged.connect(receiver, deferred=True)
+
+    def tearDown(self):
+        content_flagged.disconnect(self.receiver)
+        deferred.discard()
+        super(DeferredSignalTestCase, self).tearDown()
+
+    def _flag(self):
+        return FlagInstance.objects.add(self.user, self.model_with_author,
+                                        comment='comment', send_signal=True)
+
+    def test_deferred(self):
+        """
+        Test that deferred receivers are run by the pool
+        """
+        flag_instance = self._flag()
+        self.assertTrue(deferred.drain(5))
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.calls[0][0], flag_instance.id)
+        self.assertTrue(self.calls[0][1].startswith('flag-deferred-'))
+
+        # disconnected
+        content_flagged.disconnect(self.receiver)
+        self._flag()
+        self.assertTrue(deferred.drain(5))
+        self.assertEqual(len(self.calls), 1)
+
+    def test_hold(self):
+        """
+        Test that receivers are only run when released, and not if discarded
+        (as done by the middleware)
+        """
+        deferred.hold()
+        flag_instance = self._flag()
+        self.assertTrue(deferred.drain(5))
+        self.assertEqual(self.calls, [])
+        deferred.release()
+        self.assertTrue(deferred.drain(5))
+        self.assertEqual([call[0] for call in self.calls], [flag_instance.id])
+
+        deferred.hold()
+        self._flag()
+        deferred.discard()
+        self.assertTrue(deferred.drain(5))
+        self.assertEqual(len(self.calls), 1)
+
+    def test_queue_full(self):
+        """
+        Test the backpressure when the queue of the pool is full
+        """
+        import threading
+        flag_settings.DEFERRED_WORKERS = 1
+        flag_settings.DEFERRED_QUEUE_SIZE = 1
+        pool = deferred.Pool()
+        started, blocked = threading.Event(), threading.Event()
+
+        def block():
+            started.set()
+            blocked.wait(5)
+        calls = []
+
+        pool.submit(block)
+        started.wait(5)
+        pool.submit(calls.append, 'queued')
+        pool.submit(calls.append, 'inline')
+        self.assertEqual(calls, ['inline'])
+
+        flag_settings.DEFERRED_QUEUE_FULL = 'drop'
+        pool.submit(calls.append, 'dropped')
+        blocked.set()
+        self.assertTrue(pool.drain(5))
+        self.assertEqual(calls, ['inline', 'queued'])
+        self.assertEqual(pool.get_stats(), dict(submitted=2, run=3, failed=0,
+                                                inline=1, dropped=1))
+
+
+class QueuedFlagsTestCase(BaseTestCaseWithData):
+    """
+    Test the queued mode and the grouped add of flags
+    """
+
+    def test_add_grouped(self):
+        """
+        Test that flags are added grouped by object, with the limits checked
+        """
+        flag_settings.LIMIT_FOR_OBJECT = 3
+        flag_settings.LIMIT_SAME_OBJECT_FOR_USER = 1
+        users = [self.user, self.author, self.staff_user,
+                 User.objects.create_user('other', 'other@example.com', 'o')]
+        flags = [dict(user=user, content_object=self.model_with_author,
+                      comment='comment') for user in users]
+        flags.insert(1, dict(user=self.user, comment='comment',
+                             content_object=self.model_without_author))
+        flags.insert(2, dict(user=self.user, comment='comment',
+                             content_object=self.model_with_author))
+
+        results = FlagInstance.objects.add_grouped(flags)
+        self.assertEqual([result.__class__ for result in results],
+                         [FlagInstance, FlagInstance,
+                          ContentAlreadyFlaggedByUserException,
+                          FlagInstance, FlagInstance,
+                          ContentFlaggedEnoughException])
+        self.assertEqual(FlaggedContent.objects.get_for_object(
+                self.model_with_author).count, 3)
+        self.assertEqual(FlaggedContent.objects.get_for_object(
+                self.model_without_author).count, 1)
+        self.assertEqual(results[0].flagged_content.count, 3)
+
+    def test_notify_after(self):
+        """
+        Test that with `notify=False`, the signals are only sent by
+        `notify_added`
+        """
+        received = []
+
+        def receiver(sender, flagged_content, flagged_instance, **kwargs):
+            received.append(flagged_instance)
+        content_flagged.connect(receiver)
+        try:
+            results = FlagInstance.objects.add_grouped([
+                    dict(user=user, content_object=self.model_with_author,
+                         comment='comment')
+                    for user in (self.user, self.author)],
+                    send_signal=True, notify=False)
+            self.assertEqual(received, [])
+            FlagInstance.objects.notify_added(results, send_signal=True)
+        finally:
+            content_flagged.disconnect(receiver)
+        self.assertEqual(received, results)
+        self.assertEqual([result.reached_count for result in results], [1, 2])
+
+    def test_many_flags_by_user(self):
+        """
+        Test that many flags of a user for the same object can be queued if
+        the model allows it
+        """
+        flag_settings.LIMIT_SAME_OBJECT_FOR_USER = 0
+        for index in range(2):
+            ingestion.enqueue(self.user, self.model_with_author,
+                              comment='comment')
+        flag_settings.LIMIT_SAME_OBJECT_FOR_USER = 2
+        ingestion.enqueue(self.user, self.model_without_author,
+                          comment='comment')
+        ingestion.enqueue(self.user, self.model_without_author,
+                          comment='comment')
+        self.assertEqual(ingestion.process(), 4)
+        self.assertEqual(FlagInstance.objects.filter(
+                user=self.user).count(), 4)
+
+    def test_failing_flag(self):
+        """
+        Test that a queued flag always failing doesn't block the queue
+        """
+        queue = ingestion.get_queue()
+        queue.put(self.user, self.model_with_author, comment='comment')
+        queue.put(self.author, self.model_with_author, comment='poison')
+        queue.put(self.staff_user, self.model_with_author, comment='comment')
+        add_grouped = FlagInstance.objects.add_grouped
+
+        def failing_add_grouped(flags, *args, **kwargs):
+            if [flag for flag in flags if flag['comment'] == 'poison']:
+                raise ValueError('invalid flag')
+            return add_grouped(flags, *args, **kwargs)
+        FlagInstance.objects.add_grouped = failing_add_grouped
+        try:
+            self.assertEqual(ingestion.process(batch_size=10), 3)
+        finally:
+            del FlagInstance.objects.add_grouped
+        self.assertEqual(QueuedFlag.objects.count(), 0)
+        self.assertEqual(sorted(FlagInstance.objects.values_list('user',
+                                                                 flat=True)),
+                         sorted([self.user.pk, self.staff_user.pk]))
+
+    def test_queued_mode(self):
+        """
+        Test that the views only queue the flags, added by the command
+        """
+        import json
+        flag_settings.QUEUE = True
+        flag_settings.LIMIT_SAME_OBJECT_FOR_USER = 1
+        form = get_default_form(self.model_without_author)
+        form_data = dict((key, form[key].value()) for key in form.fields)
+        form_data.update(dict(comment='comment'))
+        self.client.login(username=self.user.username,
+                          password=self.USER_BASE)
+
+        resp = self.client.post(reverse('flag_json'), copy(form_data))
+        self.assertEqual(resp.status_code, 202)
+        self.assertTrue(json.loads(resp.content)['queued'])
+        self.assertEqual(QueuedFlag.objects.count(), 1)
+        self.assertEqual(FlagInstance.objects.count(), 0)
+
+        # duplicate
+        resp = self.client.post(reverse('flag_json'), copy(form_data))
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(json.loads(resp.content)['error_code'],
+                         'already_flagged_by_user')
+
+        # a flag for a deleted object
+        ingestion.enqueue(self.author, self.model_with_author, None, 'comment')
+        QueuedFlag.objects.filter(user=self.author).update(object_id=999)
+
+        received = []
+
+        def receiver(sender, flagged_content, flagged_instance, **kwargs):
+            received.append(flagged_instance)
+        content_flagged.connect(receiver)
+        try:
+            call_command('flag_process_queue', verbosity=0)
+        finally:
+            content_flagged.disconnect(receiver)
+        self.assertEqual(QueuedFlag.objects.count(), 0)
+        flag_instance = FlagInstance.objects.get()
+        self.assertEqual(flag_instance.user, self.user)
+        self.assertEqual(flag_instance.comment, 'comment')
+        self.assertEqual(received, [flag_instance])
+
+
+class SpoolTestCase(BaseTestCaseWithData):
+    """
+    Test the spool of flags used when the database is not available
+    """
+
+    def setUp(self):
+        import tempfile
+        super(SpoolTestCase, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        flag_settings.SPOOL_PATH = os.path.join(self.directory, 'spool')
+        flag_settings.SPOOL_FSYNC_INTERVAL = 0
+        spool._circuit['open_until'] = 0
+
+    def tearDown(self):
+        import shutil
+        spool._circuit['open_until'] = 0
+        shutil.rmtree(self.directory)
+        super(SpoolTestCase, self).tearDown()
+
+    def _read_records(self):
+        import json
+        with open(flag_settings.SPOOL_PATH) as spool_file:
+            return [json.loads(line) for line in spool_file]
+
+    def test_spool_and_replay(self):
+        """
+        Test that flags are spooled on database errors, and added once by
+        the command
+        """
+        calls = []
+
+        def failing_add(*args, **kwargs):
+            calls.append(args)
+            raise DatabaseError('database unavailable')
+        FlagInstance.objects._add = failing_add
+        try:
+            self.assertEqual(FlagInstance.objects.add(self.user,
+                    self.model_with_author, comment='comment'), None)
+            # the circuit is open: the database is not used
+            self.assertEqual(FlagInstance.objects.add(self.author,
+                    self.model_with_author, comment='other'), None)
+            self.assertEqual(FlagInstance.objects.add(self.staff_user,
+                    self.model_with_author, comment='comment',
+                    status=3), None)
+        finally:
+            del FlagInstance.objects._add
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(spool.is_circuit_open())
+
+        records = self._read_records()
+        self.assertEqual([(record['u'], record['m']) for record in records],
+                         [(self.user.pk, 'comment'),
+                          (self.author.pk, 'other'),
+                          (self.staff_user.pk, 'comment')])
+        self.assertEqual(records[2]['s'], 3)
+        self.assertEqual(FlagInstance.objects.count(), 0)
+
+        call_command('flag_replay_spool', wait=0, verbosity=0)
+        flagged_content = FlaggedContent.objects.get()
+        self.assertEqual(flagged_content.count, 2)
+        self.assertEqual(flagged_content.status, 3)
+        self.assertEqual(FlagInstance.objects.count(), 3)
+        self.assertEqual(FlagSpoolCursor.objects.count(), 0)
+        self.assertFalse(os.path.exists(flag_settings.SPOOL_PATH))
+
+        # nothing more to replay
+        self.assertEqual(spool.replay(wait=0), 0)
+        self.assertEqual(FlagInstance.objects.count(), 3)
+
+    def test_failed_add_not_announced(self):
+        """
+        Test that a flag spooled after an error is not announced before
+        being replayed
+        """
+        received = []
+
+        def receiver(sender, flagged_content, flagged_instance, **kwargs):
+            received.append(flagged_instance)
+        add = FlagInstance.objects._add
+
+        def failing_add(*args, **kwargs):
+            add(*args, **kwargs)
+            raise DatabaseError('connection lost')
+        content_flagged.connect(receiver)
+        try:
+            FlagInstance.objects._add = failing_add
+            try:
+                self.assertEqual(FlagInstance.objects.add(self.user,
+                        self.model_with_author, comment='comment',
+                        send_signal=True), None)
+            finally:
+                del FlagInstance.objects._add
+            self.assertEqual(received, [])
+
+            # what the rollback does outside of the tests
+            FlaggedContent.objects.all().delete()
+            spool.replay(wait=0)
+        finally:
+            content_flagged.disconnect(receiver)
+        self.assertEqual(len(received), 1)
+
+    def test_integrity_error(self):
+        """
+        Test that integrity errors are raised, not spooled
+        """
+        def failing_add(*args, **kwargs):
+            raise IntegrityError('duplicate key')
+        FlagInstance.objects._add = failing_add
+        try:
+            self.assertRaises(IntegrityError, FlagInstance.objects.add,
+                    self.user, self.model_with_author, comment='comment')
+        finally:
+            del FlagInstance.objects._add
+        self.assertFalse(spool.is_circuit_open())
+        self.assertFalse(os.path.exists(flag_settings.SPOOL_PATH))
+
+    def test_failing_record(self):
+        """
+        Test that a record always failing doesn't block the replay
+        """
+        spool.write(self.user, self.model_with_author, None, 'comment')
+        spool.write(self.author, self.model_with_author, None, 'poison')
+        spool.write(self.staff_user, self.model_with_author, None, 'comment')
+        add_grouped = FlagInstance.objects.add_grouped
+
+        def failing_add_grouped(flags, *args, **kwargs):
+            if [flag for flag in flags if flag['comment'] == 'poison']:
+                raise ValueError('invalid flag')
+            return add_grouped(flags, *args, **kwargs)
+        FlagInstance.objects.add_grouped = failing_add_grouped
+        try:
+            self.assertEqual(spool.replay(wait=0), 3)
+        finally:
+            del FlagInstance.objects.add_grouped
+        self.assertEqual(sorted(FlagInstance.objects.values_list('user',
+                                                                 flat=True)),
+                         sorted([self.user.pk, self.staff_user.pk]))
+        self.assertEqual(FlagSpoolCursor.objects.count(), 0)
+
+    def test_replay_resume(self):
+        """
+        Test that a replay starts at the offset stored for the file
+        """
+        spool.write(self.user, self.model_with_author, None, 'comment')
+        spool.write(self.author, self.model_with_author, None, 'comment')
+        size = os.path.getsize(flag_settings.SPOOL_PATH)
+        spool.write(self.staff_user, self.model_with_author, None, 'comment')
+        # a record being written
+        with open(flag_settings.SPOOL_PATH, 'a') as spool_file:
+            spool_file.write('{"u":')
+
+        moved_path = flag_settings.SPOOL_PATH + '.1'
+        os.rename(flag_settings.SPOOL_PATH, moved_path)
+        FlagSpoolCursor.objects.create(name='spool.1', offset=size)
+        self.assertEqual(spool.replay(batch_size=1, wait=0), 1)
+        flag_instance = FlagInstance.objects.get()
+        self.assertEqual(flag_instance.user, self.staff_user)
+        self.assertFalse(os.path.exists(moved_path))
+
+
+class IdempotencyKeyTestCase(BaseTestCaseWithData):
+    """
+    Test that flags added with an idempotency key are not added twice
+    """
+
+    def test_add(self):
+        """
+        Test that `add` returns the flag already added with the same key
+        """
+        flag_settings.LIMIT_SAME_OBJECT_FOR_USER = 1
+        flag_instance = FlagInstance.objects.add(self.user,
+                self.model_with_author, comment='comment',
+                idempotency_key='abc')
+        self.assertEqual(FlagInstance.objects.add(self.user,
+                self.model_with_author, comment='comment',
+                idempotency_key='abc'), flag_instance)
+        self.assertEqual(FlaggedContent.objects.get().count, 1)
+
+        # keys are by user
+        other = FlagInstance.objects.add(self.author, self.model_with_author,
+                comment='comment', idempotency_key='abc')
+        self.assertNotEqual(other, flag_instance)
+
+        # the limit is still checked without the key
+        self.assertRaises(ContentAlreadyFlaggedByUserException,
+                FlagInstance.objects.add, self.user, self.model_with_author,
+                comment='comment', idempotency_key='def')
+
+    def test_add_grouped(self):
+        """
+        Test that `add_grouped` doesn't add flags with an already used key
+        """
+        flag_instance = FlagInstance.objects.add(self.user,
+                self.model_with_author, comment='comment',
+                idempotency_key='abc')
+        results = FlagInstance.objects.add_grouped([
+                dict(user=self.user, content_object=self.model_with_author,
+                     comment='comment', idempotency_key='abc'),
+                dict(user=self.author, content_object=self.model_with_author,
+                     comment='comment', idempotency_key='abc'),
+                dict(user=self.author, content_object=self.model_with_author,
+                     comment='comment', idempotency_key='abc')])
+        self.assertEqual(results[0], flag_instance)
+        self.assertEqual(results[1], results[2])
+        self.assertEqual(results[1].user, self.author)
+        self.assertEqual(FlagInstance.objects.count(), 2)
+        self.assertEqual(FlaggedContent.objects.get().count, 2)
+
+    def test_views(self):
+        """
+        Test that a request sent again with the same key returns the same
+        result
+        """
+        import json
+        flag_settings.LIMIT_SAME_OBJECT_FOR_USER = 1
+        form = get_default_form(self.model_without_author)
+        form_data = dict((key, form[key].value()) for key in form.fields)
+        form_data.update(dict(comment='comment'))
+        self.client.login(username=self.user.username,
+                          password=self.USER_BASE)
+
+        for retry in range(2):
+            resp = self.client.post(reverse('flag_json'), copy(form_data),
+                                    HTTP_IDEMPOTENCY_KEY='abc')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(json.loads(resp.content)['count'], 1)
+        self.assertEqual(FlagInstance.objects.count(), 1)
+
+        # without the key, the user already flagged this object
+        resp = self.client.post(reverse('flag_json'), copy(form_data))
+        self.assertEqual(resp.status_code, 400)
+
+        resp = self.client.post(reverse('flag_json'), copy(form_data),
+                                HTTP_IDEMPOTENCY_KEY='a' * 65)
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(json.loads(resp.content)['error_code'],
+                         'invalid_idempotency_key')
+
+        # queued mode
+        flag_settings.QUEUE = True
+        form = get_default_form(self.model_with_author)
+        form_data = dict((key, form[key].value()) for key in form.fields)
+        form_data.update(dict(comment='comment', idempotency_key='def'))
+        for retry in range(2):
+            resp = self.client.post(reverse('flag_json'), copy(form_data))
+            self.assertEqual(resp.status_code, 202)
+        self.assertEqual(QueuedFlag.objects.count(), 1)
+        self.assertEqual(QueuedFlag.objects.get().idempotency_key, 'def')
+        ingestion.process()
+        flag_instance = FlagInstance.objects.get(user=self.user,
+                                                 idempotency_key='def')
+        self.assertEqual(flag_instance.flagged_content.object_id,
+                         self.model_with_author.pk)
+
+    def test_concurrent_add(self):
+        """
+        Test that a flag added with the same key by a concurrent request is
+        returned
+        """
+        flag_instance = FlagInstance.objects.add(self.user,
+                self.model_with_author, comment='comment',
+                idempotency_key='abc')
+        get_for_idempotency_key = FlagInstance.objects.get_for_idempotency_key
+        calls = []
+
+        def get_after_check(*args):
+            # not added yet when checked
+            calls.append(args)
+            if len(calls) == 1:
+                return None
+            return get_for_idempotency_key(*args)
+        FlagInstance.objects.get_for_idempotency_key = get_after_check
+        try:
+            self.assertEqual(FlagInstance.objects.add(self.user,
+                    self.model_with_author, comment='comment',
+                    idempotency_key='abc'), flag_instance)
+        finally:
+            del FlagInstance.objects.get_for_idempotency_key
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(FlagInstance.objects.count(), 1)
+
+    def test_reused_key(self):
+        """
+        Test that a key already used for another object is refused
+        """
+        FlagInstance.objects.add(self.user, self.model_with_author,
+                comment='comment', idempotency_key='abc')
+        self.assertRaises(IdempotencyKeyReusedException,
+                FlagInstance.objects.add, self.user,
+                self.model_without_author, comment='comment',
+                idempotency_key='abc')
+
+        results = FlagInstance.objects.add_grouped([
+                dict(user=self.user, content_object=self.model_without_author,
+                     comment='comment', idempotency_key='abc'),
+                dict(user=self.author, content_object=self.model_with_author,
+                     comment='comment', idempotency_key='def'),
+                dict(user=self.author,
+                     content_object=self.model_without_author,
+                     comment='comment', idempotency_key='def')])
+        self.assertTrue(isinstance(results[0], IdempotencyKeyReusedException))
+        self.assertTrue(isinstance(results[1], FlagInstance))
+        self.assertTrue(isinstance(results[2], IdempotencyKeyReusedException))
+        self.assertEqual(FlagInstance.objects.count(), 2)
+
+
+class ShardedCountsTestCase(BaseTestCaseWithData):
+    """
+    Test the sharded counts of the most flagged contents
+    """
+
+    def _add_flags(self, count):
+        users = [User.objects.create_user('user%d' % User.objects.count(),
+                                          'user@example.com', 'user')
+                 for index in range(count)]
+        return FlagInstance.objects.add_grouped([
+                dict(user=user, content_object=self.model_with_author,
+                     comment='comment') for user in users])
+
+    def test_sharded_counts(self):
+        """
+        Test that a flagged content is sharded when flagged fast, and that
+        its count stays right
+        """
+        flag_settings.SHARDED_COUNTS = True
+        flag_settings.SHARDED_COUNTS_RATE = 3
+        flag_settings.SHARDED_COUNTS_FOLD_INTERVAL = 60
+        self._add_flags(2)
+        self.assertFalse(FlaggedContent.objects.get().sharded)
+        self._add_flags(3)
+        flagged_content = FlaggedContent.objects.get()
+        self.assertTrue(flagged_content.sharded)
+        self.assertEqual(flagged_content.count, 5)
+
+        # the first flags are moved to the count, then they wait in the
+        # shards for the next fold
+        self._add_flags(1)
+        self.assertEqual(FlaggedContent.objects.get().count, 6)
+        results = self._add_flags(2)
+        flagged_content = FlaggedContent.objects.get()
+        self.assertEqual(flagged_content.count, 6)
+        self.assertEqual(flagged_content.get_count(), 8)
+        self.assertEqual(results[-1].flagged_content.count, 6)
+        self.assertEqual(results[-1].flagged_content.get_count(), 8)
+        self.assertEqual(flag_tags.flag_count(self.model_with_author), 8)
+
+        # a save doesn't overwrite the count
+        flagged_content.count = 0
+        flagged_content.save()
+        self.assertEqual(FlaggedContent.objects.get().get_count(), 8)
+
+        # a fold doesn't change the count read by a loaded flagged content
+        call_command('flag_fold_counts', verbosity=0)
+        self.assertEqual(results[-1].flagged_content.get_count(), 8)
+        flagged_content = FlaggedContent.objects.get()
+        self.assertEqual(flagged_content.count, 8)
+        self.assertEqual(FlagCountShard.objects.get_total(flagged_content), 0)
+
+    def test_sharded_while_loaded(self):
+        """
+        Test that a flagged content sharded after being loaded is not
+        overwritten when flagged
+        """
+        FlagInstance.objects.add(self.user, self.model_with_author,
+                                 comment='comment')
+        get_or_create_for_object = \
+                FlaggedContent.objects.get_or_create_for_object
+
+        def get_and_shard(*args, **kwargs):
+            result = get_or_create_for_object(*args, **kwargs)
+            FlaggedContent.objects.filter(id=result[0].id).update(
+                    count=15, sharded=True)
+            return result
+        FlaggedContent.objects.get_or_create_for_object = get_and_shard
+        try:
+            FlagInstance.objects.add(self.author, self.model_with_author,
+                                     comment='comment')
+            flagged_content = FlaggedContent.objects.get()
+            self.assertEqual((flagged_content.count, flagged_content.sharded),
+                             (16, True))
+            FlagInstance.objects.add(self.staff_user, self.model_with_author,
+                                     comment='comment', status=2)
+        finally:
+            del FlaggedContent.objects.get_or_create_for_object
+        flagged_content = FlaggedContent.objects.get()
+        self.assertEqual((flagged_content.count, flagged_content.sharded,
+                          flagged_content.status), (15, True, 2))
+
+    def test_flag_states(self):
+        """
+        Test that the `flag_states` view counts the shards, and that its
+        response changes with each flag
+        """
+        import json
+        flag_settings.SHARDED_COUNTS = True
+        flag_settings.SHARDED_COUNTS_RATE = 1
+        flag_settings.SHARDED_COUNTS_FOLD_INTERVAL = 60
+        self._add_flags(1)
+        self._add_flags(2)
+        url = reverse('flag_states', kwargs=dict(
+            app_label='tests', object_name='modelwithauthor'))
+        url += '?ids=%s' % self.model_with_author.pk
+
+        resp = self.client.get(url)
+        self.assertEqual(json.loads(resp.content)[
+                str(self.model_with_author.pk)]['count'], 3)
+        self.assertFalse(resp.has_header('Last-Modified'))
+        etag = resp['ETag']
+        self.assertEqual(self.client.get(url,
+                HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self._add_flags(1)
+        resp = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.content)[
+                str(self.model_with_author.pk)]['count'], 4)
+
+    def test_limit(self):
+        """
+        Test that the limit of flags is checked with the shards
+        """
+        flag_settings.SHARDED_COUNTS = True
+        flag_settings.SHARDED_COUNTS_RATE = 1
+        flag_settings.SHARDED_COUNTS_FOLD_INTERVAL = 60
+        flag_settings.LIMIT_FOR_OBJECT = 10
+        self._add_flags(1)
+        self._add_flags(1)
+        results = self._add_flags(9)
+        self.assertEqual(FlaggedContent.objects.get().count, 2)
+        self.assertEqual([result.__class__ for result in results],
+                         [FlagInstance] * 8 + [ContentFlaggedEnoughException])
+        results = self._add_flags(1)
+        self.assertTrue(isinstance(results[0],
+                                   ContentFlaggedEnoughException))
@@ -0,0 +1,188 @@
+"""
+Cache for the evaluation of the trust of users (used when the NEEDS_TRUST
+setting is True).
+The result of the TRUST_EVAL_FUNC function is kept, by user id, in a LRU
+cache in process memory and, optionally, in a django cache (see the
+TRUST_CACHE_* settings).
+"""
+
+from django.contrib.auth.models import User
+from django.db.models.signals import post_save, post_delete
+
+from flag import settings as flag_settings
+from flag import utils
+
+__all__ = ('get_eval_func', 'is_user_trusted', 'are_users_trusted',
+           'invalidate', 'clear')
+
+_KEY_PREFIX = 'flag:trust:%s'
+
+_local_cache = utils.LRUCache()
+
+# the TRUST_EVAL_FUNC function, for a generation of the settings
+_eval_func = dict(generation=None, func=None)
+
+
+def get_eval_func():
+    """
+    Return the function defined by the TRUST_EVAL_FUNC setting, imported on
+    first use (and again if the settings change). Fallback to
+    `utils.can_user_be_trusted` if it cannot be imported
+    """
+    if _eval_func['generation'] != flag_settings.generation:
+        try:
+            func = utils.import_from_path(flag_settings.TRUST_EVAL_FUNC)
+        except (ImportError, ValueError, AttributeError), e:
+            func = utils.can_user_be_trusted
+        _eval_func.update(generation=flag_settings.generation, func=func)
+    return _eval_func['func']
+
+
+def _get_backend():
+    """
+    Return the django cache defined by the TRUST_CACHE_BACKEND setting, or
+    None
+    """
+    if not flag_settings.TRUST_CACHE_BACKEND:
+        return None
+    from django.core.cache import get_cache
+    return get_cache(flag_settings.TRUST_CACHE_BACKEND)
+
+
+def _evaluate(user, eval_func):
+    """
+    Call the eval function and return a tuple (trusted, timeout). The
+    timeout is the TRUST_CACHE_TIMEOUT setting if the function only
+    returns a boolean
+    """
+    result = eval_func(user)
+    if isinstance(result, tuple):
+        trusted, timeout = result
+    else:
+        trusted, timeout = result, flag_settings.TRUST_CACHE_TIMEOUT
+    return bool(trusted), timeout
+
+
+def _store(user_id, trusted, timeout, backend=None):
+    """
+    Store the trust of a user in the local cache and in the backend
+    """
+    if not timeout:
+        return
+    _local_cache.set(user_id, trusted, timeout,
+                     flag_settings.TRUST_CACHE_SIZE)
+    if backend is not None:
+        backend.set(_KEY_PREFIX % user_id, trusted, timeout)
+
+
+def is_user_trusted(user, eval_func):
+    """
+    Return True if the user can be trusted, using `eval_func` only if the
+    result is not already cached
+    """
+    if not flag_settings.TRUST_CACHE_TIMEOUT or not user.pk:
+        return _evaluate(user, eval_func)[0]
+
+    trusted = _local_cache.get(user.pk)
+    if trusted is not None:
+        return trusted
+
+    backend = _get_backend()
+    if backend is not None:
+        trusted = backend.get(_KEY_PREFIX % user.pk)
+        if trusted is not None:
+            _store(user.pk, trusted, flag_settings.TRUST_CACHE_TIMEOUT)
+            return trusted
+
+    trusted, timeout = _evaluate(user, eval_func)
+    _store(user.pk, trusted, timeout, backend)
+    return trusted
+
+
+def _get_batch_eval_func(eval_func):
+    """
+    Return the function to evaluate the trust of many users at once: the
+    TRUST_BATCH_EVAL_FUNC setting if defined, the default one if `eval_func`
+    is the default one, else a function calling `eval_func` for each user
+    """
+    if flag_settings.TRUST_BATCH_EVAL_FUNC:
+        return utils.import_from_path(flag_settings.TRUST_BATCH_EVAL_FUNC)
+    if eval_func is utils.can_user_be_trusted:
+        return utils.evaluate_trust
+
+    def batch_eval_func(user_ids):
+        return dict((user.pk, eval_func(user))
+            for user in User.objects.in_bulk(user_ids).values())
+    return batch_eval_func
+
+
+def are_users_trusted(users, eval_func):
+    """
+    Return a dict with the trust of each given user (or user id), by user
+    id. Users not in the cache are evaluated all at once (see the
+    TRUST_BATCH_EVAL_FUNC setting)
+    """
+    user_ids = set(getattr(user, 'pk', user) for user in users)
+    result = {}
+
+    use_cache = bool(flag_settings.TRUST_CACHE_TIMEOUT)
+    if use_cache:
+        for user_id in user_ids:
+            trusted = _local_cache.get(user_id)
+            if trusted is not None:
+                result[user_id] = trusted
+
+    missing = user_ids.difference(result)
+    backend = _get_backend() if use_cache else None
+    if missing and backend is not None:
+        keys = dict((_KEY_PREFIX % user_id, user_id) for user_id in missing)
+        for key, trusted in backend.get_many(keys.keys()).items():
+            result[keys[key]] = trusted
+            _store(keys[key], trusted, flag_settings.TRUST_CACHE_TIMEOUT)
+        missing = user_ids.difference(result)
+
+    if missing:
+        evaluated = _get_batch_eval_func(eval_func)(list(missing))
+        for user_id in missing:
+            value = evaluated.get(user_id, False)
+            if isinstance(value, tuple):
+                trusted, timeout = value
+            else:
+                trusted, timeout = value, flag_settings.TRUST_CACHE_TIMEOUT
+            result[user_id] = trusted = bool(trusted)
+            if use_cache:
+                _store(user_id, trusted, timeout, backend)
+
+    return result
+
+
+def invalidate(user):
+    """
+    Forget the trust of the given user (or user id), to force a new
+    evaluation on the next flag
+    """
+    user_id = getattr(user, 'pk', user)
+    _local_cache.delete(user_id)
+    backend = _get_backend()
+    if backend is not None:
+        backend.delete(_KEY_PREFIX % user_id)
+
+
+def clear():
+    """
+    Forget the trust of all users. Only the in-process cache is cleared, the
+    entries in the TRUST_CACHE_BACKEND cache will expire by themselves
+    """
+    _local_cache.clear()
+
+
+def _invalidate_user(sender, instance, **kwargs):
+    """
+    Signal receiver to invalidate the trust of a saved/deleted user
+    """
+    invalidate(instance)
+
+post_save.connect(_invalidate_user, sender=User,
+                  dispatch_uid='flag.trust.invalidate_on_save')
+post_delete.connect(_invalidate_user, sender=User,
+                    dispatch_uid='flag.trust.invalidate_on_delete')
@@ -12,5 +12,8 @@ from django.conf.urls.defaults import *
 urlpatterns = patterns("",
     url(r'(?P<app_label>\w+)/(?P<object_name>\w+)/(?P<object_id>\d+)/$',
             "flag.views.confirm", name="flag_confirm"),
+    url(r'^json/$', "flag.views.flag_json", name="flag_json"),
+    url(r'^states/(?P<app_label>\w+)/(?P<object_name>\w+)/$',
+            "flag.views.flag_states", name="flag_states"),
     url(r"^$", "flag.views.flag", name="flag"),
 )
@@ -1,8 +1,79 @@
-from datetime import date
+import json
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
 
-from django.contrib.contenttypes.models import ContentType
 from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections, transaction
+from django.utils import importlib, timezone
+
+from flag.profiling import profiled
+
+
+@contextmanager
+def in_transaction(using):
+    """
+    Run the block in a transaction, unless one is already managed
+    """
+    if transaction.is_managed(using=using):
+        yield
+    else:
+        with transaction.commit_on_success(using=using):
+            yield
+
+
+class LRUCache(object):
+    """
+    A thread-safe LRU cache with a timeout for each entry
+    """
+
+    def __init__(self):
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """
+        Return the value for this key, or None if not cached or expired
+        """
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                return None
+            if expires < time.time():
+                return None
+            # put it back at the end: it's the most recently used
+            self._data[key] = (value, expires)
+            return value
+
+    def set(self, key, value, timeout, max_size):
+        """
+        Store the value for `timeout` seconds, dropping the least recently
+        used entries to keep at most `max_size` entries
+        """
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, time.time() + timeout)
+            while len(self._data) > max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
 
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+@profiled('get_content_type_tuple')
 def get_content_type_tuple(content_type):
     """
     Return a tuple with `(app_name, model_name)` from "something"
@@ -17,6 +88,10 @@ def get_content_type_tuple(content_type):
     # check if integer, as integer or string => content_type id
     if isinstance(content_type, int) or (
             isinstance(content_type, basestring) and content_type.isdigit()):
+        from flag import registry
+        result = registry.get_tuple_for_id(int(content_type))
+        if result is not None:
+            return result
         ctype = ContentType.objects.get_for_id(content_type)
         app_label, model = ctype.app_label, ctype.model
 
@@ -42,10 +117,84 @@ def get_content_type_tuple(content_type):
     return app_label, model
 
 
+def encode_keyset(when, pk):
+    """
+    Return a string to use as cursor in a keyset pagination on a
+    (datetime, pk) couple (see `decode_keyset`)
+    """
+    if timezone.is_aware(when):
+        when = timezone.make_naive(when, timezone.utc)
+    return '%s_%s' % (when.strftime('%Y%m%d%H%M%S%f'), pk)
+
+
+def decode_keyset(value):
+    """
+    Return the (datetime, pk) couple of a cursor made by `encode_keyset`, or
+    raise a ValueError if invalid
+    """
+    when, pk = value.split('_', 1)
+    when = datetime.strptime(when, '%Y%m%d%H%M%S%f')
+    if settings.USE_TZ:
+        when = timezone.make_aware(when, timezone.utc)
+    return when, int(pk)
+
+
+def estimate_count(queryset):
+    """
+    Return the number of rows of the queryset as estimated by the database
+    planner (without running the query), or None if the database backend
+    cannot estimate it (only PostgreSQL and MySQL can)
+    """
+    connection = connections[queryset.db]
+    if connection.vendor not in ('postgresql', 'mysql'):
+        return None
+    sql, params = queryset.order_by().query.get_compiler(
+            queryset.db).as_sql()
+    cursor = connection.cursor()
+    if connection.vendor == 'postgresql':
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, basestring):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+    cursor.execute('EXPLAIN ' + sql, params)
+    columns = [column[0] for column in cursor.description]
+    return int(cursor.fetchone()[columns.index('rows')] or 0)
+
+
+def import_from_path(line):
+    """
+    Return the object (function, class...) defined by the given dotted path,
+    like "flag.utils.can_user_be_trusted"
+    """
+    path, name = line.rsplit('.', 1)
+    return getattr(importlib.import_module(path), name)
+
+
+def _trust_limit_date():
+    """
+    Return the date before which a user must have joined to be trusted,
+    regarding the TRUST_TIME setting
+    """
+    from flag import settings as flag_settings
+    return date.today() - timedelta(days=flag_settings.TRUST_TIME)
+
+
 def can_user_be_trusted(user):
     """
     This method is used to test if the given user meets the requirements to add a flag.
     for now, we only test the number of days the user has subscribed against FLAG_TRUST_TIME
     settings.FLAG_TRUST_TIME should be a number of days
     """
-    return ((date.today() - user.date_joined.date()).days > settings.FLAG_TRUST_TIME)
+    return user.date_joined.date() < _trust_limit_date()
+
+
+def evaluate_trust(user_ids):
+    """
+    Batch version of `can_user_be_trusted`: return a dict with the trust of
+    each of the given user ids, using only one query
+    """
+    limit = _trust_limit_date()
+    return dict((user_id, date_joined.date() < limit)
+        for user_id, date_joined in User.objects.filter(
+            id__in=user_ids).values_list('id', 'date_joined'))
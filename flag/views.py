@@ -1,9 +1,13 @@
+import calendar
+import json
+import time
 import urlparse
+from hashlib import md5
 
-from django.http import Http404, HttpResponseBadRequest
+from django.http import (Http404, HttpResponse, HttpResponseBadRequest,
+        HttpResponseNotModified)
 from django.shortcuts import redirect, render
 from django.template.loader import render_to_string
-from django.db.models import get_model
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
 from django.core.urlresolvers import reverse
 from django.contrib.auth.decorators import login_required
@@ -11,10 +15,16 @@ from django.contrib.contenttypes.models import ContentType
 from django.utils.translation import ugettext as _
 from django.contrib import messages
 from django.utils.html import escape
+from django.utils.http import http_date, parse_http_date_safe, parse_etags, \
+        quote_etag
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils import timezone, translation
+from django.middleware.csrf import get_token
 
 from django.conf import settings
 
 from flag import settings as flag_settings
+from flag import ingestion, registry
 from flag.forms import (FlagForm, FlagFormWithCreator, get_default_form,
         FlagFormWithStatus, FlagFormWithCreatorAndStatus)
 from flag.models import FlaggedContent, FlagInstance
@@ -56,6 +66,7 @@ class FlagBadRequest(HttpResponseBadRequest):
     """
     def __init__(self, why):
         super(FlagBadRequest, self).__init__()
+        self.why = why
         if settings.DEBUG:
             self.content = render_to_string("flag/400-debug.html",
                                             {"why": why})
@@ -92,21 +103,26 @@ def get_content_object(ctype, object_pk):
     """
     Given a content type ("app_name.model_name") and an object's pk, try to
     return the mathcing object
+    The model is resolved by the registry (see `flag.registry`), so invalid
+    content types are rejected without any query
     (based on django.contrib.comments.views.comments.post_comment)
     """
     if ctype is None or object_pk is None:
         return FlagBadRequest("Missing content_type or object_pk field.")
-    try:
-        model = get_model(*ctype.split(".", 1))
-        FlaggedContent.objects.assert_model_can_be_flagged(model)
-        return model._default_manager.get(pk=object_pk)
-    except TypeError:
-        return FlagBadRequest(
-            "Invalid content_type value: %r" % escape(ctype))
-    except AttributeError:
+    entry = registry.get(ctype)
+    if entry is None:
+        if '.' not in ctype:
+            return FlagBadRequest(
+                "Invalid content_type value: %r" % escape(ctype))
         return FlagBadRequest(
             "The given content-type %r does not resolve to a valid model." % \
                 escape(ctype))
+    if not entry.allowed:
+        return FlagBadRequest(
+            "Attempting to flag an unauthorized model (%r)" % \
+                escape(ctype))
+    try:
+        return entry.model._default_manager.get(pk=object_pk)
     except ObjectDoesNotExist:
         return FlagBadRequest(
             "No object matching content-type %r and object PK %r exists." % \
@@ -116,10 +132,6 @@ def get_content_object(ctype, object_pk):
             "Attempting go get content-type %r and object PK %r exists "
                 "raised %s" % \
                 (escape(ctype), escape(object_pk), e.__class__.__name__))
-    except FlagException, e:
-        return FlagBadRequest(
-            "Attempting to flag an unauthorized model (%r)" % \
-                escape(ctype))
 
 
 def assert_user_can_change_status(user):
@@ -132,75 +144,138 @@ def assert_user_can_change_status(user):
     raise OnlyStaffCanUpdateStatus("Only staff can update a flag's status")
 
 
-@login_required
-def flag(request):
+class FlagRequestError(Exception):
     """
-    Validate the form and create the flag.
-    In all cases, redirect to the `next` parameter.
+    Raised when a flag post is invalid, with a `code` used as `error_code` in
+    json responses, and a `why` to explain the problem
     """
+    def __init__(self, code, why):
+        super(FlagRequestError, self).__init__(why)
+        self.code = code
+        self.why = why
 
-    if request.method == 'POST':
-        post_data = request.POST.copy()
 
-        # only staff can update status
-        with_status = 'status' in post_data
+def get_flag_form(request, post_data):
+    """
+    Common part of the views adding a flag: check the rights of the user, get
+    the object to flag, and create the form with the good class.
+    Return a tuple with the object and the form (not yet validated, but the
+    security is checked), or raise a FlagRequestError
+    """
+    # only staff can update status
+    with_status = 'status' in post_data
+    if with_status:
+        try:
+            assert_user_can_change_status(request.user)
+        except OnlyStaffCanUpdateStatus, e:
+            raise FlagRequestError(e.code, str(e))
+
+    # the object to flag
+    content_object = get_content_object(post_data.get("content_type"),
+                                        post_data.get('object_pk'))
+
+    if (isinstance(content_object, HttpResponseBadRequest)):
+        raise FlagRequestError('bad_request', content_object.why)
+
+    # get the form class regrding if we have a creator_field
+    form_class = FlagForm
+
+    if 'creator_field' in post_data:
+        form_class = FlagFormWithCreator
         if with_status:
-            try:
-                assert_user_can_change_status(request.user)
-            except OnlyStaffCanUpdateStatus, e:
-                return FlagBadRequest(str(e))
+            form_class = FlagFormWithCreatorAndStatus
+    elif with_status:
+        form_class = FlagFormWithStatus
 
-        # the object to flag
-        object_pk = post_data.get('object_pk')
-        content_object = get_content_object(post_data.get("content_type"),
-                                            object_pk)
+    form = form_class(target_object=content_object, data=post_data)
 
-        if (isinstance(content_object, HttpResponseBadRequest)):
-                return content_object
+    if form.security_errors():
+        raise FlagRequestError('security',
+            "The flag form failed security verification: %s" % \
+                escape(str(form.security_errors())))
 
-        content_type = ContentType.objects.get_for_model(content_object)
+    # an invalid idempotency key is an error of the request
+    get_idempotency_key(request)
 
-        # get the form class regrding if we have a creator_field
-        form_class = FlagForm
+    return content_object, form
 
-        if 'creator_field' in post_data:
-            form_class = FlagFormWithCreator
-            if with_status:
-                form_class = FlagFormWithCreatorAndStatus
-        elif with_status:
-            form_class = FlagFormWithStatus
 
-        form = form_class(target_object=content_object, data=post_data)
+def get_idempotency_key(request):
+    """
+    Return the idempotency key sent by the client, in the `Idempotency-Key`
+    header or the `idempotency_key` POST parameter, or None.
+    Raise a FlagRequestError if it's too long
+    """
+    key = request.META.get('HTTP_IDEMPOTENCY_KEY') or \
+          request.POST.get('idempotency_key')
+    if not key:
+        return None
+    if len(key) > FlagInstance._meta.get_field('idempotency_key').max_length:
+        raise FlagRequestError('invalid_idempotency_key',
+                               'Invalid idempotency key')
+    return key
 
-        if form.security_errors():
-            return FlagBadRequest(
-                "The flag form failed security verification: %s" % \
-                    escape(str(form.security_errors())))
 
-        if form.is_valid():
+def add_flag_from_form(request, content_object, form):
+    """
+    Add the flag from a valid form (see `get_flag_form`) and return it.
+    Raise a FlagException if the user cannot flag this object.
+    If the request has an idempotency key (see `get_idempotency_key`) already
+    used by the user, the flag added with it is returned.
+    In the queued mode (QUEUE setting), a flag without status is only put in
+    the queue, and None is returned (as when it's spooled, see `flag.spool`)
+    """
+    # manage creator
+    creator = None
+    if form.__class__ == FlagFormWithCreator:
+        creator_field = form.cleaned_data['creator_field']
+        if creator_field:
+            creator = getattr(content_object,
+                              creator_field,
+                              None)
+
+    # manage comment
+    if registry.get_for_model(content_object).policy['ALLOW_COMMENTS']:
+        comment = form.cleaned_data['comment']
+    else:
+        comment = None
 
-            # manage creator
-            creator = None
-            if form_class == FlagFormWithCreator:
-                creator_field = form.cleaned_data['creator_field']
-                if creator_field:
-                    creator = getattr(content_object,
-                                      creator_field,
-                                      None)
-
-            # manage comment
-            if flag_settings.get_for_model(content_object, 'ALLOW_COMMENTS'):
-                comment = form.cleaned_data['comment']
-            else:
-                comment = None
+    # manage status
+    status = form.cleaned_data.get('status', flag_settings.DEFAULT_STATUS) or flag_settings.DEFAULT_STATUS
+
+    # queued mode, only for simple flags (not updates of status by staff)
+    idempotency_key = get_idempotency_key(request)
+    if flag_settings.QUEUE and 'status' not in form.cleaned_data:
+        ingestion.enqueue(request.user, content_object, creator, comment,
+                          idempotency_key)
+        return None
+
+    # add the flag, but check the user can do it
+    return FlagInstance.objects.add(request.user, content_object, creator,
+        comment, status, send_signal=True, send_mails=True,
+        idempotency_key=idempotency_key)
 
-            # manage status
-            status = form.cleaned_data.get('status', flag_settings.DEFAULT_STATUS) or flag_settings.DEFAULT_STATUS
+
+@login_required
+def flag(request):
+    """
+    Validate the form and create the flag.
+    In all cases, redirect to the `next` parameter.
+    """
+
+    if request.method == 'POST':
+        post_data = request.POST.copy()
+
+        try:
+            content_object, form = get_flag_form(request, post_data)
+        except FlagRequestError, e:
+            return FlagBadRequest(e.why)
+
+        if form.is_valid():
 
             # add the flag, but check the user can do it
             try:
-                FlagInstance.objects.add(request.user, content_object, creator,
-                    comment, status, send_signal=True, send_mails=True)
+                add_flag_from_form(request, content_object, form)
             except FlagException, e:
                 messages.error(request, unicode(e))
             else:
@@ -209,11 +284,12 @@ def flag(request):
 
         else:
             # form not valid, we return to the confirm page
+            content_type = ContentType.objects.get_for_model(content_object)
 
             return confirm(request,
                 app_label=content_type.app_label,
                 object_name=content_type.model,
-                object_id=object_pk,
+                object_id=post_data.get('object_pk'),
                 form=form)
 
     else:
@@ -227,12 +303,112 @@ def flag(request):
         raise Http404
 
 
+def json_response(data, status=200):
+    """
+    Return a response with the given data encoded in json
+    """
+    return HttpResponse(json.dumps(data), status=status,
+                        content_type='application/json')
+
+
+def flag_json(request):
+    """
+    Validate the form and create the flag, like the `flag` view, but return
+    a json dict with `count`, `status`, `can_flag_again` and `error_code`
+    (None if the flag was added), and `errors` if the form is not valid.
+    In the queued mode, the response is a 202 one, with `queued` set to True.
+    """
+    result = dict(count=0, status=None, can_flag_again=False,
+                  error_code=None)
+
+    if not request.user.is_authenticated():
+        result['error_code'] = 'login_required'
+        return json_response(result, 403)
+
+    if request.method != 'POST':
+        result['error_code'] = 'invalid_access'
+        return json_response(result, 405)
+
+    try:
+        content_object, form = get_flag_form(request, request.POST.copy())
+    except FlagRequestError, e:
+        result['error_code'] = e.code
+        return json_response(result, 400)
+
+    flag_instance = None
+    if not form.is_valid():
+        result['error_code'] = 'invalid_form'
+        result['errors'] = dict((field, [unicode(error) for error in errors])
+                                for field, errors in form.errors.items())
+    else:
+        try:
+            flag_instance = add_flag_from_form(request, content_object, form)
+        except FlagException, e:
+            result['error_code'] = e.code
+        else:
+            if flag_instance is None:
+                # queued: the state of the flagged content is not updated yet
+                result['queued'] = True
+                return json_response(result, 202)
+
+    # current state of the flagged content
+    if flag_instance is not None and flag_instance.pk:
+        flagged_content = flag_instance.flagged_content
+    else:
+        try:
+            flagged_content = FlaggedContent.objects.get_for_object(
+                    content_object)
+        except ObjectDoesNotExist:
+            flagged_content = None
+    if flagged_content is None:
+        result['can_flag_again'] = True
+    else:
+        result.update(count=flagged_content.get_count(),
+                      status=flagged_content.status,
+                      can_flag_again=flagged_content.can_be_flagged_by_user(
+                          request.user))
+
+    return json_response(result, 400 if result['error_code'] else 200)
+
+
+def _next_from_referer(request):
+    """
+    Return True if the next url (see `get_next`) comes from the referer
+    """
+    return 'next' not in getattr(request, 'POST', {}) and \
+        'next' not in getattr(request, 'GET', {}) and \
+        bool(request.META.get('HTTP_REFERER'))
+
+
+def get_confirm_etag(request, content_object, flagged_content, user_count,
+                     form, next):
+    """
+    Return the ETag of the confirm page, built from everything the page
+    depends on: the object, the state of its flagged content, the flags of
+    the user, the form (its timestamp changes with the security hash) and the
+    version of the templates
+    """
+    content_type = ContentType.objects.get_for_model(content_object)
+    if flagged_content is not None:
+        state = (flagged_content.count, flagged_content.status,
+                 str(flagged_content.when_updated))
+    else:
+        state = None
+    return md5(repr((content_type.id, content_object.pk, state,
+        request.user.pk, user_count, form.__class__.__name__,
+        form.initial.get('timestamp'), next, translation.get_language(),
+        get_token(request), flag_settings.CONFIRM_TEMPLATE_VERSION,
+    ))).hexdigest()
+
+
 @login_required
 def confirm(request, app_label, object_name, object_id, form=None):
     """
     Display a confirmation page for the flagging, with the comment form
     The template rendered is flag/confirm.html but it can be overrided for
     each model by defining a template flag/confirm_applabel_modelname.html
+    For a simple GET (no form given, no messages to display), the page has an
+    `ETag` header, and a 304 is returned if the client already has it.
     """
 
     content_object = get_content_object('%s.%s' % (app_label, object_name),
@@ -244,6 +420,11 @@ def confirm(request, app_label, object_name, object_id, form=None):
     # where to go when finished, also used on error
     next = get_next(request)
 
+    # the page can be validated only if it depends on nothing else than what
+    # is in the etag
+    conditional = form is None and request.method in ('GET', 'HEAD') and \
+        not len(messages.get_messages(request))
+
     # additional parameters
     if form:
         with_status = 'status' in form.fields
@@ -258,10 +439,21 @@ def confirm(request, app_label, object_name, object_id, form=None):
         creator_field = request.GET.get('creator_field', None)
 
     # get the flagged_content, and test if it can be flagged by the user
+    user_count = None
     try:
         flagged_content = FlaggedContent.objects.get_for_object(content_object)
+    except ObjectDoesNotExist:
+        # if the FlaggedContent does not exists, the object was never flagged
+        # so we know that we can continue
+        flagged_content = None
+    else:
+        if conditional and \
+                flagged_content.content_settings('LIMIT_SAME_OBJECT_FOR_USER'):
+            # needed for the etag, and reused for the check
+            user_count = flagged_content.count_flags_by_user(request.user)
         try:
-            flagged_content.assert_can_be_flagged_by_user(request.user)
+            flagged_content.assert_can_be_flagged_by_user(request.user,
+                                                          user_count)
         except FlagUserNotTrustedException, e:
             # we don't do anything here for now
             # because we want the user to continue without noticing
@@ -270,21 +462,151 @@ def confirm(request, app_label, object_name, object_id, form=None):
         except FlagException, e:
             messages.error(request, unicode(e))
             return redirect(next)
-    except ObjectDoesNotExist:
-        # if the FlaggedContent does not exists, the object was never flagged
-        # so we know that we can continue
-        pass
 
     # define the form
     form = form or get_default_form(content_object, creator_field, with_status)
 
-    # ready to render
-    context = dict(
-        content_object=content_object,
-        form=form,
-        next=next)
+    response = None
+    if conditional:
+        etag = get_confirm_etag(request, content_object, flagged_content,
+                                user_count, form, next)
+        if is_not_modified(request, etag):
+            response = HttpResponseNotModified()
+
+    if response is None:
+        # ready to render
+        context = dict(
+            content_object=content_object,
+            form=form,
+            next=next)
+
+        templates = ['flag/confirm_%s_%s.html' % (app_label, object_name),
+                     'flag/confirm.html']
+
+        response = render(request, templates, context)
 
-    templates = ['flag/confirm_%s_%s.html' % (app_label, object_name),
-                 'flag/confirm.html']
+    if conditional:
+        set_validators(response, etag, private=True)
+        vary = ['Cookie']
+        if _next_from_referer(request):
+            vary.append('Referer')
+        patch_vary_headers(response, vary)
 
-    return render(request, templates, context)
+    return response
+
+
+def _timestamp(value):
+    """
+    Return the unix timestamp of a (naive or aware) datetime
+    """
+    if timezone.is_aware(value):
+        return calendar.timegm(value.utctimetuple())
+    return int(time.mktime(value.timetuple()))
+
+
+def is_not_modified(request, etag, last_modified=None):
+    """
+    Return True if the client already has the version of the response
+    defined by `etag` and `last_modified` (a datetime, can be None), regarding
+    the `If-None-Match` and `If-Modified-Since` headers of the request
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        return etag in etags or '*' in etags
+    if_modified_since = parse_http_date_safe(
+            request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    if if_modified_since and last_modified:
+        return _timestamp(last_modified) <= if_modified_since
+    return False
+
+
+def set_validators(response, etag, last_modified=None, private=False):
+    """
+    Set the `ETag` and `Last-Modified` headers of the response, and force the
+    client to revalidate it each time
+    """
+    response['ETag'] = quote_etag(etag)
+    if last_modified:
+        response['Last-Modified'] = http_date(_timestamp(last_modified))
+    patch_cache_control(response, max_age=0, must_revalidate=True)
+    if private:
+        patch_cache_control(response, private=True)
+    return response
+
+
+def flag_states(request, app_label, object_name):
+    """
+    Return, in json, the flag state of many objects of the same model, with
+    their ids in the `ids` GET parameter (separated by commas), in a dict
+    with the ids as keys and, for each, a dict with `count`, `status` and
+    `can_flag` (if the current user can flag it)
+    The response has an `ETag` header (and a `Last-Modified` one for
+    anonymous users), and a 304 is returned if nothing changed, after only
+    one query.
+    """
+    entry = registry.get('%s.%s' % (app_label, object_name))
+    if entry is None:
+        return json_response(dict(error_code='bad_request'), 400)
+    try:
+        ids = sorted(set(int(object_id)
+            for object_id in request.GET.get('ids', '').split(',')
+            if object_id))
+    except ValueError:
+        return json_response(dict(error_code='bad_request'), 400)
+    if len(ids) > flag_settings.STATES_MAX_IDS:
+        return json_response(dict(error_code='too_many_ids'), 400)
+
+    limits = (entry.allowed, entry.policy['LIMIT_FOR_OBJECT'],
+              entry.policy['LIMIT_SAME_OBJECT_FOR_USER'])
+    flagged_contents = dict((flagged_content.object_id, flagged_content)
+        for flagged_content in FlaggedContent.objects.with_shards().filter(
+            content_type=entry.content_type_id, object_id__in=ids))
+    # the flags counted in the shards of sharded flagged contents
+    for flagged_content in flagged_contents.values():
+        flagged_content.count += flagged_content.shards_count or 0
+
+    user = request.user
+    authenticated = user.is_active and user.is_authenticated()
+
+    # validators: all the data used for the response is in the etag. The
+    # date only covers the flagged contents, so it's only sent if nothing
+    # else is used: not for an authenticated user (`can_flag` depends on
+    # the user and the limits), nor for sharded flagged contents (their
+    # flags don't update their date)
+    last_modified = None
+    if not authenticated and not any(flagged_content.sharded
+            for flagged_content in flagged_contents.values()):
+        last_modified = max([flagged_content.when_updated
+            for flagged_content in flagged_contents.values()] or [None])
+    etag = md5(repr((entry.content_type_id, ids, limits,
+        user.pk if authenticated else None,
+        [(flagged_content.object_id, flagged_content.count,
+          flagged_content.status, str(flagged_content.when_updated))
+            for flagged_content in sorted(flagged_contents.values(),
+                key=lambda flagged_content: flagged_content.object_id)]
+    ))).hexdigest()
+
+    if is_not_modified(request, etag, last_modified):
+        response = HttpResponseNotModified()
+    else:
+        counts = {}
+        if authenticated and limits[2]:
+            counts = FlaggedContent.objects.count_user_flags(user,
+                    flagged_contents.values())
+        result = {}
+        for object_id in ids:
+            flagged_content = flagged_contents.get(object_id)
+            result[object_id] = dict(
+                count=getattr(flagged_content, 'count', 0),
+                status=getattr(flagged_content, 'status', None),
+                can_flag=authenticated and \
+                    FlaggedContent.objects._can_be_flagged_by_user(
+                        flagged_content,
+                        counts.get(getattr(flagged_content, 'id', None), 0),
+                        limits))
+        response = json_response(result)
+
+    set_validators(response, etag, last_modified, private=authenticated)
+    patch_vary_headers(response, ('Cookie',))
+    return response
@@ -0,0 +1,305 @@
+"""
+Webhooks, to notify other services (with a POST of json data) when a
+flagged content crosses a threshold of flags, or when its status changes.
+The endpoints are defined by the WEBHOOKS setting (which can be defined by
+model), as a list of dicts with:
+ - `url`: the url to POST to
+ - `secret` (optional): the key used to sign the body (see `sign`)
+ - `events` (optional): the kinds of events to send, "threshold" and/or
+   "status" (default to both)
+ - `thresholds` (optional): the counts of flags triggering a "threshold"
+   event (default to the LIMIT_FOR_OBJECT setting)
+Events are sent by a background thread, by batches (a list of events in
+each POST), with retries and an exponential backoff if an endpoint fails.
+"""
+
+import hmac
+import heapq
+import httplib
+import json
+import logging
+import os
+import Queue
+import socket
+import threading
+import time
+from hashlib import sha256
+from urlparse import urlsplit
+
+from django.utils import timezone
+
+from flag import settings as flag_settings
+from flag import registry
+
+__all__ = ('THRESHOLD', 'STATUS', 'sign', 'get_endpoints',
+           'notify_count', 'notify_status', 'flush')
+
+THRESHOLD = 'threshold'
+STATUS = 'status'
+
+SIGNATURE_HEADER = 'X-Flag-Signature'
+
+logger = logging.getLogger('flag.webhooks')
+
+
+def sign(secret, body):
+    """
+    Return the signature of a body, as sent in the `X-Flag-Signature`
+    header: "sha256=" followed by the hex HMAC-SHA256 of the body, with the
+    secret of the endpoint as key
+    """
+    return 'sha256=%s' % hmac.new(str(secret), body, sha256).hexdigest()
+
+
+def get_endpoints(flagged_content, kind):
+    """
+    Return the endpoints of the model of the flagged content which want
+    events of the given kind
+    """
+    content_type = registry.get_tuple_for_id(flagged_content.content_type_id)
+    if content_type is None:
+        return []
+    endpoints = flag_settings.get_for_model('%s.%s' % content_type,
+                                            'WEBHOOKS')
+    return [endpoint for endpoint in endpoints or ()
+            if kind in endpoint.get('events', (THRESHOLD, STATUS))]
+
+
+def _make_event(kind, flagged_content, **data):
+    """
+    Return the dict of an event for the flagged content (with the current
+    count of flags, if not in `data`)
+    """
+    content_type = registry.get_tuple_for_id(flagged_content.content_type_id)
+    event = dict(event=kind,
+                 flagged_content=flagged_content.id,
+                 content_type='%s.%s' % content_type if content_type
+                              else flagged_content.content_type_id,
+                 object_id=flagged_content.object_id,
+                 status=flagged_content.status,
+                 when=timezone.now().isoformat())
+    event.update(data)
+    if 'count' not in event:
+        event['count'] = flagged_content.get_count()
+    return event
+
+
+def notify_count(flagged_content, previous_count, count):
+    """
+    Send a "threshold" event to the endpoints for which the count of flags
+    of the flagged content crossed a threshold, from `previous_count` to
+    `count` (both read in the transaction adding the flags, so a threshold
+    is crossed by only one transaction)
+    """
+    endpoints = get_endpoints(flagged_content, THRESHOLD)
+    if not endpoints:
+        return
+    limit = flag_settings.get_for_model(
+            '%s.%s' % registry.get_tuple_for_id(
+                    flagged_content.content_type_id),
+            'LIMIT_FOR_OBJECT')
+    for endpoint in endpoints:
+        for threshold in endpoint.get('thresholds', [limit] if limit else []):
+            if previous_count < threshold <= count:
+                _dispatcher.enqueue(endpoint, _make_event(THRESHOLD,
+                        flagged_content, threshold=threshold, count=count))
+
+
+def notify_status(flagged_content, previous_status):
+    """
+    Send a "status" event to the endpoints, for the new status of the
+    flagged content
+    """
+    for endpoint in get_endpoints(flagged_content, STATUS):
+        _dispatcher.enqueue(endpoint, _make_event(STATUS, flagged_content,
+                previous=previous_status,
+                moderator=flagged_content.moderator_id))
+
+
+def flush(timeout=None):
+    """
+    Wait for all the events to be sent (or dropped after too many retries).
+    Return False if they are not sent after `timeout` seconds
+    """
+    return _dispatcher.flush(timeout)
+
+
+class Dispatcher(object):
+    """
+    Send the events in a background thread, started on the first event (and
+    again in a forked process)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+        self.queue = None
+        self.pending = 0
+        self.done = threading.Condition(self.lock)
+        # HTTP connections kept open, by (scheme, host:port), only used by
+        # the thread
+        self.connections = {}
+        # batches to send again: (time, attempt, endpoint, events)
+        self.retries = []
+
+    def start(self):
+        """
+        Start the thread if not running in this process
+        """
+        with self.lock:
+            if self.pid == os.getpid() and self.thread.is_alive():
+                return
+            self.pid = os.getpid()
+            self.queue = Queue.Queue(flag_settings.WEBHOOKS_QUEUE_SIZE)
+            self.pending = 0
+            self.connections, self.retries = {}, []
+            self.thread = threading.Thread(target=self.run,
+                                           name='flag-webhooks')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def enqueue(self, endpoint, event):
+        """
+        Add an event to send to the endpoint. The event is dropped if the
+        queue is full
+        """
+        self.start()
+        with self.lock:
+            self.pending += 1
+        try:
+            self.queue.put_nowait((endpoint, event))
+        except Queue.Full:
+            logger.error('Webhooks queue full, event dropped for %s',
+                         endpoint['url'])
+            self._done(1)
+
+    def _done(self, count):
+        """
+        Mark `count` events as sent (or dropped)
+        """
+        with self.lock:
+            self.pending -= count
+            if not self.pending:
+                self.done.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Wait for the pending events to be sent
+        """
+        end = time.time() + timeout if timeout is not None else None
+        with self.lock:
+            while self.pending:
+                remaining = end - time.time() if end is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.done.wait(remaining)
+        return True
+
+    def _get_batch(self):
+        """
+        Wait for events (or for a retry to be due), and return the list of
+        the events received, waiting WEBHOOKS_BATCH_WAIT seconds for more
+        events after the first one
+        """
+        timeout = None
+        if self.retries:
+            timeout = max(self.retries[0][0] - time.time(), 0)
+        batch = []
+        try:
+            batch.append(self.queue.get(True, timeout))
+        except Queue.Empty:
+            return batch
+        end = time.time() + flag_settings.WEBHOOKS_BATCH_WAIT
+        while len(batch) < flag_settings.WEBHOOKS_BATCH_SIZE:
+            remaining = end - time.time()
+            try:
+                if remaining > 0:
+                    batch.append(self.queue.get(True, remaining))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            # group the events by endpoint
+            by_url = {}
+            for endpoint, event in self._get_batch():
+                by_url.setdefault(endpoint['url'], (endpoint, []))[1] \
+                      .append(event)
+            for endpoint, events in by_url.values():
+                self.send(endpoint, events, 0)
+
+            # send again the batches which failed
+            while self.retries and self.retries[0][0] <= time.time():
+                due, attempt, endpoint, events = heapq.heappop(self.retries)
+                self.send(endpoint, events, attempt)
+
+    def send(self, endpoint, events, attempt):
+        """
+        Send the events to the endpoint, and schedule a new attempt if it
+        fails
+        """
+        try:
+            self.post(endpoint, events)
+        except Exception, e:
+            if attempt >= flag_settings.WEBHOOKS_MAX_RETRIES:
+                logger.error('Webhook %s failed, %d events dropped: %s',
+                             endpoint['url'], len(events), e)
+                self._done(len(events))
+            else:
+                delay = flag_settings.WEBHOOKS_RETRY_DELAY * 2 ** attempt
+                logger.warning('Webhook %s failed, retry in %ss: %s',
+                               endpoint['url'], delay, e)
+                heapq.heappush(self.retries, (time.time() + delay,
+                                              attempt + 1, endpoint, events))
+        else:
+            self._done(len(events))
+
+    def get_connection(self, scheme, netloc):
+        """
+        Return the HTTP connection kept open for the host
+        """
+        key = (scheme, netloc)
+        if key not in self.connections:
+            cls = httplib.HTTPSConnection if scheme == 'https' \
+                  else httplib.HTTPConnection
+            self.connections[key] = cls(netloc,
+                    timeout=flag_settings.WEBHOOKS_TIMEOUT)
+        return self.connections[key]
+
+    def post(self, endpoint, events):
+        """
+        POST the events to the endpoint, as a json dict with an `events`
+        list. Raise an exception if it fails (not a 2xx response)
+        """
+        body = json.dumps(dict(events=events), separators=(',', ':'))
+        headers = {'Content-Type': 'application/json'}
+        if endpoint.get('secret'):
+            headers[SIGNATURE_HEADER] = sign(endpoint['secret'], body)
+        url = urlsplit(endpoint['url'])
+        path = url.path or '/'
+        if url.query:
+            path = '%s?%s' % (path, url.query)
+
+        # a kept connection may have been closed by the server: try again
+        # once with a new one
+        for retry in (False, True):
+            connection = self.get_connection(url.scheme, url.netloc)
+            try:
+                connection.request('POST', path, body, headers)
+                response = connection.getresponse()
+                response.read()
+                break
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                del self.connections[(url.scheme, url.netloc)]
+                if retry:
+                    raise
+        if not 200 <= response.status < 300:
+            raise httplib.HTTPException('HTTP %s' % response.status)
+
+
+_dispatcher = Dispatcher()
@@ -22,3 +22,27 @@ alter table flag_flaginstance drop when_recalled;
 -- add a status field
 alter table flag_flaginstance add status smallint CHECK (status >= 0) default 1 not null;
 
+----------------
+-- 0.4 => 0.5 --
+----------------
+
+-- new tables (flag_flagpolicy, flag_flagpolicyversion, flag_flagcounter,
+-- flag_flagrollup, flag_flagrollupcursor, flag_flagevent, flag_queuedflag,
+-- flag_flagspoolcursor, flag_flagcountshard):
+-- run `syncdb`
+-- then fill the counters: run `manage.py flag_rebuild_counters`
+-- and the daily rollups: run `manage.py flag_rollup`
+
+-- flag_flaggedcontent
+
+-- sharded counts
+alter table flag_flaggedcontent add column sharded boolean not null default false;
+
+-- flag_flaginstance
+
+-- index for the pagination of the flags in the admin
+create index flag_flaginstance_content_when_added on flag_flaginstance (flagged_content_id, when_added, id);
+
+-- idempotency keys of flags, unique by user
+alter table flag_flaginstance add column idempotency_key varchar(64) null;
+create unique index flag_flaginstance_user_id_idempotency_key on flag_flaginstance (user_id, idempotency_key);
@@ -9,6 +9,7 @@ setup(
     author_email = "greg@20seven.org",
     url = "http://code.google.com/p/django-flag/",
     packages = find_packages(),
+    install_requires = ["Django>=1.4"],
     classifiers = [
         "Development Status :: 3 - Alpha",
         "Environment :: Web Environment",